@@ -0,0 +1,338 @@
+"""Mide el crawl completo contra un sitio sintetico local.
+
+    python benchmarks/crawl.py [--backends sqlite,jsonl,parquet,elasticsearch]
+        [--hosts 4] [--pages 200] [--fanout 5] [--slow-hosts 1] [--slow-delay 0.5]
+        [--set CONCURRENT_REQUESTS=32 ...] [--output resultados.json]
+
+Levanta en otro proceso un sitio con HOSTS hosts <n>.bench.unlp.edu.ar
+servidos por https con un certificado autofirmado (los primeros SLOW_HOSTS
+responden con SLOW_DELAY segundos de demora) y corre UNLPCrawler una vez por
+backend de persistencia, cada una en un proceso nuevo y en un directorio
+temporal. Los nombres *.unlp.edu.ar se resuelven a 127.0.0.1. Elasticsearch
+se reemplaza por un servidor local que acepta /_bulk; mongodb solo se mide
+con --mongo HOST:PORT.
+
+Imprime (o guarda en --output) un JSON con, por backend: paginas por
+segundo, latencia p50/p99 desde que llega la respuesta hasta que el item
+sale de los pipelines, tiempo de analisis, RSS maximo del proceso del crawl
+(sin los procesos de ANALYSIS_EXECUTOR) e items guardados por segundo de
+escritura.
+"""
+import argparse
+import datetime
+import http.server
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DOMAIN = 'bench.unlp.edu.ar'
+
+
+# --- sitio sintetico ---------------------------------------------------------
+
+def self_signed_certificate():
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '*.' + DOMAIN)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName('*.' + DOMAIN)]), critical=False)
+        .sign(key, hashes.SHA256()))
+    return (cert.public_bytes(serialization.Encoding.PEM)
+        + key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()))
+
+
+def render_page(args, host, n):
+    rnd = random.Random('{}/{}'.format(host, n))
+    head = ['<title>Pagina {} de {}</title>'.format(n, host)]
+    head += ['<link rel="stylesheet" href="/static/c{}.css">'.format(i) for i in range(args.styles)]
+    head += ['<script src="/static/s{}.js"></script>'.format(i) for i in range(args.scripts)]
+    head.append('<script>var pagina = {};</script>'.format(n))
+    body = ['<!-- comentario {} {} -->'.format(i, rnd.random()) for i in range(args.comments)]
+    body += ['<form action="/buscar" method="get" class="f"><input name="q{}"></form>'.format(i)
+        for i in range(args.forms)]
+    body += ['<p>{}</p>'.format(' '.join('palabra{}'.format(rnd.randrange(1000)) for _ in range(60)))
+        for _ in range(args.paragraphs)]
+    body += ['<a href="/p/{}">link</a>'.format(rnd.randrange(args.pages)) for _ in range(args.fanout)]
+    other = rnd.randrange(args.hosts)
+    body.append('<a href="https://{}.{}:{}/p/{}">otro host</a>'.format(other, DOMAIN, args.port,
+        rnd.randrange(args.pages)))
+    return '<html><head>{}</head><body>{}</body></html>'.format(''.join(head), ''.join(body)).encode()
+
+
+def serve(args):
+    from twisted.internet import reactor, ssl
+    from twisted.web import resource, server
+
+    class Site(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            host = (request.getHeader('host') or '').split(':')[0]
+            index = host.split('.')[0]
+            path = request.path.decode()
+            if path.endswith('.js'):
+                request.setHeader(b'content-type', b'application/javascript')
+                body = 'var {} = 1;'.format(path.split('/')[-1][:-3]).encode()
+            elif path.endswith('.css'):
+                request.setHeader(b'content-type', b'text/css')
+                body = b'body { margin: 0 }'
+            else:
+                last = path.rstrip('/').split('/')[-1]
+                request.setHeader(b'content-type', b'text/html; charset=utf-8')
+                body = render_page(args, host, int(last) if last.isdigit() else 0)
+            if index.isdigit() and int(index) < args.slow_hosts:
+                reactor.callLater(args.slow_delay, self.finish, request, body)
+                return server.NOT_DONE_YET
+            return body
+
+        def finish(self, request, body):
+            if not request._disconnected:
+                request.write(body)
+                request.finish()
+
+    # con tickets, como la mayoria de los servidores, para medir la reanudacion de sesiones
+    certificate = ssl.PrivateCertificate.loadPEM(self_signed_certificate())
+    options = ssl.CertificateOptions(privateKey=certificate.privateKey.original,
+        certificate=certificate.original, enableSessionTickets=True)
+    port = reactor.listenSSL(args.port, server.Site(Site()), options, interface='127.0.0.1')
+    args.port = port.getHost().port
+    print(json.dumps({'port': args.port}), flush=True)
+    reactor.run()
+
+
+class ElasticsearchStub(http.server.BaseHTTPRequestHandler):
+    # responde lo minimo para que el cliente 7.x acepte el servidor y /_bulk
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json({'version': {'number': '7.17.0', 'build_flavor': 'default'},
+            'tagline': 'You Know, for Search'})
+
+    def do_POST(self):
+        lines = self.rfile.read(int(self.headers.get('Content-Length') or 0)).splitlines()
+        items = []
+        for line in lines[::2]:
+            action = next(iter(json.loads(line)))
+            items.append({action: {'status': 201}})
+        self.send_json({'errors': False, 'items': items})
+
+    def log_message(self, *args):
+        pass
+
+
+def start_elasticsearch_stub():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ElasticsearchStub)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+# --- crawl -------------------------------------------------------------------
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def crawl(args):
+    os.chdir(args.workdir)
+    with open('domains', 'w') as f:
+        f.write('\n'.join('{}.{}:{}'.format(i, DOMAIN, args.port) for i in range(args.hosts)))
+    os.environ['SCRAPY_SETTINGS_MODULE'] = 'unlp_crawler.settings'
+
+    from scrapy import signals
+    from scrapy.crawler import CrawlerRunner
+    from scrapy.resolver import CachingThreadedResolver
+    from scrapy.utils.log import configure_logging
+    from scrapy.utils.project import get_project_settings
+    from twisted.internet import reactor
+
+    class LocalResolver(CachingThreadedResolver):
+        def getHostByName(self, name, timeout=None):
+            if name.endswith('.unlp.edu.ar'):
+                name = '127.0.0.1'
+            return super().getHostByName(name, timeout)
+
+    settings = get_project_settings()
+    # settings.py agrega sus propios handlers al logger raiz
+    for h in list(logging.getLogger().handlers):
+        logging.getLogger().removeHandler(h)
+    settings.setdict({
+        'LOG_FILE': None,
+        'LOG_LEVEL': 'WARNING',
+        'PERSISTENCE_TYPE': args.backend,
+        'SQLITE_DB': 'bench.db',
+        'EXPORT_DIR': 'export',
+        'ASSET_CACHE_DB': None,
+        'ELASTICSEARCH_SERVER': '127.0.0.1',
+        'ELASTICSEARCH_PORT': args.es_port,
+        'MONGO_SERVER': (args.mongo or ':').split(':')[0],
+        'MONGO_PORT': int((args.mongo or ':27017').split(':')[1]),
+        'MONGO_DATABASE': 'bench',
+        'TELNETCONSOLE_ENABLED': False,
+        'LOGSTASH_ENABLED': False,
+    }, priority='cmdline')
+    for kv in args.set:
+        key, value = kv.split('=', 1)
+        settings.set(key, value, priority='cmdline')
+    configure_logging(settings)
+
+    from unlp_crawler.spiders.unlp import UNLPCrawler
+    runner = CrawlerRunner(settings)
+    reactor.installResolver(LocalResolver(reactor, 1000, 60))
+    crawler = runner.create_crawler(UNLPCrawler)
+
+    received = {}
+    latencies = []
+
+    def response_received(response, request, spider):
+        received[response.url] = time.monotonic()
+
+    def item_scraped(item, response, spider):
+        start = received.pop(response.url, None)
+        if start is not None:
+            latencies.append(time.monotonic() - start)
+
+    crawler.signals.connect(response_received, signal=signals.response_received)
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+    start = time.monotonic()
+    runner.crawl(crawler).addBoth(lambda _: reactor.stop())
+    reactor.run()
+    elapsed = time.monotonic() - start
+
+    stats = crawler.stats.get_stats()
+    items = stats.get('item_scraped_count', 0)
+    writes = stats.get('persistence/write_latency/count', 0)
+    # save() incluye los lotes que se envian durante el crawl; el ultimo se
+    # envia al cerrar
+    write_time = stats.get('persistence/write_latency/sum', 0) + stats.get('persistence/close_time', 0)
+    analysis = stats.get('analysis/latency/count', 0)
+    return {
+        'backend': args.backend,
+        'items': items,
+        'responses': stats.get('response_received_count', 0),
+        'errors': stats.get('log_count/ERROR', 0),
+        'elapsed': round(elapsed, 3),
+        'pages_per_sec': round(items / elapsed, 2) if elapsed else None,
+        'item_latency_p50': percentile(latencies, 50),
+        'item_latency_p99': percentile(latencies, 99),
+        'analysis_chunk_mean': stats.get('analysis/latency/sum', 0) / analysis if analysis else None,
+        'write_time': round(write_time, 3),
+        'rows_per_write_sec': round(writes / write_time, 1) if write_time else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'finish_reason': stats.get('finish_reason'),
+    }
+
+
+# --- orquestacion ------------------------------------------------------------
+
+def site_args(args):
+    return ['--hosts', str(args.hosts), '--pages', str(args.pages), '--fanout', str(args.fanout),
+        '--scripts', str(args.scripts), '--styles', str(args.styles), '--forms', str(args.forms),
+        '--comments', str(args.comments), '--paragraphs', str(args.paragraphs),
+        '--slow-hosts', str(args.slow_hosts), '--slow-delay', str(args.slow_delay)]
+
+
+def run(args):
+    site = subprocess.Popen([sys.executable, __file__, 'serve', '--port', str(args.port)] + site_args(args),
+        stdout=subprocess.PIPE, text=True)
+    try:
+        port = json.loads(site.stdout.readline())['port']
+        es = start_elasticsearch_stub()
+        results = []
+        for backend in args.backends.split(','):
+            if backend == 'mongodb' and not args.mongo:
+                results.append({'backend': backend, 'skipped': 'sin --mongo'})
+                continue
+            with tempfile.TemporaryDirectory(prefix='unlp-bench-') as workdir:
+                cmd = [sys.executable, __file__, 'crawl', '--backend', backend, '--workdir', workdir,
+                    '--port', str(port), '--es-port', str(es.server_address[1])] + site_args(args)
+                if args.mongo:
+                    cmd += ['--mongo', args.mongo]
+                for kv in args.set:
+                    cmd += ['--set', kv]
+                p = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+                if p.returncode:
+                    results.append({'backend': backend, 'error': p.returncode})
+                else:
+                    results.append(json.loads(p.stdout.strip().splitlines()[-1]))
+            print(json.dumps(results[-1]), file=sys.stderr)
+        es.shutdown()
+    finally:
+        site.terminate()
+        site.wait()
+    report = {
+        'timestamp': int(time.time()),
+        'config': {k: v for k, v in vars(args).items() if k not in ('role', 'output', 'workdir')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('role', nargs='?', default='run', choices=['run', 'serve', 'crawl'],
+        help=argparse.SUPPRESS)
+    parser.add_argument('--backends', default='sqlite,jsonl,parquet,elasticsearch')
+    parser.add_argument('--hosts', type=int, default=4)
+    parser.add_argument('--pages', type=int, default=200, help='paginas por host')
+    parser.add_argument('--fanout', type=int, default=5, help='links por pagina')
+    parser.add_argument('--scripts', type=int, default=3)
+    parser.add_argument('--styles', type=int, default=2)
+    parser.add_argument('--forms', type=int, default=1)
+    parser.add_argument('--comments', type=int, default=3)
+    parser.add_argument('--paragraphs', type=int, default=20)
+    parser.add_argument('--slow-hosts', type=int, default=1)
+    parser.add_argument('--slow-delay', type=float, default=0.5)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--mongo', help='HOST:PORT de un mongodb para medir ese backend')
+    parser.add_argument('--set', action='append', default=[], help='KEY=VALUE para settings.py')
+    parser.add_argument('--output')
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--es-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == 'serve':
+        serve(args)
+    elif args.role == 'crawl':
+        print(json.dumps(crawl(args)))
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Compara los motores de extraccion de parse_item sobre paginas guardadas.
+
+    python benchmarks/extraction.py CORPUS_DIR [--repeat 5] [--url https://www.unlp.edu.ar/]
+
+CORPUS_DIR es un directorio con archivos .html (por ejemplo guardados con
+`curl -o` desde los dominios del archivo `domains`). Cada repeticion crea una
+respuesta nueva, asi que el tiempo incluye el parseo del documento.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrapy.http import HtmlResponse
+
+from unlp_crawler.extraction import EXTRACTORS
+
+
+def load_corpus(path, url):
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(path, '**', '*.htm*'), recursive=True)):
+        with open(filename, 'rb') as f:
+            pages.append((url + os.path.relpath(filename, path), f.read()))
+    return pages
+
+
+def normalize(data):
+    # el orden de comments no esta definido (vienen de un set)
+    data = dict(data)
+    data['comments'] = sorted(data['comments'])
+    return data
+
+
+def run(backend, pages, repeat):
+    extractor = EXTRACTORS[backend]()
+    results = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [extractor.extract(HtmlResponse(url, body=body, encoding='utf-8')) for url, body in pages]
+    elapsed = time.perf_counter() - start
+    return elapsed, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--url', default='https://www.unlp.edu.ar/')
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus, args.url)
+    if not pages:
+        sys.exit('No hay paginas .html en {}'.format(args.corpus))
+
+    report = {'pages': len(pages), 'repeat': args.repeat, 'backends': {}}
+    outputs = {}
+    for backend in EXTRACTORS:
+        elapsed, results = run(backend, pages, args.repeat)
+        outputs[backend] = results
+        report['backends'][backend] = {
+            'seconds': round(elapsed, 4),
+            'pages_per_second': round(len(pages) * args.repeat / elapsed, 1),
+        }
+
+    reference = outputs.pop('selector')
+    for backend, results in outputs.items():
+        mismatches = [pages[i][0] for i, (a, b) in enumerate(zip(reference, results))
+                      if normalize(a) != normalize(b)]
+        report['backends'][backend]['mismatches'] = mismatches
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import hashlib
+
+import pytest
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from unlp_crawler.cache import AssetHashCache
+from unlp_crawler.items import Page, PageItem, Script, Stylesheet
+from unlp_crawler.pipelines import AssetPipeline
+
+CSS = 'http://a.unlp.edu.ar/estilo.css'
+JS = 'http://a.unlp.edu.ar/app.js'
+
+
+def md5(body):
+    return hashlib.md5(body).hexdigest()
+
+
+class StubEngine:
+    # engine.download que no descarga: cada request queda pendiente hasta
+    # que el test lo responde con reply()
+
+    def __init__(self):
+        self.requests = []
+
+    def download(self, request):
+        d = Deferred()
+        self.requests.append((request, d))
+        return d
+
+    def reply(self, status=200, body=b'', headers=None):
+        request, d = self.requests.pop(0)
+        d.callback(Response(request.url, status=status, body=body, headers=headers, request=request))
+        return request
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    crawler = get_crawler(settings_dict={
+        'ASSET_CACHE_CLASS': 'unlp_crawler.cache.AssetHashCache',
+        'ASSET_CACHE_DB': str(tmp_path / 'assets.db'),
+        'ASSET_CACHE_SIZE': 10,
+    })
+    crawler.engine = StubEngine()
+    pipeline = AssetPipeline.from_crawler(crawler)
+    yield pipeline
+    pipeline.close_spider(None)
+
+
+def page_item(n):
+    page = Page(1, 'http://a.unlp.edu.ar/{}'.format(n), 'texto', (), 200, '127.0.0.1', 'a.unlp.edu.ar',
+        css=(Stylesheet('stylesheet', '/estilo.css', ''),), js=(Script('', '/app.js', ''),))
+    return PageItem(page)
+
+
+def results(d):
+    out = []
+    d.addCallback(out.append)
+    return out
+
+
+def test_lru_evicts_oldest():
+    cache = AssetHashCache(size=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+    assert cache.get('b') is None
+    assert cache.get('a').md5 == '1'
+    assert cache.get('c').md5 == '3'
+
+
+def test_persisted_entries_need_revalidation(tmp_path):
+    path = str(tmp_path / 'assets.db')
+    cache = AssetHashCache(path)
+    cache.set(CSS, 'abc', etag='"v1"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT')
+    assert cache.get(CSS).fresh
+    cache.close()
+    cache = AssetHashCache(path)
+    asset = cache.get(CSS)
+    assert asset.md5 == 'abc'
+    assert asset.etag == '"v1"'
+    assert asset.last_modified == 'Mon, 01 Jan 2024 00:00:00 GMT'
+    assert not asset.fresh
+    assert cache.touch(CSS).md5 == 'abc'
+    assert cache.get(CSS).fresh
+    cache.close()
+
+
+def test_concurrent_downloads_are_shared(pipeline):
+    engine = pipeline.crawler.engine
+    first = results(pipeline.process_item(page_item(1), None))
+    second = results(pipeline.process_item(page_item(2), None))
+    # un request por recurso aunque lo pidan dos paginas
+    assert [r.url for r, _ in engine.requests] == [CSS, JS]
+    assert not first and not second
+    engine.reply(body=b'body { }', headers={'ETag': '"v1"'})
+    engine.reply(body=b'var a;')
+    for item in (first[0], second[0]):
+        assert item.page.css[0].md5 == md5(b'body { }')
+        assert item.page.js[0].md5 == md5(b'var a;')
+    assert pipeline.stats.get_value('asset_cache/miss') == 2
+    # ya en el cache: no se vuelve a descargar
+    third = results(pipeline.process_item(page_item(3), None))
+    assert not engine.requests
+    assert third[0].page.css[0].md5 == md5(b'body { }')
+    assert pipeline.stats.get_value('asset_cache/hit') == 2
+
+
+def test_not_modified_keeps_cached_md5(pipeline, tmp_path):
+    engine = pipeline.crawler.engine
+    # entrada de una corrida anterior
+    previous = AssetHashCache(str(tmp_path / 'assets.db'))
+    previous.set(CSS, 'abc', etag='"v1"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT')
+    previous.close()
+    out = results(pipeline.asset_md5(CSS))
+    request, _ = engine.requests[0]
+    assert request.headers[b'If-None-Match'] == b'"v1"'
+    assert request.headers[b'If-Modified-Since'] == b'Mon, 01 Jan 2024 00:00:00 GMT'
+    engine.reply(status=304)
+    assert out == ['abc']
+    assert pipeline.cache.get(CSS).fresh
+    assert pipeline.stats.get_value('asset_cache/revalidated') == 1
+    # ya revalidado en esta corrida
+    assert results(pipeline.asset_md5(CSS)) == ['abc']
+    assert not engine.requests
+
+
+def test_changed_asset_replaces_cached_md5(pipeline, tmp_path):
+    engine = pipeline.crawler.engine
+    previous = AssetHashCache(str(tmp_path / 'assets.db'))
+    previous.set(CSS, 'abc', etag='"v1"')
+    previous.close()
+    out = results(pipeline.asset_md5(CSS))
+    engine.reply(body=b'body { color: red }', headers={'ETag': '"v2"'})
+    assert out == [md5(b'body { color: red }')]
+    assert pipeline.cache.get(CSS).etag == '"v2"'
+
+
+def test_failed_download_resolves_all_waiters(pipeline):
+    engine = pipeline.crawler.engine
+    first = results(pipeline.asset_md5(JS))
+    second = results(pipeline.asset_md5(JS))
+    assert len(engine.requests) == 1
+    _, d = engine.requests.pop(0)
+    d.errback(ConnectionError('stub'))
+    assert first == second == ['']
+    assert not pipeline.inflight
+    assert pipeline.stats.get_value('asset_cache/error') == 1
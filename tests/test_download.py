@@ -0,0 +1,147 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+from scrapy.core.downloader.tls import ScrapyClientTLSOptions
+from scrapy.settings import Settings
+
+from unlp_crawler import download
+from unlp_crawler.download import ResumingContextFactory, ResumingTLSOptions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Corre en otro proceso (el reactor no se puede reiniciar): un servidor https
+# local con keep-alive, salvo /close que cierra la conexion, y un spider que
+# pide /a y /b (misma conexion del pool), /close y /c (conexion nueva, con la
+# sesion TLS reanudada). Cada respuesta pasa por CertificateTracker.
+CRAWL = """
+import json, ssl, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import scrapy
+from scrapy.crawler import CrawlerProcess
+
+from unlp_crawler.certificates import CertificateTracker
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = b'<html><body>ok</body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+
+context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+context.load_cert_chain(sys.argv[1])
+server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+server.socket = context.wrap_socket(server.socket, server_side=True)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = 'https://localhost:{}'.format(server.server_address[1])
+result = {'responses': [], 'emitted': 0}
+
+
+class Spider(scrapy.Spider):
+    name = 'tls'
+    paths = ['/a', '/b', '/close', '/c']
+
+    def start_requests(self):
+        self.tracker = CertificateTracker.from_crawler(self.crawler)
+        yield scrapy.Request(base + self.paths[0], dont_filter=True)
+
+    def parse(self, response):
+        cert_hash, certificate = self.tracker.track(response.url, response.certificate, time.time())
+        result['responses'].append([response.url, bool(cert_hash)])
+        result['emitted'] += certificate is not None
+        n = len(result['responses'])
+        if n < len(self.paths):
+            # la conexion tiene que volver al pool antes del siguiente request
+            time.sleep(0.1)
+            yield scrapy.Request(base + self.paths[n], dont_filter=True)
+
+
+process = CrawlerProcess({
+    'DOWNLOAD_HANDLERS': {
+        'http': 'unlp_crawler.download.AdaptiveDownloadHandler',
+        'https': 'unlp_crawler.download.AdaptiveDownloadHandler',
+    },
+    'DOWNLOADER_CLIENTCONTEXTFACTORY': 'unlp_crawler.download.ResumingContextFactory',
+    'DOWNLOAD_PROFILE_FILE': sys.argv[2],
+    'LOG_LEVEL': 'ERROR',
+})
+process.crawl(Spider)
+process.start()
+with open(sys.argv[2]) as f:
+    result['profile'] = json.load(f)['localhost']
+print(json.dumps(result))
+"""
+
+
+def self_signed_certificate(path):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256()))
+    with open(path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+
+
+def test_certificate_on_pooled_and_resumed_connections(tmp_path):
+    pem = tmp_path / 'server.pem'
+    self_signed_certificate(pem)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.run([sys.executable, '-c', CRAWL, str(pem), str(tmp_path / 'profile.json')],
+        env=env, cwd=str(tmp_path), capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert [path.split('/')[-1] for path, _ in result['responses']] == ['a', 'b', 'close', 'c']
+    # el certificado esta en todas las respuestas y se emite una sola vez
+    assert all(has_certificate for _, has_certificate in result['responses'])
+    assert result['emitted'] == 1
+    profile = result['profile']
+    assert profile['requests'] == 4
+    assert profile['connections'] == 2
+    if download.TLS_RESUMPTION:
+        assert profile['handshakes'] == 2
+        assert profile['resumed'] == 1
+
+
+def test_plain_tls_without_private_apis(monkeypatch):
+    monkeypatch.setattr(download, 'TLS_RESUMPTION', False)
+    factory = ResumingContextFactory.from_settings(Settings())
+    creator = factory.creatorForNetloc(b'a.unlp.edu.ar', 443)
+    assert type(creator) is ScrapyClientTLSOptions
+    factory.store(('a.unlp.edu.ar', 443), object())
+    assert not factory.sessions
+
+
+def test_resuming_tls_options():
+    factory = ResumingContextFactory.from_settings(Settings())
+    creator = factory.creatorForNetloc(b'a.unlp.edu.ar', 443)
+    assert isinstance(creator, ResumingTLSOptions)
+    assert creator.key == ('a.unlp.edu.ar', 443)
@@ -0,0 +1,127 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from scrapy.settings import Settings
+
+from unlp_crawler.items import SeenItem
+from unlp_crawler.persistence.types import ElasticSearchPersistence
+
+
+class StubElasticsearch(BaseHTTPRequestHandler):
+    # Responde el chequeo de producto del cliente y guarda los cuerpos de
+    # _bulk. server.responses es una lista de respuestas a usar en orden:
+    # un status HTTP (error de transporte) o una lista con el status de cada
+    # documento; vacia = todo bien.
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply(200, {'version': {'number': '7.17.0', 'build_flavor': 'default'},
+            'tagline': 'You Know, for Search'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        lines = body.splitlines()
+        self.server.bodies.append(lines)
+        response = self.server.responses.pop(0) if self.server.responses else None
+        if isinstance(response, int):
+            self.reply(response, {'error': 'stub', 'status': response})
+            return
+        statuses = response or [200] * (len(lines) // 2)
+        items = []
+        for action, status in zip(lines[::2], statuses):
+            op = next(iter(json.loads(action)))
+            result = {'_index': 'test', '_id': None, 'status': status}
+            if status >= 300:
+                result['error'] = {'type': 'stub', 'reason': 'status {}'.format(status)}
+            items.append({op: result})
+        self.reply(200, {'took': 1, 'errors': any(s >= 300 for s in statuses), 'items': items})
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubElasticsearch)
+    server.bodies = []
+    server.responses = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def persistence(stub, **settings):
+    return ElasticSearchPersistence(Settings(dict({
+        'ELASTICSEARCH_SERVER': '127.0.0.1',
+        'ELASTICSEARCH_PORT': stub.server_address[1],
+        'ELASTICSEARCH_INDEX_PREFIX': 'test',
+        'PERSISTENCE_BATCH_INTERVAL': 3600,
+    }, **settings)))
+
+
+def seen(i):
+    return SeenItem(1, 'http://a.unlp.edu.ar/{}'.format(i), 200, 'hash', None, None)
+
+
+def urls(lines):
+    return [json.loads(source)['url'] for source in lines[1::2]]
+
+
+def test_bulk_bodies_split_by_batch_size(stub):
+    p = persistence(stub, PERSISTENCE_BATCH_SIZE=3)
+    for i in range(7):
+        p.save(seen(i))
+    p.close()
+    assert [len(lines) for lines in stub.bodies] == [6, 6, 2]
+    assert [urls(lines) for lines in stub.bodies] == [
+        ['http://a.unlp.edu.ar/{}'.format(i) for i in range(0, 3)],
+        ['http://a.unlp.edu.ar/{}'.format(i) for i in range(3, 6)],
+        ['http://a.unlp.edu.ar/6'],
+    ]
+    assert json.loads(stub.bodies[0][0]) == {'index': {'_index': 'test-seen', '_type': 'seen'}}
+
+
+def test_bulk_bodies_split_by_bytes(stub):
+    p = persistence(stub, PERSISTENCE_BATCH_SIZE=100, PERSISTENCE_BATCH_BYTES=1)
+    for i in range(3):
+        p.save(seen(i))
+    p.close()
+    assert [len(lines) for lines in stub.bodies] == [2, 2, 2]
+
+
+def test_rejected_documents_are_retried(stub):
+    stub.responses = [[200, 429, 400]]
+    p = persistence(stub, PERSISTENCE_BATCH_SIZE=100)
+    for i in range(3):
+        p.save(seen(i))
+    p.flush()
+    # el 429 vuelve al lote, el 400 se descarta y se cuenta
+    assert len(p.batch) == 1
+    assert p.errors == 1
+    p.flush()
+    assert urls(stub.bodies[1]) == ['http://a.unlp.edu.ar/1']
+    assert len(p.batch) == 0
+
+
+def test_transport_error_keeps_batch(stub):
+    stub.responses = [500]
+    p = persistence(stub, PERSISTENCE_BATCH_SIZE=100)
+    for i in range(2):
+        p.save(seen(i))
+    p.flush()
+    assert len(p.batch) == 2
+    p.close()
+    assert stub.bodies[0] == stub.bodies[1]
+    assert len(p.batch) == 0
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from unlp_crawler.extraction import LxmlExtractor, SelectorExtractor
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'forms.html')
+URL = 'http://www.unlp.edu.ar/inicio/index.html'
+
+
+@pytest.fixture
+def html():
+    with open(FIXTURE, encoding='utf-8') as f:
+        return f.read()
+
+
+def test_extractors_are_equivalent(html):
+    selector = SelectorExtractor().extract_text(html, URL)
+    lxml = LxmlExtractor().extract_text(html, URL)
+    assert set(selector['comments']) == set(lxml['comments'])
+    del selector['comments'], lxml['comments']
+    assert selector == lxml
+
+
+def test_form_attributes_are_strings(html):
+    for extractor in (SelectorExtractor(), LxmlExtractor()):
+        forms = [dict(f) for f in extractor.extract_text(html, URL)['forms']]
+        assert forms == [
+            {'action': '/buscar?q=1&p=2', 'method': 'get', 'accept-charset': 'UTF-8 ISO-8859-1', 'inputs': 'q'},
+            {'method': 'post', 'action': '/login', 'id': 'login', 'inputs': 'clave'},
+            {'action': 'vacio', 'enctype': 'multipart/form-data', 'data-x': '1<2', 'inputs': ''},
+        ]
@@ -0,0 +1,151 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = 60
+
+# Corre en otro proceso para poder matarlo con kill -9. El spider sigue los
+# links del sitio y cada item pasa por un pipeline lento (como
+# AnalysisPipeline) antes de anotarse en el archivo de salida, que hace de
+# persistencia con PERSISTENCE_BATCH_SIZE = 1.
+CRAWL = """
+import json, sys
+
+import scrapy
+from scrapy.crawler import CrawlerProcess
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+base, jobdir, output = sys.argv[1:4]
+
+
+class SlowPipeline:
+
+    def process_item(self, item, spider):
+        return deferLater(reactor, 0.3, lambda: item)
+
+
+class SavePipeline:
+
+    def open_spider(self, spider):
+        self.file = open(output, 'a')
+
+    def close_spider(self, spider):
+        self.file.close()
+
+    def process_item(self, item, spider):
+        self.file.write(item['url'] + '\\n')
+        self.file.flush()
+        return item
+
+
+class Spider(scrapy.Spider):
+    name = 'frontier'
+    start_urls = [base + '/0']
+
+    def parse(self, response):
+        yield {'url': response.url}
+        for href in response.css('a::attr(href)').getall():
+            yield response.follow(href)
+
+
+process = CrawlerProcess({
+    'JOBDIR': jobdir,
+    'SCHEDULER': 'unlp_crawler.frontier.FrontierScheduler',
+    'DUPEFILTER_CLASS': 'unlp_crawler.frontier.FrontierDupeFilter',
+    'SCHEDULER_DISK_QUEUE': 'unlp_crawler.frontier.PickleFifoSqliteQueue',
+    'SCHEDULER_PRIORITY_QUEUE': 'unlp_crawler.frontier.HeapDownloaderAwarePriorityQueue',
+    'SPIDER_MIDDLEWARES': {'unlp_crawler.frontier.FrontierSpiderMiddleware': 10},
+    'DOWNLOADER_MIDDLEWARES': {'unlp_crawler.frontier.FrontierDownloaderMiddleware': 50},
+    'ITEM_PIPELINES': {'__main__.SlowPipeline': 100, '__main__.SavePipeline': 200},
+    'FRONTIER_BLOOM_CAPACITY': 1000,
+    'RETRY_ENABLED': False,
+    'TELNETCONSOLE_ENABLED': False,
+    'LOG_LEVEL': 'WARNING',
+})
+crawler = process.create_crawler(Spider)
+process.crawl(crawler)
+process.start()
+print(json.dumps(crawler.stats.get_stats(), default=str))
+"""
+
+
+class SlowSite(BaseHTTPRequestHandler):
+    # /n enlaza a /2n+1 y /2n+2; /7 da 404 y /9 corta la conexion
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        n = int(self.path.strip('/'))
+        time.sleep(0.2)
+        if n == 9:
+            self.connection.close()
+            return
+        links = ''.join('<a href="/{0}">{0}</a>'.format(m) for m in (2 * n + 1, 2 * n + 2) if m < PAGES)
+        body = '<html><body>{}</body></html>'.format(links).encode()
+        self.send_response(404 if n == 7 else 200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowSite)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def start_crawl(site, tmp_path):
+    return subprocess.Popen([sys.executable, '-c', CRAWL, site, str(tmp_path / 'job'), str(tmp_path / 'saved')],
+        stdout=subprocess.PIPE, text=True, env=dict(os.environ, PYTHONPATH=ROOT))
+
+
+def reachable(site):
+    # las paginas que generan item: 7 da 404 y 9 no responde, asi que
+    # tampoco se llega a sus hijos
+    pages, pending = set(), [0]
+    while pending:
+        n = pending.pop()
+        if n >= PAGES or n in (7, 9):
+            continue
+        pages.add(site + '/{}'.format(n))
+        pending += [2 * n + 1, 2 * n + 2]
+    return pages
+
+
+def saved(tmp_path):
+    path = tmp_path / 'saved'
+    return path.read_text().split() if path.exists() else []
+
+
+def test_killed_crawl_resumes_in_progress_requests(site, tmp_path):
+    expected = reachable(site)
+    for kill_after in (5, 20):
+        crawl = start_crawl(site, tmp_path)
+        deadline = time.monotonic() + 60
+        while len(saved(tmp_path)) < kill_after:
+            assert crawl.poll() is None and time.monotonic() < deadline
+            time.sleep(0.05)
+        os.kill(crawl.pid, signal.SIGKILL)
+        crawl.wait()
+        assert set(saved(tmp_path)) < expected
+    crawl = start_crawl(site, tmp_path)
+    stdout, _ = crawl.communicate(timeout=120)
+    assert crawl.returncode == 0
+    stats = json.loads(stdout.strip().splitlines()[-1])
+    assert set(saved(tmp_path)) == expected
+    assert stats['finish_reason'] == 'finished'
+    assert stats['frontier/requeued_in_progress'] > 0
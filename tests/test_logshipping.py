@@ -0,0 +1,166 @@
+import json
+import logging
+import socket
+import socketserver
+import threading
+import time
+from logging.handlers import QueueHandler
+
+import pytest
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from unlp_crawler.logshipping import (DropOldestBuffer, LogShipper, LogShippingExtension,
+    LogstashFormatter)
+
+
+class StubLogstash(socketserver.ThreadingTCPServer):
+    # Input tcp de Logstash: junta las lineas recibidas. stop() cierra
+    # tambien las conexiones abiertas, como un Logstash que se reinicia.
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), StubLogstashHandler)
+        self.lines = []
+        self.connections = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+
+class StubLogstashHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        for line in self.rfile:
+            self.server.lines.append(line.decode('utf-8'))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timeout')
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def stub():
+    server = StubLogstash()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def log():
+    buffer = DropOldestBuffer(100)
+    handler = QueueHandler(buffer)
+    handler.setFormatter(LogstashFormatter('test'))
+    logger = logging.getLogger('test.logshipping')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    yield logger, buffer
+    logger.removeHandler(handler)
+    logger.propagate = True
+
+
+def messages(lines):
+    return [json.loads(line)['message'] for line in lines]
+
+
+def test_json_lines_on_the_wire(stub, log):
+    logger, buffer = log
+    shipper = LogShipper(buffer, '127.0.0.1', stub.port, interval=0.05)
+    shipper.start()
+    logger.info('uno')
+    logger.warning('dos %s', 'tres')
+    shipper.stop()
+    wait_for(lambda: len(stub.lines) == 2)
+    assert all(line.endswith('\n') for line in stub.lines)
+    assert messages(stub.lines) == ['uno', 'dos tres']
+    first = json.loads(stub.lines[0])
+    assert first['@version'] == '1'
+    assert first['type'] == 'test'
+    assert first['level'] == 'INFO'
+    assert first['logger_name'] == 'test.logshipping'
+    assert shipper.sent == 2
+    assert shipper.dropped == 0
+
+
+def test_full_buffer_drops_oldest():
+    buffer = DropOldestBuffer(3)
+    for i in range(5):
+        buffer.put_nowait(i)
+    assert buffer.dropped == 2
+    assert buffer.get_batch(10, 0) == [2, 3, 4]
+
+
+def test_unreachable_logstash_counts_dropped(log):
+    logger, _ = log
+    buffer = DropOldestBuffer(3)
+    logger.handlers[0].queue = buffer
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    shipper = LogShipper(buffer, '127.0.0.1', port, interval=0.05, reconnect_delay=60)
+    for i in range(5):
+        logger.info('registro %d', i)
+    shipper.start()
+    shipper.stop()
+    assert shipper.sent == 0
+    assert buffer.dropped == 2
+    assert shipper.dropped == 5
+
+
+def test_reconnects_after_restart(stub, log):
+    logger, buffer = log
+    port = stub.port
+    shipper = LogShipper(buffer, '127.0.0.1', port, interval=0.05, reconnect_delay=0.05)
+    shipper.start()
+    logger.info('antes')
+    wait_for(lambda: stub.lines)
+    stub.stop()
+    restarted = StubLogstash(port)
+    try:
+        logger.info('despues')
+        wait_for(lambda: restarted.lines)
+        shipper.stop()
+        assert messages(stub.lines) == ['antes']
+        assert messages(restarted.lines) == ['despues']
+        assert shipper.dropped == 0
+    finally:
+        restarted.stop()
+
+
+def test_stats_set_before_spider_close_dump(stub):
+    stats = MemoryStatsCollector(get_crawler())
+    extension = LogShippingExtension(Settings({
+        'LOGSTASH_HOST': '127.0.0.1',
+        'LOGSTASH_PORT': stub.port,
+        'LOGSTASH_FLUSH_INTERVAL': 0.05,
+        'LOGSTASH_LOGGERS': {},
+    }), stats)
+    try:
+        logging.getLogger('test.extension').warning('hola')
+        wait_for(lambda: extension.shipper.sent)
+        extension.spider_closed(None)
+        assert stats.get_value('logstash/sent') >= 1
+        assert stats.get_value('logstash/dropped') == 0
+    finally:
+        extension.engine_stopped()
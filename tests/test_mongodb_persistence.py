@@ -0,0 +1,126 @@
+import logging
+
+import pytest
+from pymongo import ReplaceOne
+from pymongo.errors import AutoReconnect
+from scrapy.settings import Settings
+
+from unlp_crawler.items import Certificate, Page, PageItem, SeenItem
+from unlp_crawler.persistence.types import MongoDBPersistence
+
+
+class StubCollection:
+    # guarda lo insertado; `failures` es la cantidad de llamadas que fallan
+    # con un error de conexion
+
+    def __init__(self):
+        self.docs = []
+        self.requests = []
+        self.failures = 0
+
+    def fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('stub')
+
+    def insert_many(self, docs, ordered=True):
+        self.fail()
+        self.docs.extend(docs)
+
+    def bulk_write(self, requests, ordered=True):
+        self.fail()
+        self.requests.extend(requests)
+
+
+class StubClient:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class StubDatabase(dict):
+
+    def __missing__(self, name):
+        collection = self[name] = StubCollection()
+        return collection
+
+
+@pytest.fixture
+def mongo():
+    persistence = MongoDBPersistence(Settings({
+        'MONGO_SERVER': 'localhost',
+        'MONGO_PORT': 27017,
+        'MONGO_DATABASE': 'test',
+        'PERSISTENCE_BATCH_SIZE': 100,
+        'PERSISTENCE_BATCH_INTERVAL': 3600,
+    }))
+    persistence.client = StubClient()
+    persistence.db = StubDatabase()
+    return persistence
+
+
+def certificate(cert_hash):
+    return Certificate(1, 'a.unlp.edu.ar', 443, 'pem', 'issuer', cert_hash)
+
+
+def page_item(i, cert=None):
+    page = Page(1, 'https://a.unlp.edu.ar/{}'.format(i), 'texto', (), 200, '127.0.0.1', 'a.unlp.edu.ar')
+    return PageItem(page, cert, str(i))
+
+
+def cert_hashes(collection):
+    hashes = []
+    for request in collection.requests:
+        for cert_hash in ('aa', 'bb'):
+            if request == ReplaceOne({'certificate_hash': cert_hash}, certificate(cert_hash).to_dict(), upsert=True):
+                hashes.append(cert_hash)
+    return hashes
+
+
+def test_certificates_written_once(mongo):
+    mongo.save(page_item(1, certificate('aa')))
+    mongo.save(page_item(2, certificate('aa')))
+    mongo.flush()
+    # otro host con el mismo certificado, despues de escrito
+    mongo.save(page_item(3, certificate('aa')))
+    mongo.save(page_item(4, certificate('bb')))
+    mongo.flush()
+    assert cert_hashes(mongo.db[mongo.COLLECTION_CERT]) == ['aa', 'bb']
+    assert mongo.written_certs == {'aa', 'bb'}
+    assert len(mongo.db[mongo.COLLECTION_PAGE].docs) == 4
+
+
+def test_connection_error_keeps_documents(mongo):
+    mongo.db[mongo.COLLECTION_PAGE].failures = 1
+    mongo.db[mongo.COLLECTION_CERT].failures = 1
+    mongo.save(page_item(1, certificate('aa')))
+    mongo.save(SeenItem(1, 'https://a.unlp.edu.ar/2', 200, 'hash', None, None))
+    mongo.flush()
+    assert len(mongo.batch) == 1
+    assert list(mongo.certs) == ['aa']
+    assert mongo.written_certs == set()
+    assert len(mongo.db[mongo.COLLECTION_SEEN].docs) == 1
+    mongo.flush()
+    assert len(mongo.batch) == 0
+    assert not mongo.certs
+    assert [d['page_id'] for d in mongo.db[mongo.COLLECTION_PAGE].docs] == ['1']
+    assert cert_hashes(mongo.db[mongo.COLLECTION_CERT]) == ['aa']
+
+
+def test_close_flushes(mongo):
+    mongo.save(page_item(1, certificate('aa')))
+    mongo.close()
+    assert len(mongo.db[mongo.COLLECTION_PAGE].docs) == 1
+    assert cert_hashes(mongo.db[mongo.COLLECTION_CERT]) == ['aa']
+    assert mongo.client.closed
+
+
+def test_close_logs_what_is_dropped(mongo, caplog):
+    mongo.db[mongo.COLLECTION_PAGE].failures = 1
+    mongo.db[mongo.COLLECTION_CERT].failures = 1
+    mongo.save(page_item(1, certificate('aa')))
+    with caplog.at_level(logging.ERROR):
+        mongo.close()
+    assert 'Se descartan 1 documentos y 1 certificados' in caplog.text
+    assert mongo.client.closed
@@ -0,0 +1,35 @@
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from unlp_crawler.nearduplicates import NearDuplicateIndex
+
+
+def test_finds_near_duplicate():
+    index = NearDuplicateIndex(distance=3)
+    assert index.check('http://a.unlp.edu.ar/1', 0xffff0000ffff0000) is None
+    assert index.check('http://a.unlp.edu.ar/2', 0xffff0000ffff0007) == 'http://a.unlp.edu.ar/1'
+    assert index.check('http://a.unlp.edu.ar/3', 0xffff0000ffff000f) is None
+    assert len(index) == 2
+
+
+def test_size_is_capped():
+    stats = MemoryStatsCollector(get_crawler())
+    index = NearDuplicateIndex(distance=3, stats=stats, max_pages=3)
+    for i in range(10):
+        index.check('http://a.unlp.edu.ar/{}'.format(i), i << 48 | i << 32 | i << 16 | i)
+    assert len(index) == 3
+    assert sum(len(ids) for bucket in index.buckets for ids in bucket.values()) == 3 * index.bands
+    assert stats.get_value('neardup/index_size') == 3
+    assert stats.get_value('neardup/evicted') == 7
+    # las primeras se olvidaron
+    assert index.check('http://a.unlp.edu.ar/x', 0) is None
+
+
+def test_match_keeps_page_in_index():
+    index = NearDuplicateIndex(distance=3, max_pages=2)
+    index.check('http://a.unlp.edu.ar/1', 0xff)
+    index.check('http://a.unlp.edu.ar/2', 0xff << 32)
+    # el 1 aparece de nuevo y pasa a ser el mas reciente
+    assert index.check('http://a.unlp.edu.ar/1b', 0xfe) == 'http://a.unlp.edu.ar/1'
+    index.check('http://a.unlp.edu.ar/3', 0xff << 48)
+    assert [url for url, _ in index.pages.values()] == ['http://a.unlp.edu.ar/1', 'http://a.unlp.edu.ar/3']
@@ -0,0 +1,22 @@
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from unlp_crawler.persistence.worker import PersistenceWorker
+
+
+def test_queue_depth_ignores_end_marker():
+    stats = MemoryStatsCollector(get_crawler())
+    worker = PersistenceWorker(None, stats, queue_size=2)
+    for i in range(3):
+        worker.put(i)
+    assert stats.get_value('persistence/queue_depth') == 3
+    worker.close()
+    assert stats.get_value('persistence/queue_depth') == 3
+    # el hilo toma los items de a uno; la marca de fin queda ultima
+    for expected in (2, 1, 0):
+        item, _ = worker.queue.get_nowait()
+        worker.feed()
+        assert stats.get_value('persistence/queue_depth') == expected
+    assert worker.queue.get_nowait() is None
+    worker.feed()
+    assert stats.get_value('persistence/queue_depth') == 0
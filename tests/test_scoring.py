@@ -0,0 +1,49 @@
+from scrapy.http import HtmlResponse, Request
+
+from unlp_crawler.scoring import LinkScorer
+
+
+def response(url='http://a.unlp.edu.ar/', depth=0, body=b'<html></html>'):
+    return HtmlResponse(url, body=body, request=Request(url, meta={'depth': depth}))
+
+
+def test_scores_fall_in_few_buckets():
+    scorer = LinkScorer(buckets=8)
+    priorities = set()
+    for depth in range(20):
+        parent = response(depth=depth, body=b'<form>' if depth % 2 else b'')
+        for i in range(50):
+            url = 'http://h{}.unlp.edu.ar/s{}/p/{}'.format(i % 7, i % 5, depth * 50 + i)
+            priorities.add(scorer.score(Request(url), parent))
+    assert len(priorities) > 1
+    assert len(priorities) <= 8
+    assert all(scorer.min_priority <= p <= scorer.max_priority for p in priorities)
+
+
+def test_quantize_keeps_order():
+    scorer = LinkScorer(buckets=8)
+    quantized = [scorer.quantize(p) for p in range(-100, 150)]
+    assert quantized == sorted(quantized)
+    assert len(set(quantized)) == 8
+
+
+def test_memory_is_bounded():
+    scorer = LinkScorer(memory=10)
+    parent = response()
+    for i in range(100):
+        scorer.score(Request('http://h{0}.unlp.edu.ar/s{0}/{0}'.format(i)), parent)
+    for entries in (scorer.hosts, scorer.sections, scorer.patterns, scorer.urls):
+        assert len(entries) == 10
+
+
+def test_repeated_link_does_not_count_as_pattern():
+    scorer = LinkScorer()
+    parent = response()
+    for _ in range(20):
+        features = scorer.features(Request('http://a.unlp.edu.ar/noticias/1'), parent)
+    assert features['pattern'] == 0
+    assert scorer.patterns[('a.unlp.edu.ar', '/noticias/{n}')] == 1
+    for i in range(2, 5):
+        features = scorer.features(Request('http://a.unlp.edu.ar/noticias/{}'.format(i)), parent)
+    # tres urls distintas antes que esta
+    assert features['pattern'] == 2
@@ -0,0 +1,122 @@
+import sqlite3
+import time
+
+import pytest
+from scrapy.settings import Settings
+from sqlalchemy import create_engine
+
+from unlp_crawler.items import SeenItem
+from unlp_crawler.persistence.types import SQLitePersistence
+
+
+def seen(url):
+    return SeenItem(1, url, 200, 'hash', None, None)
+
+
+def count(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute('select count(*) from seen').fetchone()[0]
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'crawl.db')
+    persistence = SQLitePersistence(Settings({'SQLITE_DB': path}))
+    yield path, persistence
+    persistence.engine.dispose()
+
+
+def test_invalid_row_drops_only_that_item(db):
+    path, persistence = db
+    items = [seen('http://a.unlp.edu.ar/%d' % i) for i in range(5)]
+    # sqlite no puede guardar un object: falla solo esta fila
+    items[2] = seen(object())
+    for item in items:
+        persistence.save(item)
+    persistence.flush()
+    assert count(path) == 4
+    assert len(persistence.batch) == 0
+
+
+def test_locked_database_keeps_batch(db):
+    path, persistence = db
+    persistence.engine = create_engine('sqlite:///' + path, connect_args={'timeout': 0.1})
+    lock = sqlite3.connect(path, timeout=0)
+    lock.execute('begin exclusive')
+    persistence.save(seen('http://a.unlp.edu.ar/'))
+    persistence.flush()
+    assert len(persistence.batch) == 1
+    lock.rollback()
+    lock.close()
+    persistence.flush()
+    assert len(persistence.batch) == 0
+    assert count(path) == 1
+
+
+
+def test_locked_database_caps_pending_and_waits(tmp_path):
+    path = str(tmp_path / 'crawl.db')
+    persistence = SQLitePersistence(Settings({'SQLITE_DB': path, 'PERSISTENCE_BATCH_SIZE': 2,
+        'PERSISTENCE_MAX_PENDING': 3}))
+    persistence.engine = create_engine('sqlite:///' + path, connect_args={'timeout': 0.1})
+    lock = sqlite3.connect(path, timeout=0)
+    lock.execute('begin exclusive')
+    for i in range(5):
+        persistence.save(seen('http://a.unlp.edu.ar/%d' % i))
+    # fallo el primer lote: los saves siguientes no reintentan hasta pasado
+    # el intervalo y pasado max_pending se descartan los mas viejos
+    assert persistence.retry_at > time.monotonic()
+    assert len(persistence.batch) == 5
+    persistence.flush()
+    assert [item.url for item in persistence.batch.ops] == [
+        'http://a.unlp.edu.ar/%d' % i for i in range(2, 5)]
+    lock.rollback()
+    lock.close()
+    persistence.close()
+    assert count(path) == 3
+
+
+def test_indexes_added_to_existing_database(tmp_path):
+    path = str(tmp_path / 'crawl.db')
+    SQLitePersistence(Settings({'SQLITE_DB': path})).engine.dispose()
+    with sqlite3.connect(path) as conn:
+        conn.execute('drop index ix_domain_name')
+        conn.execute('drop index ix_certificate_certificate_hash')
+    SQLitePersistence(Settings({'SQLITE_DB': path})).engine.dispose()
+    with sqlite3.connect(path) as conn:
+        indexes = {row[0] for row in conn.execute("select name from sqlite_master where type = 'index'")}
+    assert {'ix_domain_name', 'ix_certificate_certificate_hash'} <= indexes
+
+def test_unthreaded_pipeline_flushes_due_batch(tmp_path, monkeypatch):
+    from twisted.internet import task
+
+    from unlp_crawler import pipelines
+
+    clock = task.Clock()
+
+    class LoopingCall(task.LoopingCall):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.clock = clock
+
+    monkeypatch.setattr(pipelines.task, 'LoopingCall', LoopingCall)
+    path = str(tmp_path / 'crawl.db')
+    pipeline = pipelines.PersistencePipeline(Settings({
+        'PERSISTENCE_TYPE': 'sqlite',
+        'SQLITE_DB': path,
+        'PERSISTENCE_THREADED': False,
+        'PERSISTENCE_BATCH_SIZE': 100,
+        'PERSISTENCE_BATCH_INTERVAL': 0.05,
+    }))
+    pipeline.open_spider(None)
+    pipeline.process_item(seen('http://a.unlp.edu.ar/1'), None)
+    assert len(pipeline.persistence.batch) == 1
+    time.sleep(0.1)
+    # sin items nuevos el lote vencido sale igual
+    clock.advance(pipeline.FLUSH_CHECK_INTERVAL)
+    assert len(pipeline.persistence.batch) == 0
+    assert count(path) == 1
+    pipeline.close_spider(None)
+    assert not pipeline.flush_loop.running
+    pipeline.persistence.engine.dispose()
@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python.failure import Failure
+
+from .extraction import EXTRACTORS, md5
+from .items import SeenItem, header
+from .nearduplicates import simhash
+
+
+# Analisis de una pagina sin objetos de scrapy (texto, url y encoding), para
+# poder correrlo en otro proceso o hilo.
+
+def analyze_page(backend, url, text, encoding, previous_body_hash=None, fingerprint=False):
+    # (body_hash, simhash si se pidio, datos extraidos)
+    body_hash = md5(text)
+    # modo incremental: la pagina no cambio desde la corrida anterior
+    if body_hash == previous_body_hash:
+        return body_hash, None, None
+    return (body_hash, simhash(text) if fingerprint else None,
+        EXTRACTORS[backend]().extract_text(text, url, encoding))
+
+
+def analyze_pages(backend, pages):
+    return [analyze_page(backend, *page) for page in pages]
+
+
+def seen_item(url, status, headers, ts, body_hash):
+    return SeenItem(ts, url, status, body_hash, header(headers, 'Etag'), header(headers, 'Last-Modified'))
+
+
+def analyze_each(backend, pages):
+    # pagina por pagina, para que un error afecte solo a su item
+    results = []
+    for page in pages:
+        try:
+            results.append(analyze_page(backend, *page))
+        except Exception:
+            results.append(Failure())
+    return results
+
+
+def mark_duplicate(page, body_hash, canonical):
+    # casi igual a una pagina ya guardada: se guarda solo la referencia
+    page.body_hash = body_hash
+    page.duplicate_of = canonical
+    page.text = None
+    return page
+
+
+def fill_page(page, body_hash, data):
+    page.body_hash = body_hash
+    page.title = data['title']
+    page.js = data['js']
+    page.css = data['css']
+    page.forms = data['forms']
+    page.comments = data['comments']
+    page.links = data['links']
+    return page
+
+
+class InlineExecutor:
+    # en el hilo del reactor, como antes
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls()
+
+    def run(self, backend, pages):
+        try:
+            return succeed(analyze_pages(backend, pages))
+        except Exception:
+            return fail()
+
+    def close(self):
+        pass
+
+
+class ThreadExecutor(InlineExecutor):
+    # threadpool del reactor (REACTOR_THREADPOOL_MAXSIZE). lxml libera el GIL
+    # mientras parsea, el resto del analisis no
+
+    def run(self, backend, pages):
+        return threads.deferToThread(analyze_pages, backend, pages)
+
+
+class ProcessExecutor:
+    # ProcessPoolExecutor con procesos "spawn": un fork del proceso de scrapy
+    # copiaria el reactor y los hilos de persistencia a mitad de trabajo
+
+    def __init__(self, workers=None):
+        self.pool = ProcessPoolExecutor(workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn'))
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('ANALYSIS_WORKERS') or None)
+
+    def run(self, backend, pages):
+        d = Deferred()
+        try:
+            future = self.pool.submit(analyze_pages, backend, pages)
+        except (BrokenProcessPool, RuntimeError):
+            return fail()
+        future.add_done_callback(lambda f: reactor.callFromThread(self.done, f, d))
+        return d
+
+    def done(self, future, d):
+        try:
+            result = future.result()
+        except Exception:
+            d.errback()
+            return
+        d.callback(result)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+ANALYSIS_EXECUTORS = {
+    'inline': InlineExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
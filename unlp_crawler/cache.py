@@ -0,0 +1,75 @@
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
+
+
+# md5 del recurso, validadores HTTP y si ya fue validado en esta corrida
+Asset = namedtuple('Asset', ['md5', 'etag', 'last_modified', 'fresh'])
+
+
+class AssetHashCache:
+    # Cache url -> md5 de los css/js descargados. En memoria es un LRU
+    # acotado a ASSET_CACHE_SIZE entradas; si ASSET_CACHE_DB esta definido se
+    # respalda en SQLite para reutilizarlo entre corridas. Las entradas
+    # leidas del disco se devuelven con fresh=False: hay que revalidarlas con
+    # un request condicional (ETag / Last-Modified) antes de usarlas.
+
+    COMMIT_EVERY = 100
+
+    def __init__(self, path=None, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.pending_writes = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS asset ('
+                'url TEXT PRIMARY KEY, md5 TEXT, etag TEXT, last_modified TEXT, updated INTEGER)')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(settings.get('ASSET_CACHE_DB'), settings.getint('ASSET_CACHE_SIZE', 10000))
+
+    def get(self, url):
+        asset = self.entries.get(url)
+        if asset is not None:
+            self.entries.move_to_end(url)
+            return asset
+        if self.db is None:
+            return None
+        row = self.db.execute('SELECT md5, etag, last_modified FROM asset WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        asset = Asset(row[0], row[1], row[2], False)
+        self._remember(url, asset)
+        return asset
+
+    def set(self, url, md5, etag=None, last_modified=None):
+        self._remember(url, Asset(md5, etag, last_modified, True))
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO asset VALUES (?, ?, ?, ?, ?)',
+                (url, md5, etag, last_modified, int(time.time())))
+            self.pending_writes += 1
+            if self.pending_writes >= self.COMMIT_EVERY:
+                self.db.commit()
+                self.pending_writes = 0
+
+    def touch(self, url):
+        asset = self.get(url)
+        if asset is not None:
+            self._remember(url, asset._replace(fresh=True))
+        return asset
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def _remember(self, url, asset):
+        self.entries[url] = asset
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,62 @@
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def origin(url):
+    # (scheme, host, port) con el puerto por defecto explicito
+    u = urlsplit(url)
+    scheme = u.scheme.lower()
+    return scheme, (u.hostname or '').lower(), u.port or DEFAULT_PORTS.get(scheme)
+
+
+def unwww(host):
+    return host[4:] if host.startswith('www.') else host
+
+
+class OriginMap:
+    # Alias de origen aprendidos durante el crawl: http -> https, www ->
+    # sin www (o al reves) y cambios de puerto. Un alias solo se aprende si
+    # el destino es el mismo sitio (mismo host salvo el "www.") y la misma
+    # ruta, asi un redirect a una pagina de login o a otro sitio no colapsa
+    # el host entero.
+
+    def __init__(self):
+        self.aliases = {}
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def canonical(self, o):
+        seen = set()
+        while o in self.aliases and o not in seen:
+            seen.add(o)
+            o = self.aliases[o]
+        return o
+
+    def learn(self, src_url, dst_url):
+        # redirect de src_url a dst_url: solo cuenta si mantiene la ruta
+        s, d = urlsplit(src_url), urlsplit(dst_url)
+        if (s.path or '/') != (d.path or '/') or s.query != d.query:
+            return False
+        return self.alias(origin(src_url), origin(dst_url))
+
+    def alias(self, src, dst):
+        if src == dst or unwww(src[1]) != unwww(dst[1]) or dst[0] not in DEFAULT_PORTS:
+            return False
+        dst = self.canonical(dst)
+        # no se aprenden ciclos ni se pisa un alias ya conocido
+        if src in self.aliases or dst == src:
+            return False
+        self.aliases[src] = dst
+        return True
+
+    def rewrite(self, url):
+        o = origin(url)
+        target = self.canonical(o)
+        if target == o:
+            return url
+        scheme, host, port = target
+        netloc = host if port == DEFAULT_PORTS.get(scheme) else '{}:{}'.format(host, port)
+        u = urlsplit(url)
+        return urlunsplit((scheme, netloc, u.path, u.query, u.fragment))
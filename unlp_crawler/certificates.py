@@ -0,0 +1,49 @@
+import sys
+
+from scrapy import signals
+
+from .canonical import origin
+from .items import Certificate
+
+
+class CertificateTracker:
+    # Certificado visto por (hostname, puerto). Las paginas guardan solo el
+    # hash; el registro completo (PEM, issuer) se arma y se persiste la
+    # primera vez que aparece el certificado en ese host y puerto, o cuando
+    # el host cambia de certificado.
+
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.digests = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # el spider se crea antes que crawler.stats
+        tracker = cls()
+        crawler.signals.connect(tracker.spider_opened, signal=signals.spider_opened)
+        return tracker
+
+    def spider_opened(self, spider):
+        self.stats = spider.crawler.stats
+
+    def __len__(self):
+        return len(self.digests)
+
+    def track(self, url, certificate, ts):
+        # (certificate_hash, Certificate o None si ya se habia emitido)
+        if not certificate:
+            return '', None
+        cert_hash = certificate.digest().decode().replace(':', '').lower()
+        _, hostname, port = origin(url)
+        previous = self.digests.get((hostname, port))
+        if previous == cert_hash:
+            return cert_hash, None
+        self.digests[(hostname, port)] = cert_hash
+        if self.stats is not None:
+            self.stats.inc_value('certificates/changed' if previous else 'certificates/new')
+        return cert_hash, Certificate(ts, sys.intern(hostname), port,
+            str(certificate.dumpPEM()), str(certificate.inspect()), cert_hash)
+
+    def forget(self, url):
+        _, hostname, port = origin(url)
+        self.digests.pop((hostname, port), None)
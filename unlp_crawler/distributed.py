@@ -0,0 +1,306 @@
+import hashlib
+import logging
+import pickle
+import sqlite3
+from urllib.parse import urlsplit
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.http import Request
+from scrapy.utils.request import request_from_dict
+from twisted.internet import task
+
+from .canonical import unwww
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+# Modo distribuido: varios procesos `scrapy crawl unlp` (en una o varias
+# maquinas) reparten los hosts por hash. Cada worker crawlea solo sus hosts,
+# con su propio scheduler (y su propio JOBDIR), asi la politica por host se
+# mantiene. Los requests a hosts de otro worker se le pasan por el
+# coordinador, que ademas guarda los fingerprints de lo ya pasado para no
+# reenviar el mismo link una y otra vez. Como cada host tiene un solo dueno,
+# el dupefilter local de cada worker alcanza para sus propios hosts:
+#
+#   scrapy crawl unlp -s DISTRIBUTED_ENABLED=1 -s DISTRIBUTED_WORKERS=4 \
+#       -s DISTRIBUTED_WORKER_INDEX=0 -s DISTRIBUTED_RUN_ID=2024-05-01 \
+#       -s JOBDIR=crawls/unlp-0
+#
+# Todos los workers tienen que arrancar juntos y con el mismo
+# DISTRIBUTED_RUN_ID: el estado del coordinador (fingerprints, requests
+# pasados, workers ociosos) es por corrida. Repetir el id (con los mismos
+# JOBDIR) reanuda la corrida; uno nuevo empieza de cero y el coordinador
+# SQLite borra lo de las corridas anteriores. El crawl termina cuando todos
+# los workers estan ociosos y no quedan requests pasados sin tomar.
+
+
+def worker_for(url, workers):
+    # www.x y x caen en el mismo worker, asi los alias de CanonicalOriginMiddleware
+    # se aprenden donde se usan
+    host = unwww((urlsplit(url).hostname or '').lower())
+    return int(hashlib.md5(host.encode('utf-8')).hexdigest(), 16) % workers
+
+
+class SQLiteCoordinator:
+    # Coordinador para varios procesos en una misma maquina. SQLite serializa
+    # las escrituras con su lock de archivo: los links de cada respuesta se
+    # filtran y se encolan en una sola transaccion, y pop() toma los
+    # requests y marca al worker como activo en la misma transaccion.
+
+    def __init__(self, path, workers, run):
+        self.workers = workers
+        self.run = run
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS fingerprint (run TEXT, fp BLOB, PRIMARY KEY (run, fp)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS request (id INTEGER PRIMARY KEY, run TEXT, worker INTEGER, data BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS request_worker ON request (run, worker, id)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS worker (run TEXT, idx INTEGER, idle INTEGER, PRIMARY KEY (run, idx))')
+        self.transaction(self.clear_other_runs)
+
+    def clear_other_runs(self):
+        # lo de otras corridas (workers ociosos, fingerprints ya pasados,
+        # requests sin tomar) no se vuelve a usar
+        for table in ('fingerprint', 'request', 'worker'):
+            self.db.execute('DELETE FROM {} WHERE run != ?'.format(table), (self.run,))
+
+    def transaction(self, func):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            result = func()
+        except sqlite3.Error:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+        return result
+
+    def push(self, requests):
+        # requests: (worker, fingerprint, data); fingerprint None = no filtrar.
+        # Devuelve cuantos se encolaron
+        def push():
+            new = [(self.run, worker, data) for worker, fp, data in requests if fp is None
+                or self.db.execute('INSERT OR IGNORE INTO fingerprint VALUES (?, ?)', (self.run, fp)).rowcount]
+            self.db.executemany('INSERT INTO request (run, worker, data) VALUES (?, ?, ?)', new)
+            return len(new)
+        return self.transaction(push)
+
+    def pop(self, worker, count):
+        def pop():
+            rows = self.db.execute('SELECT id, data FROM request WHERE run = ? AND worker = ? ORDER BY id LIMIT ?',
+                (self.run, worker, count)).fetchall()
+            if rows:
+                self.db.execute('DELETE FROM request WHERE run = ? AND worker = ? AND id <= ?',
+                    (self.run, worker, rows[-1][0]))
+                self.db.execute('INSERT OR REPLACE INTO worker VALUES (?, ?, 0)', (self.run, worker))
+            return [data for _, data in rows]
+        return self.transaction(pop)
+
+    def set_idle(self, worker, idle):
+        self.db.execute('INSERT OR REPLACE INTO worker VALUES (?, ?, ?)', (self.run, worker, int(idle)))
+
+    def finished(self):
+        self.db.execute('BEGIN')
+        try:
+            idle = self.db.execute('SELECT COUNT(*) FROM worker WHERE run = ? AND idle = 1', (self.run,)).fetchone()[0]
+            pending = self.db.execute('SELECT 1 FROM request WHERE run = ? LIMIT 1', (self.run,)).fetchone()
+        finally:
+            self.db.execute('COMMIT')
+        return idle >= self.workers and pending is None
+
+    def close(self):
+        self.db.close()
+
+
+class RedisCoordinator:
+    # Coordinador sobre Redis (o cualquier servidor compatible) para workers
+    # en distintas maquinas. Requiere Redis >= 6.2 por LPOP con cantidad.
+    # Las claves llevan el id de la corrida (<prefijo>:<corrida>:...); las
+    # de corridas viejas se pueden borrar con redis-cli --scan.
+
+    def __init__(self, url, workers, run, prefix='unlp'):
+        if redis is None:
+            raise NotConfigured('DISTRIBUTED_BACKEND = "redis" requiere el paquete redis')
+        self.workers = workers
+        self.redis = redis.Redis.from_url(url)
+        prefix = '{}:{}'.format(prefix, run)
+        self.fingerprints = prefix + ':fingerprints'
+        self.idle = prefix + ':idle'
+        self.queue = prefix + ':requests:{}'
+        # toma requests y marca al worker activo de forma atomica
+        self.pop_script = self.redis.register_script(
+            "local items = redis.call('LPOP', KEYS[1], ARGV[1]) "
+            "if items then redis.call('HSET', KEYS[2], ARGV[2], 0) end "
+            "return items")
+
+    def push(self, requests):
+        pipe = self.redis.pipeline()
+        for worker, fp, data in requests:
+            if fp is not None:
+                pipe.sadd(self.fingerprints, fp)
+        added = iter(pipe.execute())
+        pipe = self.redis.pipeline()
+        count = 0
+        for worker, fp, data in requests:
+            if fp is None or next(added):
+                pipe.rpush(self.queue.format(worker), data)
+                count += 1
+        pipe.execute()
+        return count
+
+    def pop(self, worker, count):
+        return self.pop_script(keys=[self.queue.format(worker), self.idle], args=[count, worker]) or []
+
+    def set_idle(self, worker, idle):
+        self.redis.hset(self.idle, worker, int(idle))
+
+    def finished(self):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hvals(self.idle)
+        for worker in range(self.workers):
+            pipe.llen(self.queue.format(worker))
+        idle, *pending = pipe.execute()
+        return sum(int(v) for v in idle) >= self.workers and not any(pending)
+
+    def close(self):
+        self.redis.close()
+
+
+def coordinator_from_settings(settings):
+    workers = settings.getint('DISTRIBUTED_WORKERS', 1)
+    backend = settings.get('DISTRIBUTED_BACKEND', 'sqlite')
+    run = settings.get('DISTRIBUTED_RUN_ID')
+    if not run:
+        raise ValueError('El modo distribuido requiere DISTRIBUTED_RUN_ID (el mismo en todos los workers)')
+    if backend == 'redis':
+        return RedisCoordinator(settings.get('DISTRIBUTED_REDIS_URL', 'redis://localhost:6379/0'),
+            workers, run, settings.get('DISTRIBUTED_REDIS_PREFIX', 'unlp'))
+    if backend == 'sqlite':
+        return SQLiteCoordinator(settings.get('DISTRIBUTED_PATH', 'frontier.db'), workers, run)
+    raise NotConfigured('DISTRIBUTED_BACKEND desconocido: {}'.format(backend))
+
+
+class DistributedMiddleware:
+    # Middleware de spider: descarta los start requests de hosts ajenos (cada
+    # worker tiene la lista completa de dominios) y pasa al worker dueno los
+    # requests a hosts ajenos que no se le hayan pasado antes, en un solo
+    # lote por respuesta.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.workers = settings.getint('DISTRIBUTED_WORKERS', 1)
+        self.index = settings.getint('DISTRIBUTED_WORKER_INDEX', 0)
+        self.coordinator = coordinator_from_settings(settings)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('DISTRIBUTED_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_start_requests(self, start_requests, spider):
+        for r in start_requests:
+            if worker_for(r.url, self.workers) == self.index:
+                yield r
+            else:
+                self.stats.inc_value('distributed/start_skipped')
+
+    def process_spider_output(self, response, result, spider):
+        outgoing = []
+        for r in result:
+            if self.keep(r, outgoing, spider):
+                yield r
+        self.push(outgoing)
+
+    async def process_spider_output_async(self, response, result, spider):
+        outgoing = []
+        async for r in result:
+            if self.keep(r, outgoing, spider):
+                yield r
+        self.push(outgoing)
+
+    def keep(self, r, outgoing, spider):
+        if not isinstance(r, Request):
+            return True
+        worker = worker_for(r.url, self.workers)
+        if worker == self.index:
+            return True
+        # el coordinador filtra los ya pasados al encolar el lote de la respuesta
+        fp = None if r.dont_filter else self.crawler.request_fingerprinter.fingerprint(r)
+        outgoing.append((worker, fp, pickle.dumps(r.to_dict(spider=spider), protocol=4)))
+        return False
+
+    def push(self, outgoing):
+        if outgoing:
+            pushed = self.coordinator.push(outgoing)
+            self.stats.inc_value('distributed/pushed', pushed)
+            self.stats.inc_value('distributed/already_pushed', len(outgoing) - pushed)
+
+    def spider_closed(self, spider):
+        self.coordinator.close()
+
+
+class DistributedExtension:
+    # Trae cada DISTRIBUTED_POLL_INTERVAL segundos los requests que otros
+    # workers pasaron a este y los agenda. Mientras algun worker siga activo
+    # o queden requests pasados, el spider no se cierra al quedar ocioso.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.index = settings.getint('DISTRIBUTED_WORKER_INDEX', 0)
+        self.batch = settings.getint('DISTRIBUTED_BATCH', 100)
+        self.interval = settings.getfloat('DISTRIBUTED_POLL_INTERVAL', 1)
+        self.coordinator = coordinator_from_settings(settings)
+        self.spider = None
+        self.poll_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('DISTRIBUTED_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.coordinator.set_idle(self.index, False)
+        self.poll_task = task.LoopingCall(self.poll)
+        self.poll_task.start(self.interval, now=False)
+        spider.logger.info('Modo distribuido: worker %d de %d', self.index,
+            self.crawler.settings.getint('DISTRIBUTED_WORKERS', 1))
+
+    def poll(self):
+        received = self.coordinator.pop(self.index, self.batch)
+        for data in received:
+            self.crawler.engine.crawl(request_from_dict(pickle.loads(data), spider=self.spider))
+        if received:
+            self.stats.inc_value('distributed/received', len(received))
+        return received
+
+    def spider_idle(self, spider):
+        if self.poll():
+            raise DontCloseSpider
+        self.coordinator.set_idle(self.index, True)
+        if not self.coordinator.finished():
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self.poll_task is not None and self.poll_task.running:
+            self.poll_task.stop()
+        self.coordinator.set_idle(self.index, True)
+        self.coordinator.close()
@@ -0,0 +1,389 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+
+from OpenSSL import SSL
+from scrapy import signals
+from scrapy.core.downloader.contextfactory import ScrapyClientContextFactory
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.core.downloader.tls import ScrapyClientTLSOptions
+from twisted.internet import defer
+from twisted.internet.error import TimeoutError
+from twisted.internet.interfaces import ISSLTransport
+from twisted.web.client import HTTPConnectionPool
+
+try:
+    from scrapy.core.downloader.handlers.http2 import H2DownloadHandler, ScrapyH2Agent
+    from scrapy.core.http2.agent import H2Agent
+except ImportError:
+    H2DownloadHandler = None
+
+try:
+    from OpenSSL._util import lib as _lib
+except ImportError:
+    _lib = None
+
+from .metrics import BYTE_BUCKETS, observe
+
+logger = logging.getLogger(__name__)
+
+# Perfil de descarga para muchos hosts chicos: conexiones persistentes por
+# host con limites de keep-alive, HTTP/2 con los hosts que lo negocian (el
+# resto sigue en HTTP/1.1), reanudacion de sesiones TLS y un reporte por host
+# del tiempo de conexion y handshake contra el de transferencia.
+
+# La reanudacion de sesiones usa dos APIs privadas: el info callback de
+# ClientTLSOptions (twisted), para enterarse del fin del handshake, y
+# SSL_session_reused de los bindings de OpenSSL en pyOpenSSL (sobre
+# Connection._ssl). Probado con Scrapy 2.11.2, Twisted 23.10.0 y pyOpenSSL
+# 24.3.0; si alguna de las dos falta ResumingContextFactory se comporta como
+# ScrapyClientContextFactory.
+TLS_RESUMPTION = (getattr(_lib, 'SSL_session_reused', None) is not None
+    and callable(getattr(ScrapyClientTLSOptions, '_identityVerifyingInfoCallback', None)))
+
+# un perfil por crawler, compartido por los handlers de http y https
+_profiles = WeakKeyDictionary()
+
+
+class _HostProfile:
+
+    def __init__(self):
+        self.connections = 0
+        self.connect = 0.0
+        self.handshakes = 0
+        self.resumed = 0
+        self.tls = 0.0
+        self.requests = 0
+        self.http2 = 0
+        self.wait = 0.0
+        self.transfer = 0.0
+        self.bytes = 0
+
+    def to_dict(self):
+        def ms(total, count):
+            return round(total / count * 1000, 1) if count else None
+        return {
+            'connections': self.connections,
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+            'requests': self.requests,
+            'http2': self.http2,
+            'bytes': self.bytes,
+            'connect_ms': ms(self.connect, self.connections),
+            'tls_ms': ms(self.tls, self.handshakes),
+            'wait_ms': ms(self.wait, self.requests),
+            'transfer_ms': ms(self.transfer, self.requests),
+            'setup_s': round(self.connect + self.tls, 3),
+            'transfer_s': round(self.wait + self.transfer, 3),
+        }
+
+
+class DownloadProfile:
+    # Tiempos por host: conexion (DNS + TCP), handshake TLS (completo o
+    # reanudado), espera hasta los headers y transferencia del cuerpo. Los
+    # histogramas van a los stats (download/connect, download/tls,
+    # download/transfer) y al cerrar se loguean los hosts que mas tiempo
+    # pasaron armando conexiones; con DOWNLOAD_PROFILE_FILE se guarda el
+    # reporte completo en JSON.
+
+    def __init__(self, stats=None, report_file=None):
+        self.stats = stats
+        self.report_file = report_file
+        self.hosts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        profile = _profiles.get(crawler)
+        if profile is None:
+            profile = _profiles[crawler] = cls(crawler.stats, crawler.settings.get('DOWNLOAD_PROFILE_FILE'))
+            crawler.signals.connect(profile.spider_closed, signal=signals.spider_closed)
+        return profile
+
+    def host(self, hostname):
+        state = self.hosts.get(hostname)
+        if state is None:
+            state = self.hosts[hostname] = _HostProfile()
+        return state
+
+    def connected(self, hostname, seconds):
+        state = self.host(hostname)
+        state.connections += 1
+        state.connect += seconds
+        if self.stats is not None:
+            self.stats.inc_value('download/connections')
+            observe(self.stats, 'download/connect', seconds)
+
+    def handshake(self, hostname, seconds, resumed):
+        state = self.host(hostname)
+        state.handshakes += 1
+        state.resumed += resumed
+        state.tls += seconds
+        if self.stats is not None:
+            self.stats.inc_value('download/tls_resumed' if resumed else 'download/tls_full')
+            observe(self.stats, 'download/tls', seconds)
+
+    def response(self, hostname, wait, transfer, size, protocol):
+        state = self.host(hostname)
+        state.requests += 1
+        state.http2 += protocol == 'h2'
+        state.wait += wait
+        state.transfer += transfer
+        state.bytes += size
+        if self.stats is not None:
+            if protocol == 'h2':
+                self.stats.inc_value('download/http2')
+            observe(self.stats, 'download/transfer', transfer)
+            observe(self.stats, 'download/response_bytes', size, BYTE_BUCKETS)
+
+    def report(self):
+        return {hostname: state.to_dict() for hostname, state in self.hosts.items()}
+
+    def spider_closed(self, spider):
+        report = self.report()
+        for hostname in sorted(report, key=lambda h: report[h]['setup_s'], reverse=True)[:20]:
+            r = report[hostname]
+            spider.logger.info('Descargas de %s: %d requests (%d por h2) en %d conexiones, %d handshakes '
+                '(%d reanudados); conexion %sms, tls %sms, espera %sms, transferencia %sms, %d bytes',
+                hostname, r['requests'], r['http2'], r['connections'], r['handshakes'], r['resumed'],
+                r['connect_ms'], r['tls_ms'], r['wait_ms'], r['transfer_ms'], r['bytes'])
+        if self.report_file:
+            with open(self.report_file, 'w') as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+            spider.logger.info('Reporte de descargas en %s', self.report_file)
+
+
+class ResumingTLSOptions(ScrapyClientTLSOptions):
+    # Ofrece la ultima sesion TLS guardada para el host y avisa a la factory
+    # al terminar el handshake. Los mensajes posteriores al handshake
+    # (renegociacion, key update) no se vuelven a medir.
+
+    def __init__(self, hostname, ctx, verbose_logging, factory, port):
+        super().__init__(hostname, ctx, verbose_logging)
+        self.factory = factory
+        self.key = (hostname, port)
+        self.started = None
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = super().clientConnectionForTLS(tlsProtocol)
+        session = self.factory.sessions.get(self.key)
+        if session is not None:
+            connection.set_session(session)
+        self.started = time.monotonic()
+        return connection
+
+    def _identityVerifyingInfoCallback(self, connection, where, ret):
+        if self.started is None:
+            return
+        super()._identityVerifyingInfoCallback(connection, where, ret)
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            resumed = _lib.SSL_session_reused(connection._ssl) == 1
+            self.factory.handshake(self.key, time.monotonic() - self.started, resumed, connection.get_session())
+            self.started = None
+
+
+class ResumingContextFactory(ScrapyClientContextFactory):
+    # ScrapyClientContextFactory no reanuda sesiones: cada conexion hace el
+    # handshake completo. Esta guarda la ultima sesion de cada (host, puerto),
+    # hasta DOWNLOAD_TLS_SESSION_CACHE hosts, y la ofrece en las conexiones
+    # nuevas a ese host (ticket o session id). Cada conexion sigue teniendo
+    # su propio SSL.Context: twisted engancha en el contexto el callback que
+    # pone el SNI, y un contexto compartido mezclaria los hosts. El
+    # certificado sigue disponible en las sesiones reanudadas. Sin
+    # TLS_RESUMPTION cada conexion hace el handshake completo.
+
+    def __init__(self, *args, session_cache_size=10000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_cache_size = session_cache_size if TLS_RESUMPTION else 0
+        self.sessions = OrderedDict()
+        self.profile = None
+
+    @classmethod
+    def from_settings(cls, settings, method=SSL.SSLv23_METHOD, *args, **kwargs):
+        kwargs.setdefault('session_cache_size', settings.getint('DOWNLOAD_TLS_SESSION_CACHE', 10000))
+        return super().from_settings(settings, method, *args, **kwargs)
+
+    def getContext(self, hostname=None, port=None):
+        # twisted le pone a cada contexto un session id context al azar y
+        # OpenSSL no reanuda sesiones de otro contexto: se fija uno comun
+        ctx = super().getContext(hostname, port)
+        ctx.set_session_id(b'unlp_crawler')
+        return ctx
+
+    def creatorForNetloc(self, hostname, port):
+        if not TLS_RESUMPTION:
+            return super().creatorForNetloc(hostname, port)
+        return ResumingTLSOptions(hostname.decode('ascii'), self.getContext(),
+            self.tls_verbose_logging, self, port)
+
+    def refresh(self, hostname, port, connection):
+        # con TLS 1.3 el ticket llega despues del handshake, junto con la
+        # primera respuesta: la sesion guardada en el handshake no se puede
+        # reanudar y hay que volver a pedirla
+        key = (hostname, port)
+        if key in self.sessions:
+            self.store(key, connection.get_session())
+
+    def store(self, key, session):
+        if session is None or not self.session_cache_size:
+            return
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        if len(self.sessions) > self.session_cache_size:
+            self.sessions.popitem(last=False)
+
+    def handshake(self, key, seconds, resumed, session):
+        self.store(key, session)
+        if self.profile is not None:
+            self.profile.handshake(key[0], seconds, resumed)
+
+
+class ProfiledConnectionPool(HTTPConnectionPool):
+    # mide cuanto tarda cada conexion nueva (DNS + TCP) por host y, con una
+    # ResumingContextFactory, actualiza la sesion TLS del host cada vez que
+    # una conexion https vuelve al pool
+
+    def __init__(self, reactor, profile, context_factory=None, persistent=True):
+        super().__init__(reactor, persistent)
+        self.profile = profile
+        self.context_factory = context_factory
+
+    def _putConnection(self, key, connection):
+        if self.context_factory is not None and ISSLTransport.providedBy(connection.transport):
+            self.context_factory.refresh(key[1].decode('ascii'), key[2], connection.transport.getHandle())
+        super()._putConnection(key, connection)
+
+    def _newConnection(self, key, endpoint):
+        d = super()._newConnection(key, endpoint)
+        d.addCallback(self.connected, key[1], time.monotonic())
+        return d
+
+    def connected(self, protocol, host, start):
+        self.profile.connected(host.decode('ascii', 'replace'), time.monotonic() - start)
+        return protocol
+
+
+def _profiled(d, profile, request, start):
+    # download_latency (lo pone el handler) es la espera hasta los headers en
+    # HTTP/1.1; en HTTP/2 llega con la respuesta completa
+    def downloaded(response):
+        total = time.monotonic() - start
+        wait = min(request.meta.get('download_latency', total), total)
+        profile.response(urlsplit(response.url).hostname or '', wait, total - wait,
+            len(response.body), response.protocol)
+        return response
+    return d.addCallback(downloaded)
+
+
+class PooledHTTP11DownloadHandler(HTTP11DownloadHandler):
+    # HTTP/1.1 con conexiones persistentes: hasta DOWNLOAD_POOL_MAX_PER_HOST
+    # conexiones ociosas por host, cerradas despues de
+    # DOWNLOAD_POOL_IDLE_TIMEOUT segundos sin uso.
+
+    def __init__(self, settings, crawler=None, profile=None):
+        super().__init__(settings, crawler)
+        from twisted.internet import reactor
+        if profile is None:
+            profile = DownloadProfile.from_crawler(crawler) if crawler is not None else DownloadProfile()
+        self.profile = profile
+        resuming = isinstance(self._contextFactory, ResumingContextFactory)
+        self._pool = ProfiledConnectionPool(reactor, profile, self._contextFactory if resuming else None)
+        self._pool.maxPersistentPerHost = settings.getint('DOWNLOAD_POOL_MAX_PER_HOST', 16)
+        self._pool.cachedConnectionTimeout = settings.getint('DOWNLOAD_POOL_IDLE_TIMEOUT', 30)
+        self._pool._factory.noisy = False
+        if resuming:
+            self._contextFactory.profile = profile
+
+    def download_request(self, request, spider):
+        start = time.monotonic()
+        return _profiled(super().download_request(request, spider), self.profile, request, start)
+
+
+if H2DownloadHandler is not None:
+
+    class _FallbackH2Agent(H2Agent):
+        # ofrece h2 y http/1.1 por ALPN: un host sin HTTP/2 elige http/1.1 y
+        # la conexion falla enseguida con InvalidNegotiatedProtocol
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._context_factory._acceptable_protocols = [b'h2', b'http/1.1']
+
+    class _FallbackScrapyH2Agent(ScrapyH2Agent):
+        _Agent = _FallbackH2Agent
+
+    class FallbackH2DownloadHandler(H2DownloadHandler):
+
+        def download_request(self, request, spider):
+            agent = _FallbackScrapyH2Agent(context_factory=self._context_factory,
+                pool=self._pool, crawler=self._crawler)
+            return agent.download_request(request, spider)
+
+
+class AdaptiveDownloadHandler:
+    # Handler de http y https. Con DOWNLOAD_HTTP2_ENABLED y el paquete h2
+    # (pip install Twisted[http2]) el primer request https a cada host se
+    # intenta por HTTP/2; si el host no lo negocia o la conexion falla antes
+    # de la primera respuesta, el host queda en HTTP/1.1 el resto del crawl y
+    # el request se repite por ahi. Los requests con proxy van siempre por
+    # HTTP/1.1 (el handler de HTTP/2 no hace CONNECT). HTTP/2 no emite
+    # headers_received ni bytes_received: ResponseFilterMiddleware filtra
+    # esas respuestas recien al llegar completas.
+
+    lazy = False
+
+    def __init__(self, settings, crawler=None):
+        self.stats = crawler.stats if crawler is not None else None
+        # hay un handler por esquema: el aviso de h2 se da una sola vez
+        first = crawler is None or crawler not in _profiles
+        self.profile = DownloadProfile.from_crawler(crawler) if crawler is not None else DownloadProfile()
+        self.http11 = PooledHTTP11DownloadHandler(settings, crawler, self.profile)
+        self.http2 = None
+        if settings.getbool('DOWNLOAD_HTTP2_ENABLED'):
+            if H2DownloadHandler is None:
+                if first:
+                    logger.warning('DOWNLOAD_HTTP2_ENABLED requiere el paquete h2, se usa solo HTTP/1.1')
+            else:
+                self.http2 = FallbackH2DownloadHandler(settings, crawler)
+                if isinstance(self.http2._context_factory, ResumingContextFactory):
+                    self.http2._context_factory.profile = self.profile
+        # (host, puerto) que respondieron por HTTP/2 y los que quedan en HTTP/1.1
+        self.http2_hosts = set()
+        self.http1_hosts = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler)
+
+    def download_request(self, request, spider):
+        u = urlsplit(request.url)
+        key = (u.hostname, u.port)
+        if self.http2 is None or u.scheme != 'https' or request.meta.get('proxy') or key in self.http1_hosts:
+            return self.http11.download_request(request, spider)
+        start = time.monotonic()
+        d = _profiled(self.http2.download_request(request, spider), self.profile, request, start)
+        d.addCallbacks(self.http2_downloaded, self.http2_failed,
+            callbackArgs=(key,), errbackArgs=(key, request, spider))
+        return d
+
+    def http2_downloaded(self, response, key):
+        self.http2_hosts.add(key)
+        return response
+
+    def http2_failed(self, failure, key, request, spider):
+        if key in self.http2_hosts or failure.check(TimeoutError, defer.CancelledError):
+            return failure
+        if key not in self.http1_hosts:
+            self.http1_hosts.add(key)
+            if self.stats is not None:
+                self.stats.inc_value('download/http2_fallback')
+            logger.debug('%s no negocio HTTP/2 (%s), se sigue por HTTP/1.1', key[0], failure.value)
+        return self.http11.download_request(request, spider)
+
+    @defer.inlineCallbacks
+    def close(self):
+        yield self.http11.close()
+        if self.http2 is not None:
+            self.http2.close()
@@ -0,0 +1,188 @@
+import hashlib
+import sys
+from urllib import parse
+
+from bs4 import BeautifulSoup
+from lxml import etree
+from scrapy.http import HtmlResponse
+from scrapy.linkextractors import IGNORED_EXTENSIONS, LinkExtractor
+from scrapy.selector import Selector
+from scrapy.utils.url import url_has_any_extension
+from w3lib.html import strip_html5_whitespace
+from w3lib.url import safe_url_string
+
+from .items import Script, Stylesheet
+
+
+def md5(data):
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def clean_comment(comment):
+    return comment.replace('<!--', '').replace('-->', '').strip()
+
+
+class SelectorExtractor:
+    # Extraccion original: LinkExtractor dos veces, un Selector por cada
+    # xpath y BeautifulSoup por formulario. Se mantiene como referencia para
+    # comparar resultados y tiempos (ver benchmarks/extraction.py).
+
+    def extract(self, response):
+        extractor = LinkExtractor()
+        links = tuple(l.url for l in extractor.extract_links(response))
+
+        sel = Selector(response)
+        comments = sel.xpath('//comment()').extract()
+        return {
+            'links': links,
+            'css': self.extract_css(sel),
+            'js': self.extract_js(sel),
+            'forms': self.extract_form(sel),
+            'comments': tuple(set([clean_comment(c) for c in comments])),
+            'title': response.xpath('//title/text()').get(),
+        }
+
+    def extract_text(self, text, url, encoding='utf-8'):
+        return self.extract(HtmlResponse(url=url, body=text.encode('utf-8'), encoding='utf-8'))
+
+    def extract_css(self, sel):
+        # el md5 de las hojas de estilo lo resuelve AssetPipeline
+        css = sel.xpath('//link')
+        items = []
+        for c in css:
+            href = (c.xpath('@href').extract() or [None])[0]
+            rel = (c.xpath('@rel').extract() or [None])[0]
+            if rel == 'stylesheet' and href:
+                items.append(Stylesheet(rel, href, ''))
+        return tuple(items)
+
+    def extract_js(self, sel):
+        # el md5 de los scripts externos lo resuelve AssetPipeline
+        js = sel.xpath('//script')
+        items = []
+        for j in js:
+            src = (j.xpath('@src').extract() or [''])[0]
+            jtype = (j.xpath('@type').extract() or [''])[0]
+            md5_ = ''
+            if not src:
+                md5_ = md5(j.extract())
+            items.append(Script(sys.intern(jtype), src, md5_))
+        return tuple(items)
+
+    def extract_form(self, sel):
+        form = sel.xpath('//form')
+        items = []
+        for f in form:
+            # atributos tal cual estan en el html, como en LxmlExtractor: sin
+            # separar los multivaluados (accept-charset, class) en listas y
+            # con el primero de los repetidos
+            soup = BeautifulSoup(f.extract(), 'html.parser', multi_valued_attributes=None,
+                on_duplicate_attribute='ignore')
+            attrs = soup.form.attrs
+            attrs.pop('class', None)
+            inputs = (f.xpath('input/@name').extract() or [''])[0]
+
+            attrs['inputs'] = inputs
+            items.append(tuple(attrs.items()))
+        return tuple(items)
+
+
+class LxmlExtractor:
+    # Recorre una sola vez el arbol lxml que scrapy ya parseo para la
+    # respuesta (response.selector.root) y junta links, css, js, formularios,
+    # comentarios y titulo. Los links siguen las mismas reglas que
+    # LinkExtractor() sin argumentos.
+
+    LINK_TAGS = ('a', 'area')
+    deny_extensions = {'.' + e for e in IGNORED_EXTENSIONS}
+
+    def extract(self, response):
+        return self.extract_tree(response.selector.root, response.url, response.encoding)
+
+    def extract_text(self, text, url, encoding='utf-8'):
+        # mismo arbol que arma scrapy para response.selector
+        return self.extract_tree(Selector(text=text, type='html', base_url=url).root, url, encoding)
+
+    def extract_tree(self, root, url, encoding='utf-8'):
+        hrefs = []
+        css = []
+        js = []
+        forms = []
+        comments = set()
+        title = None
+        base_href = None
+
+        for el in root.iter():
+            tag = el.tag
+            if tag is etree.Comment:
+                comments.add(clean_comment(el.text or ''))
+                continue
+            if not isinstance(tag, str):
+                continue
+            if tag in self.LINK_TAGS:
+                href = el.get('href')
+                if href is not None:
+                    hrefs.append(href)
+            elif tag == 'link':
+                href = el.get('href')
+                if el.get('rel') == 'stylesheet' and href:
+                    css.append(Stylesheet('stylesheet', href, ''))
+            elif tag == 'script':
+                src = el.get('src') or ''
+                md5_ = ''
+                if not src:
+                    md5_ = md5(etree.tostring(el, method='html', encoding='unicode', with_tail=False))
+                js.append(Script(sys.intern(el.get('type') or ''), src, md5_))
+            elif tag == 'form':
+                attrs = dict(el.attrib)
+                attrs.pop('class', None)
+                attrs['inputs'] = ''
+                for child in el:
+                    if child.tag == 'input' and child.get('name') is not None:
+                        attrs['inputs'] = child.get('name')
+                        break
+                forms.append(tuple(attrs.items()))
+            elif tag == 'title':
+                if title is None and el.text is not None:
+                    title = el.text
+            elif tag == 'base':
+                if base_href is None and el.get('href'):
+                    base_href = el.get('href')
+
+        links = self.resolve_links(hrefs, url, encoding, base_href)
+        return {
+            'links': links,
+            'css': tuple(css),
+            'js': tuple(js),
+            'forms': tuple(forms),
+            'comments': tuple(comments),
+            'title': title,
+        }
+
+    def resolve_links(self, hrefs, url, encoding, base_href):
+        base_url = safe_url_string(url)
+        if base_href:
+            base_url = parse.urljoin(base_url, safe_url_string(base_href.strip(), encoding=encoding))
+        links = []
+        seen = set()
+        for href in hrefs:
+            try:
+                link = parse.urljoin(base_url, strip_html5_whitespace(href))
+                link = parse.urljoin(url, safe_url_string(link, encoding=encoding))
+            except ValueError:
+                continue
+            if link in seen:
+                continue
+            seen.add(link)
+            if link.split('://', 1)[0] not in ('http', 'https', 'file', 'ftp'):
+                continue
+            if url_has_any_extension(parse.urlparse(link), self.deny_extensions):
+                continue
+            links.append(link)
+        return tuple(links)
+
+
+EXTRACTORS = {
+    'selector': SelectorExtractor,
+    'lxml': LxmlExtractor,
+}
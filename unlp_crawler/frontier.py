@@ -0,0 +1,395 @@
+import hashlib
+import heapq
+import logging
+import math
+import os
+import pickle
+import sqlite3
+from pathlib import Path
+from weakref import WeakKeyDictionary
+
+from queuelib import queue
+from scrapy import Request, signals
+from scrapy.core.scheduler import Scheduler
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.exceptions import NotConfigured
+from scrapy.pqueues import DownloaderAwarePriorityQueue, ScrapyPriorityQueue, _path_safe
+from scrapy.squeues import _pickle_serialize, _scrapy_serialization_queue, _serializable_queue, _with_mkdir
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import request_from_dict
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    # Filtro de Bloom sobre un bytearray. Dimensionado para `capacity`
+    # elementos con `error_rate` de falsos positivos, sin pasar de
+    # `max_bytes` de memoria.
+
+    def __init__(self, capacity, error_rate=0.001, max_bytes=None):
+        bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes:
+            bits = min(bits, max_bytes * 8)
+        self.size = max(bits, 64)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.md5(key).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class FrontierDupeFilter(RFPDupeFilter):
+    # Dupefilter para crawls grandes: en memoria solo un filtro de Bloom de
+    # tamano acotado (FRONTIER_MEMORY_LIMIT); el conjunto exacto de
+    # fingerprints vive en SQLite (JOBDIR/fingerprints.db) y solo se consulta
+    # cuando el Bloom da positivo. Sin JOBDIR la tabla es en memoria.
+    # La tabla in_progress guarda los requests que salieron de la cola y
+    # todavia no terminaron (ver FrontierScheduler).
+
+    def __init__(self, path=None, debug=False, *, fingerprinter=None,
+                 capacity=10000000, error_rate=0.001, memory_limit=None):
+        super().__init__(None, debug, fingerprinter=fingerprinter)
+        self.fingerprints = None
+        self.db = sqlite3.connect(str(Path(path, 'fingerprints.db')) if path else ':memory:')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS fingerprint (fp BLOB PRIMARY KEY) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS in_progress (fp BLOB PRIMARY KEY, request BLOB)')
+        self.bloom = BloomFilter(capacity, error_rate, memory_limit)
+        count = 0
+        for (fp,) in self.db.execute('SELECT fp FROM fingerprint'):
+            self.bloom.add(fp)
+            count += 1
+        if count:
+            logger.info('Frontera: %d fingerprints recuperados', count)
+
+    @classmethod
+    def from_settings(cls, settings, *, fingerprinter=None):
+        return cls(job_dir(settings), settings.getbool('DUPEFILTER_DEBUG'),
+            fingerprinter=fingerprinter,
+            capacity=settings.getint('FRONTIER_BLOOM_CAPACITY', 10000000),
+            error_rate=settings.getfloat('FRONTIER_BLOOM_ERROR_RATE', 0.001),
+            memory_limit=settings.getint('FRONTIER_MEMORY_LIMIT') or None)
+
+    def request_seen(self, request):
+        fp = self.fingerprinter.fingerprint(request)
+        if fp in self.bloom and self.db.execute('SELECT 1 FROM fingerprint WHERE fp = ?', (fp,)).fetchone():
+            return True
+        self.bloom.add(fp)
+        # se confirma enseguida, igual que el push en la cola de disco: si no,
+        # tras un kill -9 un request encolado podria volver a encolarse
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO fingerprint VALUES (?)', (fp,))
+        return False
+
+    def start(self, fp, request):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO in_progress VALUES (?, ?)', (fp, request))
+
+    def finish(self, fps):
+        with self.db:
+            self.db.executemany('DELETE FROM in_progress WHERE fp = ?', [(fp,) for fp in fps])
+
+    def in_progress(self):
+        return self.db.execute('SELECT fp, request FROM in_progress').fetchall()
+
+    def close(self, reason):
+        self.db.close()
+
+
+class _CountedFifoSQLiteQueue(queue.FifoSQLiteQueue):
+    # FifoSQLiteQueue confirma cada push/pop, asi que sobrevive a un kill -9.
+    # El largo se lleva en memoria para no hacer un COUNT(*) en cada
+    # consulta del scheduler.
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._size = super().__len__()
+
+    def push(self, item):
+        super().push(item)
+        self._size += 1
+
+    def pop(self):
+        item = super().pop()
+        if item is not None:
+            self._size -= 1
+        return item
+
+    def __len__(self):
+        return self._size
+
+
+PickleFifoSqliteQueue = _scrapy_serialization_queue(
+    _serializable_queue(_with_mkdir(_CountedFifoSQLiteQueue), _pickle_serialize, pickle.loads)
+)
+
+
+class HeapPriorityQueue(ScrapyPriorityQueue):
+    # ScrapyPriorityQueue recorre todas sus prioridades cada vez que se vacia
+    # una; con el puntaje de links (unlp_crawler/scoring.py) hay decenas por
+    # slot. Aca las prioridades activas van en un heap. Sigue habiendo una
+    # cola (de memoria o de disco) por prioridad y close() devuelve las
+    # prioridades activas, asi un JOBDIR se reanuda igual.
+
+    def init_prios(self, startprios):
+        super().init_prios(startprios)
+        self.heap = list(self.queues)
+        heapq.heapify(self.heap)
+
+    def push(self, request):
+        priority = self.priority(request)
+        if priority not in self.queues:
+            self.queues[priority] = self.qfactory(priority)
+            heapq.heappush(self.heap, priority)
+        self.queues[priority].push(request)
+        self.curprio = self.heap[0]
+
+    def pop(self):
+        if self.curprio is None:
+            return None
+        q = self.queues[self.curprio]
+        m = q.pop()
+        if not q:
+            del self.queues[self.curprio]
+            q.close()
+            heapq.heappop(self.heap)
+            self.curprio = self.heap[0] if self.heap else None
+        return m
+
+
+# archivo con el nombre del slot en el directorio de colas de cada slot
+SLOT_FILE = 'slot'
+
+
+def queue_priorities(path):
+    # prioridades con cola de disco en `path`: un archivo SQLite por
+    # prioridad, con el numero como nombre (los -wal y -shm no cuentan; con
+    # WAL el archivo principal puede estar vacio hasta el checkpoint)
+    priorities = []
+    for entry in os.scandir(path):
+        if entry.is_file():
+            try:
+                priorities.append(int(entry.name))
+            except ValueError:
+                pass
+    return sorted(priorities)
+
+
+class HeapDownloaderAwarePriorityQueue(DownloaderAwarePriorityQueue):
+    # DownloaderAwarePriorityQueue con un HeapPriorityQueue por slot. En
+    # disco cada slot guarda su nombre (el directorio es _path_safe(slot))
+    # para poder reconstruir las colas sin active.json.
+
+    def pqfactory(self, slot, startprios=()):
+        path = self.key + '/' + _path_safe(slot)
+        slot_file = Path(path, SLOT_FILE)
+        # key vacio: colas de memoria
+        if self.key and not slot_file.exists():
+            os.makedirs(path, exist_ok=True)
+            slot_file.write_text(slot, encoding='utf-8')
+        return HeapPriorityQueue(self.crawler, self.downstream_queue_cls, path, startprios)
+
+
+# scheduler de cada crawler, para que los middlewares de abajo marquen los
+# requests terminados
+_schedulers = WeakKeyDictionary()
+
+
+def finish_requests(crawler, fps):
+    scheduler = _schedulers.get(crawler)
+    if scheduler is not None and fps:
+        scheduler.finish(fps)
+
+
+class FrontierScheduler(Scheduler):
+    # El Scheduler de scrapy guarda la lista de colas de disco activas
+    # (requests.queue/active.json) solo al cerrar, por lo que un crawl
+    # matado con kill -9 no puede reanudarse. Aca la lista se reconstruye al
+    # abrir a partir de los archivos de las colas, que se confirman en cada
+    # push: no se pierde ningun request encolado, ni siquiera los de colas
+    # creadas justo antes del corte.
+    # Con JOBDIR cada request que sale de la cola se anota en in_progress
+    # (fingerprints.db) hasta que FrontierSpiderMiddleware o
+    # FrontierDownloaderMiddleware lo dan por terminado; los fingerprints
+    # viajan en meta['frontier_fps'], asi una redireccion o un reintento
+    # terminan tambien el request original. Al abrir, los que quedaron en
+    # curso (en descarga, en el spider o en los pipelines al momento del
+    # corte) se vuelven a encolar.
+
+    tracking = False
+
+    def open(self, spider):
+        result = super().open(spider)
+        self.tracking = self.dqs is not None and isinstance(self.df, FrontierDupeFilter)
+        if self.tracking:
+            if self.crawler is not None:
+                _schedulers[self.crawler] = self
+            self.requeue_in_progress()
+        return result
+
+    def close(self, reason):
+        self.tracking = False
+        return super().close(reason)
+
+    def requeue_in_progress(self):
+        entries = self.df.in_progress()
+        if not entries:
+            return
+        for _, data in entries:
+            request = request_from_dict(pickle.loads(data), spider=self.spider)
+            if not self._dqpush(request):
+                self._mqpush(request)
+        # si se corta de nuevo antes de borrarlos, un request puede quedar dos
+        # veces en la cola: se descarga de mas pero no se pierde
+        self.df.finish([fp for fp, _ in entries])
+        self.stats.inc_value('frontier/requeued_in_progress', len(entries), spider=self.spider)
+        logger.info('Frontera: %d requests que estaban en curso vuelven a la cola', len(entries))
+
+    def enqueue_request(self, request):
+        if super().enqueue_request(request):
+            return True
+        # p.ej. una redireccion a una url ya vista: el original termina aca
+        self.finish(request.meta.get('frontier_fps'))
+        return False
+
+    def next_request(self):
+        request = super().next_request()
+        if request is not None and self.tracking:
+            self.start(request)
+        return request
+
+    def start(self, request):
+        try:
+            data = _pickle_serialize(request.to_dict(spider=self.spider))
+        except ValueError:
+            # tampoco entro en la cola de disco
+            return
+        fp = self.df.fingerprinter.fingerprint(request)
+        fps = request.meta.get('frontier_fps', ())
+        if fp not in fps:
+            request.meta['frontier_fps'] = fps + (fp,)
+        self.df.start(fp, data)
+
+    def finish(self, fps):
+        if fps and self.tracking:
+            self.df.finish(fps)
+
+    def _read_dqs_state(self, dqdir):
+        if issubclass(self.pqclass, HeapDownloaderAwarePriorityQueue):
+            state = {}
+            for entry in os.scandir(dqdir):
+                slot_file = Path(entry.path, SLOT_FILE)
+                if entry.is_dir() and slot_file.exists():
+                    priorities = queue_priorities(entry.path)
+                    if priorities:
+                        state[slot_file.read_text(encoding='utf-8')] = priorities
+            return state
+        if issubclass(self.pqclass, HeapPriorityQueue):
+            return queue_priorities(dqdir)
+        return super()._read_dqs_state(dqdir)
+
+
+class _ResponseProgress:
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.items = 0
+        self.output_done = False
+
+
+class FrontierSpiderMiddleware:
+    # Da por terminado el request de una respuesta cuando el spider termino
+    # de procesarla y cada item que genero paso por los pipelines
+    # (item_scraped, item_dropped o item_error). Tiene que ir antes que
+    # HttpErrorMiddleware (50) para ver tambien las respuestas que ese
+    # descarta. Los items que quedan en un lote de persistencia sin enviar
+    # ya cuentan como guardados: PERSISTENCE_BATCH_SIZE = 1 para no perder
+    # ninguno en un corte.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.responses = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not job_dir(crawler.settings):
+            raise NotConfigured
+        s = cls(crawler)
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            crawler.signals.connect(s.item_done, signal=signal)
+        return s
+
+    def process_spider_output(self, response, result, spider):
+        progress = self.track(response)
+        try:
+            for r in result:
+                self.count(progress, r)
+                yield r
+        finally:
+            self.output_done(response, progress)
+
+    async def process_spider_output_async(self, response, result, spider):
+        progress = self.track(response)
+        try:
+            async for r in result:
+                self.count(progress, r)
+                yield r
+        finally:
+            self.output_done(response, progress)
+
+    def track(self, response):
+        fps = response.request.meta.get('frontier_fps') if response.request is not None else None
+        if not fps:
+            return None
+        progress = self.responses[response] = _ResponseProgress(fps)
+        return progress
+
+    def count(self, progress, r):
+        if progress is not None and r is not None and not isinstance(r, Request):
+            progress.items += 1
+
+    def output_done(self, response, progress):
+        if progress is not None:
+            progress.output_done = True
+            self.maybe_finish(response, progress)
+
+    def item_done(self, item, response, spider, **kwargs):
+        progress = self.responses.get(response)
+        if progress is not None:
+            progress.items -= 1
+            self.maybe_finish(response, progress)
+
+    def maybe_finish(self, response, progress):
+        if progress.output_done and progress.items <= 0:
+            del self.responses[response]
+            finish_requests(self.crawler, progress.fps)
+
+
+class FrontierDownloaderMiddleware:
+    # Da por terminados los requests cuya descarga fallo sin reintento: va
+    # ultimo en process_exception (orden bajo), despues de RetryMiddleware.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not job_dir(crawler.settings):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_exception(self, request, exception, spider):
+        finish_requests(self.crawler, request.meta.get('frontier_fps'))
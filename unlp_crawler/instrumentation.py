@@ -0,0 +1,229 @@
+import cProfile
+import heapq
+import io
+import logging
+import os
+import pstats
+import re
+import time
+import weakref
+from contextlib import contextmanager
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from .metrics import BYTE_BUCKETS, observe
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+logger = logging.getLogger(__name__)
+
+# etapas que se resumen en la linea periodica del log
+STAGES = (
+    ('download', 'stage/download'),
+    ('connect', 'download/connect'),
+    ('tls', 'download/tls'),
+    ('transfer', 'download/transfer'),
+    ('parse', 'stage/parse'),
+    ('links', 'stage/links'),
+    ('analysis', 'analysis/latency'),
+    ('assets', 'stage/assets'),
+    ('write', 'persistence/write_latency'),
+    ('item', 'stage/item'),
+)
+
+
+class SlowestProfiler:
+    # Perfila cada bloque pasado por metrics.timed y guarda el reporte de los
+    # N mas lentos, que se escriben en `path` al cerrar el spider.
+
+    def __init__(self, n, path, kind='cprofile'):
+        if kind == 'pyinstrument' and pyinstrument is None:
+            raise NotConfigured('INSTRUMENTATION_PROFILER = "pyinstrument" requiere el paquete pyinstrument')
+        self.n = n
+        self.path = path
+        self.kind = kind
+        self.slowest = []
+        self.counter = 0
+
+    @contextmanager
+    def profile(self, key, label):
+        if self.kind == 'pyinstrument':
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            if self.kind == 'pyinstrument':
+                profiler.stop()
+            else:
+                profiler.disable()
+            if len(self.slowest) < self.n or elapsed > self.slowest[0][0]:
+                self.counter += 1
+                entry = (elapsed, self.counter, key, label, self.report(profiler))
+                if len(self.slowest) < self.n:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def report(self, profiler):
+        if self.kind == 'pyinstrument':
+            return profiler.output_text(unicode=True)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        return out.getvalue()
+
+    def dump(self):
+        if not self.slowest:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        for rank, (elapsed, _, key, label, report) in enumerate(sorted(self.slowest, reverse=True), 1):
+            name = '{:02d}-{}-{:.1f}ms.txt'.format(rank, key.replace('/', '_'), elapsed * 1000)
+            with open(os.path.join(self.path, name), 'w', encoding='utf-8') as f:
+                f.write('{} {} {:.3f}s\n\n{}'.format(key, label or '', elapsed, report))
+        logger.info('Perfiles de los %d bloques mas lentos en %s', len(self.slowest), self.path)
+
+
+def prometheus_text(stats, prefix='unlp'):
+    # Formato de texto de Prometheus. Los histogramas de metrics.observe se
+    # exportan con buckets acumulados; el resto de los valores numericos
+    # como gauges.
+    histograms = {key[:-len('/count')] for key in stats
+        if key.endswith('/count') and key[:-len('/count')] + '/sum' in stats}
+    lines = []
+    for base in sorted(histograms):
+        name = metric_name(prefix, base)
+        buckets = []
+        for key, value in stats.items():
+            if key.startswith(base + '/le_'):
+                limit = key[len(base) + 4:]
+                buckets.append((float('inf') if limit == 'inf' else float(limit), value))
+        lines.append('# TYPE {} histogram'.format(name))
+        total = 0
+        for limit, value in sorted(buckets):
+            if limit == float('inf'):
+                continue
+            total += value
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, limit, total))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, stats[base + '/count']))
+        lines.append('{}_sum {}'.format(name, stats[base + '/sum']))
+        lines.append('{}_count {}'.format(name, stats[base + '/count']))
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        # /max queda como gauge, el resto del histograma ya se exporto
+        base, _, suffix = key.rpartition('/')
+        if base in histograms and (suffix in ('count', 'sum') or suffix.startswith('le_')):
+            continue
+        name = metric_name(prefix, key)
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def metric_name(prefix, key):
+    return '{}_{}'.format(prefix, re.sub(r'[^a-zA-Z0-9_]', '_', key)).lower()
+
+
+class InstrumentationExtension:
+    # Tiempos por etapa en los stats de scrapy (ver metrics.timed): descarga,
+    # parse_item, extraccion de links, analisis, css/js, persistencia y el
+    # recorrido completo de cada item desde que llega la respuesta. Cada
+    # INSTRUMENTATION_LOG_INTERVAL segundos loguea los promedios y, si esta
+    # configurado, escribe los stats en formato Prometheus en un archivo
+    # (INSTRUMENTATION_PROMETHEUS_FILE, para el textfile collector) o los
+    # sirve por HTTP (INSTRUMENTATION_PROMETHEUS_PORT, en /metrics).
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('INSTRUMENTATION_LOG_INTERVAL', 60)
+        self.prometheus_file = settings.get('INSTRUMENTATION_PROMETHEUS_FILE')
+        self.prometheus_port = settings.getint('INSTRUMENTATION_PROMETHEUS_PORT')
+        self.profiler = None
+        if settings.getint('INSTRUMENTATION_PROFILE_SLOWEST'):
+            self.profiler = SlowestProfiler(settings.getint('INSTRUMENTATION_PROFILE_SLOWEST'),
+                settings.get('INSTRUMENTATION_PROFILE_DIR', 'profiles'),
+                settings.get('INSTRUMENTATION_PROFILER', 'cprofile'))
+        # respuestas sin item (solo links) se liberan solas
+        self.received = weakref.WeakKeyDictionary()
+        self.log_task = None
+        self.listener = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INSTRUMENTATION_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.response_received, signal=signals.response_received)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        return s
+
+    def spider_opened(self, spider):
+        spider.profiler = self.profiler
+        if self.interval:
+            self.log_task = task.LoopingCall(self.log)
+            self.log_task.start(self.interval, now=False)
+        if self.prometheus_port:
+            from twisted.internet import reactor
+            from twisted.web import resource, server
+
+            extension = self
+
+            class Metrics(resource.Resource):
+                isLeaf = True
+
+                def render_GET(self, request):
+                    request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+                    return prometheus_text(extension.stats.get_stats()).encode()
+
+            self.listener = reactor.listenTCP(self.prometheus_port, server.Site(Metrics()))
+
+    def spider_closed(self, spider):
+        if self.log_task is not None and self.log_task.running:
+            self.log_task.stop()
+        self.log()
+        if self.listener is not None:
+            self.listener.stopListening()
+        if self.profiler is not None:
+            self.profiler.dump()
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            observe(self.stats, 'stage/download', latency)
+        observe(self.stats, 'stage/response_bytes', len(response.body), BYTE_BUCKETS)
+        self.received[response] = time.monotonic()
+
+    def item_scraped(self, item, response, spider):
+        start = self.received.pop(response, None)
+        if start is not None:
+            observe(self.stats, 'stage/item', time.monotonic() - start)
+
+    def log(self):
+        stats = self.stats.get_stats()
+        parts = []
+        for name, key in STAGES:
+            count = stats.get(key + '/count')
+            if count:
+                parts.append('{} {:.1f}ms (n={}, max {:.0f}ms)'.format(name,
+                    stats[key + '/sum'] / count * 1000, count, stats[key + '/max'] * 1000))
+        if parts:
+            logger.info('Etapas: %s', ', '.join(parts))
+        if self.prometheus_file:
+            tmp = self.prometheus_file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(prometheus_text(stats))
+            os.replace(tmp, self.prometheus_file)
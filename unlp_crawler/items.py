@@ -3,10 +3,178 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
-import scrapy
+import os
+from dataclasses import dataclass, fields
+from typing import Optional
+from urllib import parse
 
+# Items como dataclasses con __slots__: con miles de paginas en vuelo (en el
+# analisis, esperando sus css/js o en la cola de persistencia) cada item pesa
+# lo minimo. Los headers, formularios, links y comentarios son tuplas; los
+# nombres de headers y los hostnames se internan. Los campos que se derivan
+# de la url (scheme, netloc, path, ...) y hostname_links se calculan recien
+# al serializar, en el backend.
 
-class UnlpCrawlerItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+
+def header(headers, name):
+    # headers es una tupla de (nombre, valor)
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+def as_dict(obj):
+    # dataclasses.asdict hace deepcopy de cada campo; aca alcanza con una
+    # copia plana
+    return {f.name: getattr(obj, f.name) for f in fields(obj)}
+
+
+@dataclass(slots=True)
+class Script:
+    type: str
+    src: str
+    # md5 del script inline, o del externo cuando lo resuelve AssetPipeline
+    md5: str
+
+
+@dataclass(slots=True)
+class Stylesheet:
+    rel: str
+    href: str
+    md5: str
+
+
+@dataclass(slots=True)
+class Certificate:
+    timestamp: int
+    hostname: str
+    port: int
+    pubkey: str
+    issuer: str
+    certificate_hash: str
+
+    def to_dict(self):
+        return as_dict(self)
+
+
+@dataclass(slots=True)
+class Page:
+    timestamp: int
+    url: str
+    text: Optional[str]
+    headers: tuple
+    status: int
+    ip: str
+    hostname: str
+    certificate_hash: str = ''
+    # los completa fill_page con el resultado del analisis
+    title: Optional[str] = None
+    body_hash: Optional[str] = None
+    js: tuple = ()
+    css: tuple = ()
+    # cada formulario es una tupla de (atributo, valor)
+    forms: tuple = ()
+    comments: tuple = ()
+    links: tuple = ()
+    # SimHash del texto y, si es casi igual a otra pagina, la url de esa
+    # pagina (el texto y el analisis no se guardan)
+    simhash: Optional[int] = None
+    duplicate_of: Optional[str] = None
+
+    @property
+    def hostname_links(self):
+        return list({parse.urlparse(l).hostname for l in self.links})
+
+    def url_parts(self):
+        u = parse.urlparse(self.url)
+        return {
+            'scheme': u.scheme,
+            'netloc': u.netloc,
+            'hostname': self.hostname,
+            'port': u.port,
+            'path': u.path,
+            'params': u.params,
+            'query': u.query,
+            'fragment': u.fragment,
+            'filename': os.path.basename(u.path),
+        }
+
+    def to_dict(self):
+        # documento plano, como el dict que armaba parse_item (elasticsearch,
+        # mongodb, jsonl)
+        d = self.document()
+        d['headers'] = dict(self.headers)
+        d['forms'] = [dict(form) for form in self.forms]
+        return d
+
+    def to_row(self):
+        # fila para parquet: headers y formularios van como listas de pares
+        # (columnas map)
+        d = self.document()
+        d['headers'] = list(self.headers)
+        d['forms'] = [list(form) for form in self.forms]
+        return d
+
+    def document(self):
+        d = {
+            'timestamp': self.timestamp,
+            'url': self.url,
+            'text': self.text,
+            'title': self.title,
+            'status': self.status,
+            'body_hash': self.body_hash,
+            'certificate_hash': self.certificate_hash,
+            'ip': self.ip,
+            'js': [as_dict(js) for js in self.js],
+            'css': [as_dict(css) for css in self.css],
+            'comments': list(self.comments),
+            'links': list(self.links),
+            'hostname_links': self.hostname_links,
+            'simhash': None if self.simhash is None else '{:016x}'.format(self.simhash),
+            'duplicate_of': self.duplicate_of,
+        }
+        d.update(self.url_parts())
+        return d
+
+
+@dataclass(slots=True)
+class PageItem:
+    page: Page
+    # solo la primera vez que se ve el certificado (ver CertificateTracker)
+    certificate: Optional[Certificate] = None
+    id: Optional[str] = None
+    # (encoding, previous_body_hash, calcular simhash) mientras el analisis
+    # lo hace AnalysisPipeline
+    analysis: Optional[tuple] = None
+
+
+@dataclass(slots=True)
+class SeenItem:
+    # pagina sin cambios desde la corrida anterior (modo incremental)
+    timestamp: int
+    url: str
+    status: int
+    body_hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    def to_dict(self):
+        return as_dict(self)
+
+
+@dataclass(slots=True)
+class ResourceItem:
+    # respuesta que no es una pagina (pdf, imagen, zip) o demasiado grande:
+    # solo tipo y tamano, sin el cuerpo (ver ResponseFilterMiddleware)
+    timestamp: int
+    url: str
+    status: int
+    content_type: Optional[str]
+    # Content-Length, o lo recibido hasta cortar la descarga
+    size: Optional[int]
+    # 'extension', 'type' o 'size'
+    reason: str
+
+    def to_dict(self):
+        return as_dict(self)
@@ -0,0 +1,226 @@
+import json
+import logging
+import select
+import socket
+import threading
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+logger = logging.getLogger(__name__)
+
+
+# Envio de logs a Logstash sin bloquear el reactor. Un QueueHandler en el
+# root logger deja cada registro (ya formateado como JSON) en un buffer
+# acotado; un hilo los junta en lotes y los manda como JSON separado por
+# newlines al input tcp de Logstash (codec json_lines, ver
+# elastic-cluster/logstash/pipeline/logstash.conf). Si Logstash esta lento o
+# caido el buffer descarta los registros mas viejos y los cuenta en
+# logstash/dropped; la conexion se reintenta recien con el siguiente lote.
+
+
+class DropOldestBuffer:
+    # Cola acotada para QueueHandler. put_nowait nunca bloquea ni falla: con
+    # el buffer lleno descarta el registro mas viejo.
+
+    def __init__(self, maxsize):
+        self.records = deque()
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.ready = threading.Condition(threading.Lock())
+
+    def put_nowait(self, record):
+        with self.ready:
+            if len(self.records) >= self.maxsize:
+                self.records.popleft()
+                self.dropped += 1
+            self.records.append(record)
+            self.ready.notify()
+
+    def get_batch(self, size, timeout):
+        # espera el primer registro a lo sumo `timeout` segundos y se lleva
+        # hasta `size`
+        with self.ready:
+            if not self.records:
+                self.ready.wait(timeout)
+            return [self.records.popleft() for _ in range(min(size, len(self.records)))]
+
+    def __len__(self):
+        return len(self.records)
+
+
+class LogstashFormatter(logging.Formatter):
+    # Mismo formato que python-logstash (version 1), que es lo que esperan
+    # los indices y dashboards existentes
+
+    def __init__(self, message_type='logstash', tags=None):
+        super().__init__()
+        self.message_type = message_type
+        self.tags = tags or []
+        self.host = socket.gethostname()
+
+    def format(self, record):
+        message = {
+            '@timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                + '.{:03d}Z'.format(int(record.msecs)),
+            '@version': '1',
+            'message': record.getMessage(),
+            'host': self.host,
+            'path': record.pathname,
+            'tags': self.tags,
+            'type': self.message_type,
+            'level': record.levelname,
+            'logger_name': record.name,
+            'stack_info': record.stack_info,
+            }
+        if record.exc_info:
+            message['exception'] = self.formatException(record.exc_info)
+        return json.dumps(message, default=str)
+
+
+class LevelFilter(logging.Filter):
+    # Nivel minimo por logger (el prefijo mas largo en `levels`), asi un solo
+    # handler en el root puede mandar el DEBUG de un logger y el INFO del resto
+
+    def __init__(self, level, levels):
+        super().__init__()
+        self.level = level
+        self.levels = sorted(levels.items(), key=lambda item: -len(item[0]))
+
+    def filter(self, record):
+        for name, level in self.levels:
+            if record.name == name or record.name.startswith(name + '.'):
+                return record.levelno >= level
+        return record.levelno >= self.level
+
+
+class LogShipper(QueueListener):
+    # Hilo que vacia el buffer en lotes de hasta `batch` registros, o lo que
+    # haya cada `interval` segundos, y los manda por una conexion TCP que se
+    # abre recien cuando hay algo para mandar.
+
+    def __init__(self, buffer, host, port, batch=500, interval=1, timeout=5, reconnect_delay=5):
+        super().__init__(buffer)
+        self.host = host
+        self.port = port
+        self.batch = batch
+        self.interval = interval
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.sock = None
+        self.retry_at = 0
+        self.sent = 0
+        self.lost = 0
+        self.stopping = threading.Event()
+
+    def _monitor(self):
+        pending = []
+        while True:
+            stopping = self.stopping.is_set()
+            if not pending:
+                pending = self.frames(self.queue.get_batch(self.batch, self.interval))
+            if pending and self.send(pending):
+                pending = []
+            elif pending:
+                self.stopping.wait(max(0, self.retry_at - time.monotonic()))
+            if stopping and (not pending and not len(self.queue) or self.retry_at > time.monotonic()):
+                break
+        self.lost += len(pending) + len(self.frames(self.queue.get_batch(len(self.queue), 0)))
+        self.close()
+
+    def frames(self, records):
+        return [r.msg for r in records if r is not self._sentinel]
+
+    def send(self, frames):
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            if self.sock is not None and select.select([self.sock], [], [], 0)[0]:
+                # Logstash no manda nada: si hay algo para leer es que cerro
+                # la conexion, y lo que se escriba ahi se pierde
+                self.close()
+            if self.sock is None:
+                self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.sock.sendall(('\n'.join(frames) + '\n').encode('utf-8'))
+        except OSError:
+            self.close()
+            self.retry_at = time.monotonic() + self.reconnect_delay
+            return False
+        self.sent += len(frames)
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def stop(self):
+        # un ultimo intento de mandar lo que quede, sin esperar a reconectar
+        self.stopping.set()
+        self.enqueue_sentinel()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def dropped(self):
+        return self.queue.dropped + self.lost
+
+
+class LogShippingExtension:
+    # Instala el handler al arrancar el crawler y lo saca al terminar. Los
+    # stats logstash/sent y logstash/dropped se actualizan al cerrar la
+    # spider (antes de que se vuelquen) y de nuevo al parar el motor, con lo
+    # que se haya mandado de los ultimos registros.
+
+    def __init__(self, settings, stats):
+        self.stats = stats
+        self.buffer = DropOldestBuffer(settings.getint('LOGSTASH_BUFFER', 10000))
+        self.shipper = LogShipper(self.buffer,
+            settings.get('LOGSTASH_HOST', 'localhost'),
+            settings.getint('LOGSTASH_PORT', 5000),
+            batch=settings.getint('LOGSTASH_BATCH', 500),
+            interval=settings.getfloat('LOGSTASH_FLUSH_INTERVAL', 1),
+            timeout=settings.getfloat('LOGSTASH_TIMEOUT', 5),
+            reconnect_delay=settings.getfloat('LOGSTASH_RECONNECT_DELAY', 5))
+        level = logging.getLevelName(settings.get('LOGSTASH_LEVEL', 'INFO'))
+        levels = {name: logging.getLevelName(l)
+            for name, l in settings.getdict('LOGSTASH_LOGGERS').items()}
+        self.handler = QueueHandler(self.buffer)
+        self.handler.setFormatter(LogstashFormatter(settings.get('LOGSTASH_TYPE', 'logstash')))
+        self.handler.addFilter(LevelFilter(level, levels))
+        for name, l in levels.items():
+            named = logging.getLogger(name)
+            if named.getEffectiveLevel() > l:
+                named.setLevel(l)
+        logging.getLogger().addHandler(self.handler)
+        self.shipper.start()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('LOGSTASH_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.engine_stopped, signal=signals.engine_stopped)
+        return s
+
+    def update_stats(self):
+        self.stats.set_value('logstash/sent', self.shipper.sent)
+        self.stats.set_value('logstash/dropped', self.shipper.dropped)
+
+    def spider_closed(self, spider):
+        self.update_stats()
+
+    def engine_stopped(self):
+        logging.getLogger().removeHandler(self.handler)
+        self.shipper.stop()
+        self.update_stats()
+        if self.shipper.dropped:
+            logger.warning('Se descartaron %d registros de log sin enviar a Logstash', self.shipper.dropped)
@@ -0,0 +1,36 @@
+# Histogramas sobre el StatsCollector de scrapy. Cada observacion incrementa
+# el contador del primer bucket que la contiene (<key>/le_<limite>) y
+# actualiza <key>/count, <key>/sum y <key>/max.
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760)
+
+
+def observe(stats, key, value, buckets=LATENCY_BUCKETS):
+    for limit in buckets:
+        if value <= limit:
+            stats.inc_value('{}/le_{}'.format(key, limit))
+            break
+    else:
+        stats.inc_value('{}/le_inf'.format(key))
+    stats.inc_value(key + '/count')
+    stats.inc_value(key + '/sum', value)
+    stats.max_value(key + '/max', value)
+
+
+@contextmanager
+def timed(stats, key, profiler=None, label=None):
+    # mide el bloque en <key>; con un profiler (ver instrumentation.py) ademas
+    # lo perfila para quedarse con los mas lentos
+    start = time.monotonic()
+    try:
+        if profiler is None:
+            yield
+        else:
+            with profiler.profile(key, label):
+                yield
+    finally:
+        observe(stats, key, time.monotonic() - start)
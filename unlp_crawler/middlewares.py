@@ -3,11 +3,32 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import hashlib
+import os
+import time
+from fnmatch import fnmatchcase
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
+
 from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import TunnelError
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.exceptions import NotConfigured, StopDownload
+from scrapy.http import HtmlResponse, Response
+from scrapy.utils.python import to_unicode
+from scrapy.utils.response import response_status_message
+from twisted.internet import defer
+from twisted.internet.error import (ConnectError, ConnectionDone, ConnectionLost,
+    ConnectionRefusedError, DNSLookupError, TCPTimedOutError, TimeoutError)
+from twisted.web.client import ResponseFailed
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from .canonical import origin
+from .persistence.blobstore import BlobStore
+from .persistence.types import PERSISTENCE_TYPES
+
 
 class UnlpCrawlerSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +122,367 @@ class UnlpCrawlerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class IncrementalMiddleware:
+    # Modo incremental: al abrir el spider carga de la persistencia un indice
+    # url -> (ETag, Last-Modified, body_hash, ultima vez visto). Las paginas
+    # conocidas se piden con If-None-Match / If-Modified-Since cuando su
+    # cuerpo esta en el BlobStore, asi un 304 se puede reconstruir y el spider
+    # sigue sus links. parse_item convierte las paginas sin cambios en un
+    # registro liviano "seen".
+
+    CONDITIONAL_HEADERS = (b'If-None-Match', b'If-Modified-Since')
+
+    def __init__(self, settings, stats):
+        self.settings = settings
+        self.stats = stats
+        self.index = {}
+        self.store = None
+        if settings.getbool('BLOBSTORE_ENABLED'):
+            self.store = BlobStore.from_settings(settings)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def spider_opened(self, spider):
+        persistence = PERSISTENCE_TYPES[self.settings['PERSISTENCE_TYPE']](self.settings)
+        persistence.open()
+        try:
+            for url, etag, last_modified, body_hash, ts in persistence.load_index():
+                key = self.key(url)
+                entry = self.index.get(key)
+                if entry is None or ts >= entry[3]:
+                    self.index[key] = (etag, last_modified, body_hash, ts)
+        finally:
+            persistence.close()
+        self.stats.set_value('incremental/index_size', len(self.index))
+        spider.logger.info('Indice incremental: %d urls', len(self.index))
+
+    def key(self, url):
+        return hashlib.md5(url.encode('utf-8')).digest()
+
+    def process_request(self, request, spider):
+        if 'previous_body_hash' in request.meta:
+            return None
+        entry = self.index.get(self.key(request.url))
+        if entry is None:
+            return None
+        etag, last_modified, body_hash, ts = entry
+        request.meta['previous_body_hash'] = body_hash
+        if request.meta.get('incremental_unconditional') or not body_hash:
+            return None
+        if self.store is None or body_hash not in self.store or not (etag or last_modified):
+            return None
+        if etag:
+            request.headers[b'If-None-Match'] = etag
+        if last_modified:
+            request.headers[b'If-Modified-Since'] = last_modified
+        request.meta['incremental_conditional'] = True
+        request.meta['handle_httpstatus_list'] = list(request.meta.get('handle_httpstatus_list', [])) + [304]
+        return None
+
+    def process_response(self, request, response, spider):
+        if response.status != 304 or not request.meta.get('incremental_conditional'):
+            return response
+        body = self.store.get(request.meta['previous_body_hash'])
+        if body is None:
+            # el cuerpo ya no esta en el BlobStore: se pide la pagina completa
+            self.stats.inc_value('incremental/missing_body')
+            r = request.replace(dont_filter=True)
+            for h in self.CONDITIONAL_HEADERS:
+                r.headers.pop(h, None)
+            r.meta['incremental_unconditional'] = True
+            r.meta.pop('incremental_conditional', None)
+            return r
+        self.stats.inc_value('incremental/not_modified')
+        return HtmlResponse(url=response.url, status=304, headers=response.headers, body=body,
+            encoding='utf-8', request=request, flags=response.flags + ['incremental'],
+            certificate=response.certificate, ip_address=response.ip_address,
+            protocol=response.protocol)
+
+
+class _HostState:
+    # estado AIMD de un slot de descarga (un host)
+
+    def __init__(self, window, budget):
+        self.window = window
+        self.delay = None
+        self.latency = None
+        self.budget = budget
+        self.last_decrease = 0
+
+
+class AdaptiveConcurrencyMiddleware:
+    # Concurrencia y delay por host al estilo AIMD. Cada respuesta rapida
+    # agranda la ventana del slot de a 1/ventana (≈ +1 por ronda) y achica el
+    # delay a la mitad; una respuesta lenta (latencia promedio sobre
+    # ADAPTIVE_TARGET_LATENCY) reduce la ventana a la mitad, y un error de
+    # conexion o un codigo de RETRY_HTTP_CODES ademas duplica el delay, a lo
+    # sumo una vez por latencia. Los errores se reintentan mientras el host tenga
+    # presupuesto (ADAPTIVE_RETRY_BUDGET); las respuestas buenas lo recargan
+    # de a poco, asi un host que nunca contesta deja de consumir reintentos.
+
+    EXCEPTIONS_TO_RETRY = (defer.TimeoutError, TimeoutError, DNSLookupError,
+        ConnectionRefusedError, ConnectionDone, ConnectError, ConnectionLost,
+        TCPTimedOutError, ResponseFailed, IOError, TunnelError)
+
+    # fraccion del presupuesto de reintentos que recupera cada respuesta buena
+    BUDGET_REFILL = 0.1
+    # peso de la ultima latencia en el promedio movil
+    EWMA_WEIGHT = 0.3
+
+    def __init__(self, crawler):
+        s = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = s.getint('ADAPTIVE_MIN_CONCURRENCY', 1)
+        self.max_concurrency = s.getint('ADAPTIVE_MAX_CONCURRENCY', 16)
+        self.target_latency = s.getfloat('ADAPTIVE_TARGET_LATENCY', 2)
+        self.min_delay = s.getfloat('DOWNLOAD_DELAY')
+        self.backoff_delay = s.getfloat('ADAPTIVE_BACKOFF_DELAY', 1)
+        self.max_delay = s.getfloat('ADAPTIVE_MAX_DELAY', 30)
+        self.retry_times = s.getint('ADAPTIVE_RETRY_TIMES', 2)
+        self.retry_budget = s.getint('ADAPTIVE_RETRY_BUDGET', 20)
+        self.retry_http_codes = {int(c) for c in s.getlist('RETRY_HTTP_CODES')}
+        self.hosts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def host(self, request):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return None, None
+        state = self.hosts.get(key)
+        if state is None:
+            state = self.hosts[key] = _HostState(slot.concurrency, self.retry_budget)
+            state.delay = slot.delay
+        return slot, state
+
+    def apply(self, slot, state):
+        slot.concurrency = max(self.min_concurrency, min(self.max_concurrency, int(state.window)))
+        slot.delay = state.delay
+
+    def process_request(self, request, spider):
+        # el downloader borra los slots inactivos: uno nuevo para un host
+        # conocido arranca con lo aprendido
+        slot, state = self.host(request)
+        if slot is not None:
+            self.apply(slot, state)
+        return None
+
+    def process_response(self, request, response, spider):
+        slot, state = self.host(request)
+        if slot is None:
+            return response
+        if response.status in self.retry_http_codes:
+            self.decrease(slot, state, backoff=True)
+            return self.retry(request, state, response_status_message(response.status), spider) or response
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            if state.latency is None:
+                state.latency = latency
+            else:
+                state.latency += self.EWMA_WEIGHT * (latency - state.latency)
+        state.budget = min(self.retry_budget, state.budget + self.BUDGET_REFILL)
+        if state.latency is not None and state.latency > self.target_latency:
+            self.decrease(slot, state)
+        else:
+            self.increase(slot, state)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not isinstance(exception, self.EXCEPTIONS_TO_RETRY):
+            return None
+        slot, state = self.host(request)
+        if slot is None:
+            return None
+        self.decrease(slot, state, backoff=True)
+        return self.retry(request, state, exception, spider)
+
+    def increase(self, slot, state):
+        if state.window < self.max_concurrency:
+            state.window = min(self.max_concurrency, state.window + 1 / state.window)
+            self.stats.inc_value('adaptive/increase')
+        state.delay = state.delay / 2 if state.delay / 2 > self.min_delay + 0.01 else self.min_delay
+        self.apply(slot, state)
+
+    def decrease(self, slot, state, backoff=False):
+        # a lo sumo una reduccion por latencia: las respuestas que ya estaban
+        # en vuelo no vuelven a castigar al host
+        now = time.monotonic()
+        if now - state.last_decrease < (state.latency or self.target_latency):
+            return
+        state.last_decrease = now
+        state.window = max(self.min_concurrency, state.window / 2)
+        if backoff:
+            state.delay = min(self.max_delay, max(state.delay * 2, self.backoff_delay))
+        self.stats.inc_value('adaptive/decrease')
+        self.apply(slot, state)
+
+    def retry(self, request, state, reason, spider):
+        if state.budget < 1:
+            self.stats.inc_value('adaptive/retry/budget_exhausted')
+            return None
+        r = get_retry_request(request, spider=spider, reason=reason,
+            max_retry_times=self.retry_times, stats_base_key='adaptive/retry')
+        if r is not None:
+            state.budget -= 1
+        return r
+
+    def spider_closed(self, spider):
+        slowed = [k for k, s in self.hosts.items() if s.delay > self.min_delay]
+        self.stats.set_value('adaptive/hosts_slowed', len(slowed))
+        if slowed:
+            spider.logger.info('Hosts con delay adaptativo: %s', ', '.join(sorted(slowed)[:20]))
+
+
+class CanonicalOriginMiddleware:
+    # Colapsa http/https, www/sin www y puertos de un mismo sitio. Aprende
+    # alias en spider.origins a partir de los redirects que mantienen la
+    # ruta y de los start requests (si responde https, la variante http es
+    # un alias). Los requests ya encolados con un origen que resulto ser un
+    # alias se reescriben y vuelven al scheduler, donde el dupefilter
+    # descarta los repetidos.
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CANONICAL_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def process_request(self, request, spider):
+        origins = getattr(spider, 'origins', None)
+        if not origins:
+            return None
+        url = origins.rewrite(request.url)
+        if url == request.url:
+            return None
+        self.stats.inc_value('canonical/rewritten')
+        return request.replace(url=url)
+
+    def process_response(self, request, response, spider):
+        origins = getattr(spider, 'origins', None)
+        if origins is None or response.status >= 400:
+            return response
+        learned = False
+        for url in request.meta.get('redirect_urls', []):
+            learned |= origins.learn(url, response.url)
+        alternative = request.meta.get('canonical_alternative')
+        if alternative:
+            learned |= origins.alias(origin(alternative), origin(response.url))
+        if learned:
+            self.stats.set_value('canonical/aliases', len(origins))
+        return response
+
+
+class ResponseFilterMiddleware:
+    # Corta la descarga apenas llegan los headers si la url tiene una
+    # extension de RESPONSE_FILTER_DENY_EXTENSIONS, si el Content-Type no
+    # esta en RESPONSE_FILTER_CONTENT_TYPES (admite comodines, 'text/*') o si
+    # el Content-Length pasa RESPONSE_FILTER_MAX_SIZE; sin Content-Length la
+    # corta al recibir mas de RESPONSE_FILTER_MAX_SIZE bytes. La respuesta
+    # llega al spider sin cuerpo y con request.meta['response_filter'] =
+    # (content_type, size, motivo), y parse_item emite un ResourceItem en
+    # lugar de la pagina. Los requests con meta['dont_filter_response'] (los
+    # css/js de AssetPipeline) no se filtran.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.extensions = {'.' + e.lower().lstrip('.') for e in settings.getlist('RESPONSE_FILTER_DENY_EXTENSIONS')}
+        self.content_types = [t.lower() for t in settings.getlist('RESPONSE_FILTER_CONTENT_TYPES')]
+        self.max_size = settings.getint('RESPONSE_FILTER_MAX_SIZE')
+        # request -> (content_type, bytes recibidos)
+        self.received = WeakKeyDictionary()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RESPONSE_FILTER_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.headers_received, signal=signals.headers_received)
+        if s.max_size:
+            crawler.signals.connect(s.bytes_received, signal=signals.bytes_received)
+        return s
+
+    def process_request(self, request, spider):
+        # un redirect o un reintento copia el meta del request original
+        request.meta.pop('response_filter', None)
+        return None
+
+    def headers_received(self, headers, body_length, request, spider):
+        if request.meta.get('dont_filter_response') or b'Location' in headers:
+            return
+        content_type = self.content_type(headers)
+        size = body_length if isinstance(body_length, int) else None
+        reason = self.reason(request, content_type, size)
+        if reason is not None:
+            self.stop(request, content_type, size, reason)
+        if self.max_size and size is None:
+            self.received[request] = (content_type, 0)
+
+    def content_type(self, headers):
+        content_type = headers.get(b'Content-Type')
+        return to_unicode(content_type).split(';')[0].strip().lower() if content_type else None
+
+    def reason(self, request, content_type, size):
+        if os.path.splitext(urlsplit(request.url).path)[1].lower() in self.extensions:
+            return 'extension'
+        if content_type and self.content_types and not any(fnmatchcase(content_type, t) for t in self.content_types):
+            return 'type'
+        if self.max_size and size is not None and size > self.max_size:
+            return 'size'
+        return None
+
+    def bytes_received(self, data, request, spider):
+        entry = self.received.get(request)
+        if entry is None:
+            return
+        content_type, size = entry
+        size += len(data)
+        self.received[request] = (content_type, size)
+        if size > self.max_size:
+            del self.received[request]
+            self.stop(request, content_type, size, 'size')
+
+    def stop(self, request, content_type, size, reason):
+        request.meta['response_filter'] = (content_type, size, reason)
+        self.stats.inc_value('response_filter/{}'.format(reason))
+        raise StopDownload(fail=False)
+
+    def process_response(self, request, response, spider):
+        self.received.pop(request, None)
+        if 'response_filter' not in request.meta:
+            # el handler de HTTP/2 no emite headers_received: esas respuestas
+            # se filtran ya descargadas
+            if response.protocol != 'h2' or request.meta.get('dont_filter_response') or b'Location' in response.headers:
+                return response
+            content_type = self.content_type(response.headers)
+            reason = self.reason(request, content_type, len(response.body))
+            if reason is None:
+                return response
+            request.meta['response_filter'] = (content_type, len(response.body), reason)
+            self.stats.inc_value('response_filter/{}'.format(reason))
+        # sin cuerpo (y sin Content-Encoding, para que HttpCompressionMiddleware
+        # no intente descomprimir un cuerpo cortado)
+        headers = response.headers.copy()
+        headers.pop(b'Content-Encoding', None)
+        return Response(url=response.url, status=response.status, headers=headers, request=request,
+            flags=response.flags + ['filtered'], certificate=response.certificate,
+            ip_address=response.ip_address, protocol=response.protocol)
@@ -0,0 +1,145 @@
+import re
+import zlib
+from collections import OrderedDict
+
+from scrapy import signals
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Deteccion de paginas casi iguales (calendarios, listados, paginas que solo
+# cambian por un timestamp o un token CSRF). Cada pagina se resume en un
+# SimHash de 64 bits de sus shingles de tres palabras; dos paginas son casi
+# iguales si sus SimHash difieren en a lo sumo NEARDUP_DISTANCE bits.
+
+TAGS = re.compile(r'<script.*?</script>|<style.*?</style>|<!--.*?-->|<[^>]*>', re.S | re.I)
+WORDS = re.compile(r'\w+')
+# con menos shingles el SimHash no es confiable (redirects, paginas vacias)
+MIN_FEATURES = 16
+MASK = (1 << 64) - 1
+
+
+def words(text):
+    return WORDS.findall(TAGS.sub(' ', text).lower())
+
+
+def mix(x):
+    # finalizador de splitmix64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK
+    return x ^ (x >> 31)
+
+
+def simhash(text):
+    # None si la pagina tiene muy poco texto
+    ws = [zlib.crc32(w.encode('utf-8')) for w in words(text)]
+    if len(ws) < MIN_FEATURES + 2:
+        return None
+    if np is not None:
+        return simhash_numpy(ws)
+    features = {mix(a ^ mix(b ^ mix(c))) for a, b, c in zip(ws, ws[1:], ws[2:])}
+    counts = [0] * 64
+    for h in features:
+        for i in range(64):
+            if h >> i & 1:
+                counts[i] += 1
+    return sum(1 << i for i in range(64) if counts[i] * 2 > len(features))
+
+
+if np is not None:
+    M1 = np.uint64(0xbf58476d1ce4e5b9)
+    M2 = np.uint64(0x94d049bb133111eb)
+
+    def mix_numpy(x):
+        x = (x ^ (x >> np.uint64(30))) * M1
+        x = (x ^ (x >> np.uint64(27))) * M2
+        return x ^ (x >> np.uint64(31))
+
+    def simhash_numpy(ws):
+        # mismo resultado que la version en Python, sobre arrays
+        w = np.array(ws, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            features = np.unique(mix_numpy(w[:-2] ^ mix_numpy(w[1:-1] ^ mix_numpy(w[2:]))))
+        # bits de cada feature, del menos significativo al mas significativo
+        bits = np.unpackbits(features.astype('<u8').view(np.uint8), bitorder='little').reshape(-1, 64)
+        majority = bits.sum(axis=0, dtype=np.int64) * 2 > len(features)
+        return int.from_bytes(np.packbits(majority, bitorder='little').tobytes(), 'little')
+
+
+class NearDuplicateIndex:
+    # Indice en memoria por bandas: el SimHash se parte en distance + 1
+    # bandas y, si dos SimHash difieren en a lo sumo `distance` bits, al
+    # menos una banda coincide exacta. Solo se comparan los SimHash que
+    # comparten alguna banda. Guarda a lo sumo `max_pages` paginas: pasado
+    # ese tamanio se olvida la que hace mas tiempo no se indexo ni se
+    # encontro como original (LRU). El tamanio queda en neardup/index_size.
+
+    def __init__(self, distance=3, stats=None, max_pages=200000):
+        self.distance = distance
+        self.stats = stats
+        self.max_pages = max_pages
+        self.bands = distance + 1
+        self.width = 64 // self.bands
+        self.buckets = [{} for _ in range(self.bands)]
+        # id -> (url, fingerprint), del menos al mas reciente
+        self.pages = OrderedDict()
+        self.next_id = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # el spider se crea antes que crawler.stats
+        settings = crawler.settings
+        index = cls(settings.getint('NEARDUP_DISTANCE', 3),
+            max_pages=settings.getint('NEARDUP_MAX_PAGES', 200000))
+        crawler.signals.connect(index.spider_opened, signal=signals.spider_opened)
+        return index
+
+    def spider_opened(self, spider):
+        self.stats = spider.crawler.stats
+
+    def __len__(self):
+        return len(self.pages)
+
+    def keys(self, fingerprint):
+        mask = (1 << self.width) - 1
+        return [(fingerprint >> (band * self.width)) & mask for band in range(self.bands)]
+
+    def check(self, url, fingerprint):
+        # url de la pagina casi igual ya vista, o None (y la pagina queda
+        # en el indice)
+        keys = self.keys(fingerprint)
+        seen = set()
+        for bucket, key in zip(self.buckets, keys):
+            for i in bucket.get(key, ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                original, other = self.pages[i]
+                if (other ^ fingerprint).bit_count() <= self.distance:
+                    self.pages.move_to_end(i)
+                    if self.stats is not None:
+                        self.stats.inc_value('neardup/duplicates')
+                    return original
+        i = self.next_id
+        self.next_id += 1
+        self.pages[i] = (url, fingerprint)
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, set()).add(i)
+        while len(self.pages) > self.max_pages:
+            self.evict()
+        if self.stats is not None:
+            self.stats.inc_value('neardup/indexed')
+            self.stats.set_value('neardup/index_size', len(self.pages))
+        return None
+
+    def evict(self):
+        i, (_, fingerprint) = self.pages.popitem(last=False)
+        for bucket, key in zip(self.buckets, self.keys(fingerprint)):
+            ids = bucket[key]
+            ids.discard(i)
+            if not ids:
+                del bucket[key]
+        if self.stats is not None:
+            self.stats.inc_value('neardup/evicted')
@@ -0,0 +1,44 @@
+import time
+
+
+class Batch:
+    # Buffer de operaciones pendientes de escritura. Se considera listo para
+    # enviar cuando junta max_docs operaciones, max_bytes bytes o cuando pasan
+    # interval segundos desde la primera operacion agregada.
+
+    def __init__(self, max_docs=500, max_bytes=5242880, interval=5):
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.ops = []
+        self.size = 0
+        self.started = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('PERSISTENCE_BATCH_SIZE', 500),
+            settings.getint('PERSISTENCE_BATCH_BYTES', 5242880),
+            settings.getfloat('PERSISTENCE_BATCH_INTERVAL', 5))
+
+    def __len__(self):
+        return len(self.ops)
+
+    def add(self, op, size=0):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.ops.append(op)
+        self.size += size
+
+    def is_due(self):
+        if not self.ops:
+            return False
+        return (len(self.ops) >= self.max_docs
+            or self.size >= self.max_bytes
+            or time.monotonic() - self.started >= self.interval)
+
+    def take(self):
+        ops = self.ops
+        self.ops = []
+        self.size = 0
+        self.started = None
+        return ops
@@ -0,0 +1,112 @@
+import gzip
+import logging
+import os
+import tempfile
+
+from ..items import PageItem
+from .types import Persistence
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    # Almacen de cuerpos de pagina direccionado por contenido. Cada cuerpo se
+    # guarda comprimido en <path>/ab/cd/<hash>.gz (o .zst), asi paginas
+    # identicas de distintos sitios ocupan un solo archivo.
+
+    EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, compression='gzip', level=6):
+        if compression not in self.EXTENSIONS:
+            raise ValueError('Compresion desconocida: {}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('BLOBSTORE_COMPRESSION = "zstd" requiere el paquete zstandard')
+        self.path = path
+        self.compression = compression
+        self.level = level
+        self.extension = self.EXTENSIONS[compression]
+        self.known = set()
+        self.written = 0
+        self.deduplicated = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('BLOBSTORE_DIR', 'bodies'),
+            settings.get('BLOBSTORE_COMPRESSION', 'gzip'),
+            settings.getint('BLOBSTORE_LEVEL', 6))
+
+    def path_for(self, key):
+        return os.path.join(self.path, key[:2], key[2:4], key + self.extension)
+
+    def __contains__(self, key):
+        return key in self.known or os.path.exists(self.path_for(key))
+
+    def put(self, key, data):
+        if key in self:
+            self.known.add(key)
+            self.deduplicated += 1
+            return False
+        path = self.path_for(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # se escribe a un temporal y se renombra para no dejar blobs truncados
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.compress(data))
+        os.replace(tmp, path)
+        self.known.add(key)
+        self.written += 1
+        return True
+
+    def get(self, key):
+        try:
+            with open(self.path_for(key), 'rb') as f:
+                return self.decompress(f.read())
+        except FileNotFoundError:
+            return None
+
+    def compress(self, data):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        if self.compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+
+class BlobStorePersistence(Persistence):
+    # Envuelve otra persistencia: guarda page.text en el BlobStore bajo su
+    # body_hash y le pasa al backend la pagina sin el texto. El registro de
+    # la pagina queda referenciando el cuerpo por body_hash.
+
+    def __init__(self, persistence, store):
+        self.persistence = persistence
+        self.store = store
+
+    def save(self, item):
+        page = item.page if isinstance(item, PageItem) else None
+        if page is not None and page.text is not None:
+            self.store.put(page.body_hash, page.text.encode('utf-8'))
+            page.text = None
+        return self.persistence.save(item)
+
+    def open(self):
+        self.persistence.open()
+
+    def close(self):
+        logger.info('Cuerpos de pagina: %d escritos, %d deduplicados',
+            self.store.written, self.store.deduplicated)
+        self.persistence.close()
+
+    def flush(self):
+        self.persistence.flush()
+
+    def flush_if_due(self):
+        self.persistence.flush_if_due()
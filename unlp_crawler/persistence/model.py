@@ -11,7 +11,7 @@ class Domain(Base):
     __tablename__ = 'domain'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     ip = Column(String)
     certificate_hash = Column(String)
     pages = relationship('Page', backref='domain', lazy='dynamic')
@@ -43,6 +43,7 @@ class Page(Base):
     headers = relationship('Header', backref='page', lazy='dynamic')
     certificates = relationship('Certificate', backref='page', lazy='dynamic')
     comments = relationship('Comment', backref='page', lazy='dynamic')
+    duplicates = relationship('Duplicate', backref='page', lazy='dynamic')
 
 
 class Javascript(Base):
@@ -94,7 +95,7 @@ class Certificate(Base):
     page_id = Column(Integer, ForeignKey('page.id'))
     issuer = Column(String)
     pubkey = Column(String)
-    certificate_hash = Column(String)
+    certificate_hash = Column(String, index=True)
 
 class Comment(Base):
     __tablename__ = 'comment'
@@ -102,3 +103,35 @@ class Comment(Base):
     id = Column(Integer, primary_key=True)
     page_id = Column(Integer, ForeignKey('page.id'))
     comment = Column(String)
+
+class Duplicate(Base):
+    # la pagina es casi igual a canonical_url (ver nearduplicates.py)
+    __tablename__ = 'duplicate'
+
+    id = Column(Integer, primary_key=True)
+    page_id = Column(Integer, ForeignKey('page.id'))
+    canonical_url = Column(String)
+    simhash = Column(String)
+
+class Resource(Base):
+    # respuesta filtrada por ResponseFilterMiddleware: solo tipo y tamano
+    __tablename__ = 'resource'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String)
+    status = Column(String)
+    content_type = Column(String)
+    size = Column(Integer)
+    reason = Column(String)
+    timestamp = Column(Integer)
+
+class Seen(Base):
+    __tablename__ = 'seen'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String)
+    status = Column(String)
+    body_hash = Column(String)
+    etag = Column(String)
+    last_modified = Column(String)
+    timestamp = Column(Integer)
@@ -1,145 +1,418 @@
 import pymongo
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from elasticsearch import Elasticsearch as ES
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import scan
 import logging
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm import scoped_session, sessionmaker
-from .model import Base, Domain, Page, Javascript, Css, Form, Header, Link, Certificate, Comment
+import glob
+import gzip
+import json
+import os
+import time
+import zlib
+from datetime import timezone
+from sqlalchemy import create_engine, event, func, insert, select
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from ..items import PageItem, ResourceItem, SeenItem
+from .batch import Batch
+from .model import Base, Domain, Page, Javascript, Css, Form, Header, Link, Certificate, Comment, Seen, Duplicate, Resource
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 class Persistence:
+    batch = None
+
     def save(self, item):
         raise NotImplementedError
 
+    def load_index(self):
+        # (url, etag, last_modified, body_hash, timestamp) de paginas y
+        # registros "seen" ya guardados, para el modo incremental
+        raise NotImplementedError
+
     def open(self):
         pass
 
     def close(self):
         pass
 
+    def flush(self):
+        pass
+
+    def flush_if_due(self):
+        if self.batch is not None and self.batch.is_due():
+            self.flush()
+
 class ElasticSearchPersistence(Persistence):
     es_logger = logging.getLogger('elasticsearch')
     es_logger.setLevel(logging.WARNING)
+    logger = logging.getLogger(__name__)
     ELASTICSEARCH_INDEX_PAGES = 'pages'
     ELASTICSEARCH_INDEX_CERTS = 'certificates'
     ELASTICSEARCH_TYPE_PAGES = 'page'
     ELASTICSEARCH_TYPE_CERTS = 'certificate'
+    ELASTICSEARCH_TYPE_SEEN = 'seen'
+    ELASTICSEARCH_TYPE_RESOURCE = 'resource'
 
     def __init__(self, settings):
         self.settings = settings
         uri = "{}:{}".format(self.settings['ELASTICSEARCH_SERVER'], self.settings['ELASTICSEARCH_PORT'])
         self.es = ES([uri])
+        self.batch = Batch.from_settings(settings)
+        self.errors = 0
     
     def save(self, item):
-        page = item['page']
-        cert = item['certificate']
-        self.es.index(index=f'{self.settings["ELASTICSEARCH_INDEX_PREFIX"]}-pages',
-            doc_type=self.ELASTICSEARCH_TYPE_PAGES,
-            id = item['id'],
-            body = dict(page))
-        if cert:
-            self.es.update(index=f'{self.settings["ELASTICSEARCH_INDEX_PREFIX"]}-certificates',
-                doc_type=self.ELASTICSEARCH_TYPE_CERTS,
-                id=cert['certificate_hash'],
-                body={'doc': dict(cert), 'doc_as_upsert': True})
-            # op_type='create')
+        if isinstance(item, SeenItem):
+            self.add_action({'index': {'_index': f'{self.settings["ELASTICSEARCH_INDEX_PREFIX"]}-seen',
+                    '_type': self.ELASTICSEARCH_TYPE_SEEN}},
+                item.to_dict())
+            if self.batch.is_due():
+                self.flush()
+            return item
+        if isinstance(item, ResourceItem):
+            self.add_action({'index': {'_index': f'{self.settings["ELASTICSEARCH_INDEX_PREFIX"]}-resources',
+                    '_type': self.ELASTICSEARCH_TYPE_RESOURCE}},
+                item.to_dict())
+            if self.batch.is_due():
+                self.flush()
+            return item
+        cert = item.certificate
+        self.add_action({'index': {'_index': f'{self.settings["ELASTICSEARCH_INDEX_PREFIX"]}-pages',
+                '_type': self.ELASTICSEARCH_TYPE_PAGES,
+                '_id': item.id}},
+            item.page.to_dict())
+        if cert is not None:
+            self.add_action({'update': {'_index': f'{self.settings["ELASTICSEARCH_INDEX_PREFIX"]}-certificates',
+                    '_type': self.ELASTICSEARCH_TYPE_CERTS,
+                    '_id': cert.certificate_hash}},
+                {'doc': cert.to_dict(), 'doc_as_upsert': True})
+        if self.batch.is_due():
+            self.flush()
         # raise DropItem('If you want to discard an item')
         return item
 
+    def add_action(self, action, source):
+        dumps = self.es.transport.serializer.dumps
+        op = dumps(action) + '\n' + dumps(source) + '\n'
+        self.batch.add(op, len(op))
+
+    def flush(self):
+        ops = self.batch.take()
+        if not ops:
+            return
+        try:
+            response = self.es.bulk(body=''.join(ops))
+        except TransportError as e:
+            # se conserva el lote para reintentarlo en el proximo flush
+            self.logger.error('Error enviando %d operaciones a elasticsearch: %s', len(ops), e)
+            for op in ops:
+                self.batch.add(op, len(op))
+            return
+        if not response.get('errors'):
+            return
+        for op, result in zip(ops, response['items']):
+            action, result = next(iter(result.items()))
+            if 'error' not in result:
+                continue
+            if result.get('status') == 429:
+                # elasticsearch esta saturado: se reintenta el documento
+                self.batch.add(op, len(op))
+                continue
+            self.errors += 1
+            self.logger.warning('Error en %s de %s/%s: %s', action, result.get('_index'),
+                result.get('_id'), result['error'])
+
+    def load_index(self):
+        prefix = self.settings["ELASTICSEARCH_INDEX_PREFIX"]
+        for hit in scan(self.es, index=f'{prefix}-pages', ignore_unavailable=True,
+                _source=['url', 'body_hash', 'timestamp', 'headers.Etag', 'headers.Last-Modified']):
+            page = hit['_source']
+            headers = page.get('headers') or {}
+            yield (page['url'], headers.get('Etag'), headers.get('Last-Modified'),
+                page.get('body_hash'), page.get('timestamp') or 0)
+        for hit in scan(self.es, index=f'{prefix}-seen', ignore_unavailable=True):
+            seen = hit['_source']
+            yield (seen['url'], seen.get('etag'), seen.get('last_modified'),
+                seen.get('body_hash'), seen.get('timestamp') or 0)
+
     def open(self):
         pass
 
     def close(self):
-        pass
+        self.flush()
+        if len(self.batch):
+            self.logger.error('Se descartan %d operaciones que no se pudieron enviar a elasticsearch', len(self.batch))
 
 
 class MongoDBPersistence(Persistence):
+    logger = logging.getLogger(__name__)
     COLLECTION_PAGE = 'unlp_page'
     COLLECTION_CERT = 'unlp_cert'
+    COLLECTION_SEEN = 'unlp_seen'
+    COLLECTION_RESOURCE = 'unlp_resource'
 
     def __init__(self, settings):
         self.settings = settings
         self.mongo_uri = "mongodb://{}:{}".format(self.settings['MONGO_SERVER'], self.settings['MONGO_PORT'])
         self.mongo_db = self.settings['MONGO_DATABASE']
+        self.batch = Batch.from_settings(settings)
+        self.certs = {}
+        self.written_certs = set()
 
     def open(self):
         self.client = pymongo.MongoClient(self.mongo_uri)
         self.db = self.client[self.mongo_db]
 
     def close(self):
+        self.flush()
+        if len(self.batch) or self.certs:
+            self.logger.error('Se descartan %d documentos y %d certificados que no se pudieron guardar en mongodb',
+                len(self.batch), len(self.certs))
         self.client.close()
 
     def save(self, item):
-        page = item['page']
-        page['page_id'] = item['id']
-        cert = item['certificate']
-        self.db[self.COLLECTION_PAGE].insert_one(dict(page))
-        if cert:
-            self.db[self.COLLECTION_CERT].replace_one({'certificate_hash': cert['certificate_hash']}, dict(cert), upsert=True)
+        if isinstance(item, (SeenItem, ResourceItem)):
+            collection = self.COLLECTION_SEEN if isinstance(item, SeenItem) else self.COLLECTION_RESOURCE
+            self.batch.add((collection, item.to_dict()))
+            if self.batch.is_due():
+                self.flush()
+            return item
+        page = item.page.to_dict()
+        page['page_id'] = item.id
+        cert = item.certificate
+        self.batch.add((self.COLLECTION_PAGE, page), len(page.get('text') or ''))
+        if cert is not None and cert.certificate_hash not in self.written_certs:
+            # el mismo certificado puede llegar de varios hosts: se escribe una vez
+            self.certs[cert.certificate_hash] = cert.to_dict()
+        if self.batch.is_due() or len(self.certs) >= self.batch.max_docs:
+            self.flush()
         return item
 
+    def flush(self):
+        docs = {}
+        for collection, doc in self.batch.take():
+            docs.setdefault(collection, []).append(doc)
+        for collection, pages in docs.items():
+            try:
+                self.db[collection].insert_many(pages, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                self.logger.warning('%d de %d documentos no se pudieron insertar en %s: %s', len(errors), len(pages),
+                    collection, errors[0]['errmsg'] if errors else e)
+            except PyMongoError as e:
+                self.logger.error('Error insertando %d documentos en %s: %s', len(pages), collection, e)
+                for page in pages:
+                    self.batch.add((collection, page), len(page.get('text') or ''))
+        if self.certs:
+            certs = self.certs
+            self.certs = {}
+            hashes = list(certs)
+            requests = [ReplaceOne({'certificate_hash': h}, certs[h], upsert=True) for h in hashes]
+            try:
+                self.db[self.COLLECTION_CERT].bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                failed = {hashes[err['index']] for err in e.details.get('writeErrors', [])}
+                self.written_certs.update(h for h in certs if h not in failed)
+                self.logger.warning('%d certificados no se pudieron guardar', len(failed))
+            except PyMongoError as e:
+                self.logger.error('Error guardando %d certificados en mongodb: %s', len(certs), e)
+                self.certs.update(certs)
+            else:
+                self.written_certs.update(certs)
+
+    def load_index(self):
+        fields = {'_id': 0, 'url': 1, 'body_hash': 1, 'timestamp': 1, 'headers.Etag': 1, 'headers.Last-Modified': 1}
+        for page in self.db[self.COLLECTION_PAGE].find({}, fields):
+            headers = page.get('headers') or {}
+            yield (page['url'], headers.get('Etag'), headers.get('Last-Modified'),
+                page.get('body_hash'), page.get('timestamp') or 0)
+        for seen in self.db[self.COLLECTION_SEEN].find({}, {'_id': 0}):
+            yield (seen['url'], seen.get('etag'), seen.get('last_modified'),
+                seen.get('body_hash'), seen.get('timestamp') or 0)
+
 
 class SQLAlchemyPersistence(Persistence):
+    logger = logging.getLogger(__name__)
 
     def __init__(self, settings):
         self.settings = settings
         Base.metadata.create_all(self.engine)
-        session_factory = sessionmaker(bind=self.engine)
-        self.Session = scoped_session(session_factory)
+        # create_all no agrega indices nuevos a tablas que ya existen
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+        self.batch = Batch.from_settings(settings)
+        # con la base bloqueada o caida se conservan a lo sumo max_pending
+        # items y no se reintenta hasta pasado PERSISTENCE_BATCH_INTERVAL
+        self.max_pending = settings.getint('PERSISTENCE_MAX_PENDING', 10000)
+        self.retry_at = 0
+        # netloc -> domain.id y certificate_hash -> certificate.id
+        self.domains = {}
+        self.certificates = {}
 
     def open(self):
-        self.session = self.Session()
+        pass
 
     def close(self):
-        self.session.close()
+        self.flush()
+        if len(self.batch):
+            self.logger.error('Se descartan %d items que no se pudieron guardar en la base', len(self.batch))
+        self.engine.dispose()
+
+    def size(self, item):
+        return len(item.page.text or '') if isinstance(item, PageItem) else 0
 
     def save(self, item):
-        ipage = item['page']
-        cert = item['certificate']
-        # convertir item en objetos de la base de datos
-        domain = Domain(name=ipage['netloc'],ip=ipage['ip'],certificate_hash=ipage['certificate_hash'])
-        page = Page(domain=domain,
-            url=ipage['url'],
-            text=ipage['text'],
-            title=ipage['title'],
-            status=ipage['status'],
-            body_hash=ipage['body_hash'],
-            scheme=ipage['scheme'],
-            netloc=ipage['netloc'],
-            hostname=ipage['hostname'],
-            path=ipage['path'],
-            port=ipage['port'],
-            params=ipage['params'],
-            query=ipage['query'],
-            fragment=ipage['fragment'],
-            filename=ipage['filename'])
-        for js in ipage['js']:
-            page.javascripts.append(Javascript(js_type=js['type'],src=js['src'],md5=js['md5']))
-        for css in ipage['css']:
-            page.csss.append(Css(rel=css['rel'],href=css['href'],md5=css['md5']))
-        for f in ipage['forms']:
-            try:
-                page.forms.append(Form(action=f['action'],method=f['method']))
-            except:
-                pass
-        for hn, hv in ipage['headers'].items():
-            page.headers.append(Header(name=hn,value=hv))
-        for l in ipage['links']:
-            page.links.append(Link(url=l))
-        for c in ipage['comments']:
-            page.comments.append(Comment(comment=c))
-
-        if cert:
-            page.certificate = Certificate(certificate_hash=cert['certificate_hash'],
-                issuer=cert['issuer'],
-                pubkey=cert['pubkey'])
-
-        domain.page = page
-
-        self.session.add(domain)
-        self.session.commit()
+        self.batch.add(item, self.size(item))
+        self.flush_if_due()
+        return item
+
+    def flush_if_due(self):
+        if self.batch.is_due() and time.monotonic() >= self.retry_at:
+            self.flush()
+
+    def flush(self):
+        items = self.batch.take()
+        if not items:
+            return
+        try:
+            self.write(items)
+            self.retry_at = 0
+        except OperationalError as e:
+            # base bloqueada o caida: se conserva el lote para el proximo flush
+            self.logger.error('Error guardando %d items: %s', len(items), e)
+            self.retry(items)
+        except SQLAlchemyError as e:
+            # alguna fila invalida: se reintenta de a un item y se descarta
+            # solo el que falla
+            self.logger.warning('Error guardando %d items, se guardan de a uno: %s', len(items), e)
+            for i, item in enumerate(items):
+                try:
+                    self.write([item])
+                except OperationalError as e:
+                    self.logger.error('Error guardando %d items: %s', len(items) - i, e)
+                    self.retry(items[i:])
+                    return
+                except SQLAlchemyError as e:
+                    url = item.page.url if isinstance(item, PageItem) else item.url
+                    self.logger.error('Se descarta %s: %s', url, e)
+
+    def retry(self, items):
+        self.retry_at = time.monotonic() + self.batch.interval
+        dropped = len(items) - self.max_pending
+        if dropped > 0:
+            self.logger.error('Se descartan %d items que no se pudieron guardar en la base', dropped)
+            items = items[dropped:]
+        for item in items:
+            self.batch.add(item, self.size(item))
+
+    def write(self, items):
+        domains = {}
+        certificates = {}
+        children = {Javascript: [], Css: [], Form: [], Header: [], Link: [], Comment: [], Seen: [], Duplicate: [], Resource: []}
+        with self.engine.begin() as conn:
+            for item in items:
+                if isinstance(item, SeenItem):
+                    children[Seen].append(item.to_dict())
+                    continue
+                if isinstance(item, ResourceItem):
+                    children[Resource].append(item.to_dict())
+                    continue
+                self.insert_page(conn, item, domains, certificates, children)
+            for model, rows in children.items():
+                if rows:
+                    conn.execute(insert(model), rows)
+        # los ids nuevos solo se cachean si la transaccion se confirmo
+        self.domains.update(domains)
+        self.certificates.update(certificates)
+
+    def insert_page(self, conn, item, domains, certificates, children):
+        ipage = item.page
+        cert = item.certificate
+        parts = ipage.url_parts()
+        # convertir item en filas de la base de datos
+        domain_id = self.domain_id(conn, ipage, parts['netloc'], domains)
+        page_id = conn.execute(insert(Page).values(domain_id=domain_id,
+            url=ipage.url,
+            text=ipage.text,
+            title=ipage.title,
+            status=ipage.status,
+            body_hash=ipage.body_hash,
+            **parts)).inserted_primary_key[0]
+        for js in ipage.js:
+            children[Javascript].append({'page_id': page_id, 'js_type': js.type, 'src': js.src, 'md5': js.md5})
+        for css in ipage.css:
+            children[Css].append({'page_id': page_id, 'rel': css.rel, 'href': css.href, 'md5': css.md5})
+        for f in ipage.forms:
+            f = dict(f)
+            if 'action' in f and 'method' in f:
+                children[Form].append({'page_id': page_id, 'action': f['action'], 'method': f['method']})
+        for hn, hv in ipage.headers:
+            children[Header].append({'page_id': page_id, 'name': hn, 'value': hv})
+        for l in ipage.links:
+            children[Link].append({'page_id': page_id, 'url': l})
+        for c in ipage.comments:
+            children[Comment].append({'page_id': page_id, 'comment': c})
+        if ipage.duplicate_of is not None:
+            children[Duplicate].append({'page_id': page_id, 'canonical_url': ipage.duplicate_of,
+                'simhash': '{:016x}'.format(ipage.simhash)})
+
+        if cert is not None:
+            self.certificate_id(conn, cert, page_id, certificates)
+
+    def load_index(self):
+        with self.engine.connect() as conn:
+            headers = {}
+            for page_id, name, value in conn.execute(select(Header.page_id, Header.name, Header.value)
+                    .where(Header.name.in_(['Etag', 'Last-Modified']))):
+                headers.setdefault(page_id, {})[name] = value
+            for page_id, url, body_hash, created in conn.execute(select(Page.id, Page.url, Page.body_hash, Page.created_time)):
+                h = headers.get(page_id, {})
+                ts = int(created.replace(tzinfo=timezone.utc).timestamp()) if created else 0
+                yield (url, h.get('Etag'), h.get('Last-Modified'), body_hash, ts)
+            for row in conn.execute(select(Seen.url, Seen.etag, Seen.last_modified, Seen.body_hash, Seen.timestamp)):
+                yield tuple(row)
+
+    def domain_id(self, conn, ipage, name, domains):
+        domain_id = self.domains.get(name) or domains.get(name)
+        if domain_id is None:
+            domain_id = conn.execute(select(Domain.id).where(Domain.name == name).limit(1)).scalar()
+        if domain_id is None:
+            domain_id = conn.execute(insert(Domain).values(name=name,
+                ip=ipage.ip,
+                certificate_hash=ipage.certificate_hash)).inserted_primary_key[0]
+        domains[name] = domain_id
+        return domain_id
+
+    def certificate_id(self, conn, cert, page_id, certificates):
+        cert_hash = cert.certificate_hash
+        cert_id = self.certificates.get(cert_hash) or certificates.get(cert_hash)
+        if cert_id is None:
+            cert_id = conn.execute(select(Certificate.id).where(Certificate.certificate_hash == cert_hash).limit(1)).scalar()
+        if cert_id is None:
+            cert_id = conn.execute(insert(Certificate).values(page_id=page_id,
+                certificate_hash=cert_hash,
+                issuer=cert.issuer,
+                pubkey=cert.pubkey)).inserted_primary_key[0]
+        certificates[cert_hash] = cert_id
+        return cert_id
+
+def sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL + synchronous=NORMAL: un fsync por checkpoint en lugar de uno por commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
 
 class SQLitePersistence(SQLAlchemyPersistence):
     def __init__(self, settings):
         self.engine = create_engine("sqlite:///{}".format(settings['SQLITE_DB']))
+        event.listen(self.engine, 'connect', sqlite_pragmas)
         super().__init__(settings)
 
 class MySQLPersistence(SQLAlchemyPersistence):
@@ -151,3 +424,237 @@ class PostgresPersistence(SQLAlchemyPersistence):
     def __init__(self, settings):
         self.engine = create_engine("postgres+psycopg2://{}:{}@{}/{}".format(settings['POSTGRES_USER'],settings['POSTGRES_PASSWORD'],settings['POSTGRES_SERVER'],settings['POSTGRES_DATABASE']))
         super().__init__(settings)
+
+
+
+class _ExportFile:
+    # archivo abierto de un tipo de registro y cuantas filas lleva
+
+    def __init__(self, handle, path):
+        self.handle = handle
+        self.path = path
+        self.rows = 0
+
+
+class FilePersistence(Persistence):
+    # Exporta a archivos en EXPORT_DIR, sin base de datos. Hay un archivo por
+    # tipo de registro (pages, seen, resources, certificates) y se rota cada
+    # EXPORT_ROWS_PER_FILE filas: <tipo>-<inicio>-<pid>-<n><extension>.
+    # Cada lote de Batch (PERSISTENCE_BATCH_*) se escribe de una vez. Los
+    # certificados se escriben una sola vez por hash, tambien entre corridas.
+    logger = logging.getLogger(__name__)
+    extension = None
+
+    def __init__(self, settings):
+        self.path = settings.get('EXPORT_DIR', 'export')
+        self.rows_per_file = settings.getint('EXPORT_ROWS_PER_FILE', 100000)
+        self.batch = Batch.from_settings(settings)
+        # con el pid: varios workers distribuidos pueden compartir EXPORT_DIR
+        self.run = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        self.files = {}
+        self.sequence = {}
+        self.certificates = set()
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        for cert in self.read('certificates'):
+            self.certificates.add(cert['certificate_hash'])
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            self.close_file(f)
+        self.files = {}
+
+    def save(self, item):
+        if isinstance(item, SeenItem):
+            self.batch.add(('seen', item.to_dict()))
+        elif isinstance(item, ResourceItem):
+            self.batch.add(('resources', item.to_dict()))
+        else:
+            # la fila se arma al escribir el lote (ver serialize)
+            self.batch.add(('pages', item), len(item.page.text or ''))
+            cert = item.certificate
+            if cert is not None and cert.certificate_hash not in self.certificates:
+                self.certificates.add(cert.certificate_hash)
+                self.batch.add(('certificates', cert.to_dict()))
+        if self.batch.is_due():
+            self.flush()
+        return item
+
+    def flush(self):
+        rows = {}
+        for kind, row in self.batch.take():
+            if kind == 'pages':
+                row = self.serialize(row)
+            rows.setdefault(kind, []).append(row)
+        for kind, records in rows.items():
+            while records:
+                f = self.files.get(kind)
+                if f is None or f.rows >= self.rows_per_file:
+                    if f is not None:
+                        self.close_file(f)
+                    f = self.files[kind] = self.next_file(kind)
+                chunk = records[:self.rows_per_file - f.rows]
+                records = records[len(chunk):]
+                self.write(f, kind, chunk)
+                f.rows += len(chunk)
+
+    def next_file(self, kind):
+        n = self.sequence[kind] = self.sequence.get(kind, 0) + 1
+        path = os.path.join(self.path, '{}-{}-{:05d}{}'.format(kind, self.run, n, self.extension))
+        return _ExportFile(self.open_file(path, kind), path)
+
+    def paths(self, kind):
+        return sorted(glob.glob(os.path.join(self.path, '{}-*{}'.format(kind, self.extension))))
+
+    def load_index(self):
+        for page in self.read('pages', ['url', 'body_hash', 'timestamp', 'headers']):
+            headers = dict(page.get('headers') or {})
+            yield (page['url'], headers.get('Etag'), headers.get('Last-Modified'),
+                page.get('body_hash'), page.get('timestamp') or 0)
+        for seen in self.read('seen'):
+            yield (seen['url'], seen.get('etag'), seen.get('last_modified'),
+                seen.get('body_hash'), seen.get('timestamp') or 0)
+
+    def serialize(self, item):
+        page = item.page.to_dict()
+        page['id'] = item.id
+        return page
+
+    def open_file(self, path, kind):
+        raise NotImplementedError
+
+    def write(self, f, kind, rows):
+        raise NotImplementedError
+
+    def close_file(self, f):
+        f.handle.close()
+
+    def read(self, kind, columns=None):
+        raise NotImplementedError
+
+
+class JsonLinesPersistence(FilePersistence):
+    # JSON por linea comprimido con gzip. Se hace flush del compresor en cada
+    # lote, asi el archivo se puede leer mientras el crawl sigue.
+    extension = '.jsonl.gz'
+
+    def open_file(self, path, kind):
+        return gzip.open(path, 'wt', encoding='utf-8')
+
+    def write(self, f, kind, rows):
+        f.handle.write(''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows))
+        f.handle.flush()
+
+    def read(self, kind, columns=None):
+        for path in self.paths(kind):
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        yield json.loads(line)
+            except (EOFError, OSError, zlib.error, ValueError) as e:
+                # archivo cortado por un crawl interrumpido
+                self.logger.warning('Se ignora el resto de %s: %s', path, e)
+
+
+def parquet_schemas():
+    string_map = pa.map_(pa.string(), pa.string())
+    return {
+        'pages': pa.schema([
+            ('id', pa.string()),
+            ('timestamp', pa.int64()),
+            ('url', pa.string()),
+            ('text', pa.string()),
+            ('title', pa.string()),
+            ('headers', string_map),
+            ('status', pa.int32()),
+            ('body_hash', pa.string()),
+            ('certificate_hash', pa.string()),
+            ('ip', pa.string()),
+            ('js', pa.list_(pa.struct([('type', pa.string()), ('src', pa.string()), ('md5', pa.string())]))),
+            ('css', pa.list_(pa.struct([('rel', pa.string()), ('href', pa.string()), ('md5', pa.string())]))),
+            ('scheme', pa.string()),
+            ('netloc', pa.string()),
+            ('hostname', pa.string()),
+            ('port', pa.int32()),
+            ('path', pa.string()),
+            ('params', pa.string()),
+            ('query', pa.string()),
+            ('fragment', pa.string()),
+            ('filename', pa.string()),
+            ('forms', pa.list_(string_map)),
+            ('comments', pa.list_(pa.string())),
+            ('links', pa.list_(pa.string())),
+            ('hostname_links', pa.list_(pa.string())),
+            ('simhash', pa.string()),
+            ('duplicate_of', pa.string()),
+        ]),
+        'seen': pa.schema([
+            ('timestamp', pa.int64()),
+            ('url', pa.string()),
+            ('status', pa.int32()),
+            ('body_hash', pa.string()),
+            ('etag', pa.string()),
+            ('last_modified', pa.string()),
+        ]),
+        'resources': pa.schema([
+            ('timestamp', pa.int64()),
+            ('url', pa.string()),
+            ('status', pa.int32()),
+            ('content_type', pa.string()),
+            ('size', pa.int64()),
+            ('reason', pa.string()),
+        ]),
+        'certificates': pa.schema([
+            ('timestamp', pa.int64()),
+            ('hostname', pa.string()),
+            ('port', pa.int32()),
+            ('pubkey', pa.string()),
+            ('issuer', pa.string()),
+            ('certificate_hash', pa.string()),
+        ]),
+    }
+
+
+class ParquetPersistence(FilePersistence):
+    # Parquet columnar: cada lote es un row group y js/css/forms/links quedan
+    # como columnas de listas. Un archivo se puede leer recien cuando se
+    # cierra (al rotar o al terminar el crawl).
+    extension = '.parquet'
+
+    def __init__(self, settings):
+        if pa is None:
+            raise ValueError('PERSISTENCE_TYPE = "parquet" requiere el paquete pyarrow')
+        super().__init__(settings)
+        self.compression = settings.get('EXPORT_PARQUET_COMPRESSION', 'zstd')
+        self.schemas = parquet_schemas()
+
+    def open_file(self, path, kind):
+        return pq.ParquetWriter(path, self.schemas[kind], compression=self.compression)
+
+    def serialize(self, item):
+        page = item.page.to_row()
+        page['id'] = item.id
+        return page
+
+    def write(self, f, kind, rows):
+        f.handle.write_table(pa.Table.from_pylist(rows, schema=self.schemas[kind]))
+
+    def read(self, kind, columns=None):
+        for path in self.paths(kind):
+            try:
+                for batch in pq.ParquetFile(path).iter_batches(columns=columns):
+                    yield from batch.to_pylist()
+            except (pa.ArrowInvalid, OSError) as e:
+                # sin footer: el crawl que lo escribia no termino
+                self.logger.warning('Se ignora %s: %s', path, e)
+
+
+PERSISTENCE_TYPES = {
+    'elasticsearch': ElasticSearchPersistence,
+    'mongodb': MongoDBPersistence,
+    'sqlite': SQLitePersistence,
+    'jsonl': JsonLinesPersistence,
+    'parquet': ParquetPersistence,
+}
@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from ..metrics import SIZE_BUCKETS, observe
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceWorker(threading.Thread):
+    # Hilo dedicado que ejecuta persistence.save() fuera del reactor. Los
+    # items entran por una cola acotada; los que no entran esperan en el
+    # reactor y su Deferred no se dispara hasta que se guardan, asi scrapy
+    # deja de procesar respuestas nuevas cuando la base se atrasa.
+
+    # cada cuanto se revisa si hay un lote vencido cuando no llegan items
+    IDLE_TIMEOUT = 1
+
+    def __init__(self, persistence, stats, queue_size=1000):
+        super().__init__(name='persistence-worker', daemon=True)
+        self.persistence = persistence
+        self.stats = stats
+        self.queue = queue.Queue(queue_size)
+        self.waiting = deque()
+        self.closing = False
+        self.closed = Deferred()
+
+    def put(self, item):
+        d = Deferred()
+        self.waiting.append((item, d))
+        self.feed()
+        return d
+
+    def close(self):
+        # None es la marca de fin: se encola despues de los items pendientes
+        self.closing = True
+        self.waiting.append(None)
+        self.feed()
+        return self.closed
+
+    def feed(self):
+        while self.waiting:
+            try:
+                self.queue.put_nowait(self.waiting[0])
+            except queue.Full:
+                break
+            self.waiting.popleft()
+        # la marca de fin no es un item; va siempre ultima, asi que si ya
+        # salio de la cola no queda nada
+        depth = max(0, self.queue.qsize() + len(self.waiting) - self.closing)
+        self.stats.set_value('persistence/queue_depth', depth)
+        observe(self.stats, 'persistence/queue_depth', depth, SIZE_BUCKETS)
+
+    def run(self):
+        from twisted.internet import reactor
+        while True:
+            try:
+                entry = self.queue.get(timeout=self.IDLE_TIMEOUT)
+            except queue.Empty:
+                result = self.call(self.persistence.flush_if_due)
+                if isinstance(result, Failure):
+                    logger.error('Error enviando lote pendiente: %s', result.getErrorMessage())
+                continue
+            if entry is None:
+                break
+            item, d = entry
+            start = time.monotonic()
+            result = self.call(self.persistence.save, item)
+            if not isinstance(result, Failure):
+                result = item
+            reactor.callFromThread(self.saved, d, result, time.monotonic() - start)
+        # el cierre envia el ultimo lote
+        start = time.monotonic()
+        result = self.call(self.persistence.close)
+        reactor.callFromThread(self.stats.set_value, 'persistence/close_time', time.monotonic() - start)
+        reactor.callFromThread(self.closed.callback, result)
+
+    def call(self, f, *args):
+        try:
+            return f(*args)
+        except Exception:
+            return Failure()
+
+    def saved(self, d, result, elapsed):
+        observe(self.stats, 'persistence/write_latency', elapsed)
+        self.feed()
+        d.callback(result)
@@ -4,22 +4,121 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 
-# useful for handling different item types with a single interface
-from itemadapter import ItemAdapter
-import pymongo
 from scrapy.utils.project import get_project_settings
-from elasticsearch import Elasticsearch as ES
+from scrapy import Request
+from scrapy.http import TextResponse
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_unicode
+from scrapy.exceptions import NotConfigured
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from urllib import parse
+import hashlib
+import time
 import uuid
 import logging
-from .persistence.types import ElasticSearchPersistence, MongoDBPersistence, SQLitePersistence
+from concurrent.futures.process import BrokenProcessPool
+from .analysis import ANALYSIS_EXECUTORS, InlineExecutor, analyze_each, fill_page, mark_duplicate, seen_item
+from .items import PageItem
+from .metrics import observe
+from .persistence.blobstore import BlobStore, BlobStorePersistence
+from .persistence.worker import PersistenceWorker
+from .persistence.types import PERSISTENCE_TYPES
 
 # class UnlpCrawlerPipeline:
 #     def process_item(self, item, spider):
 #         return item
 
+class AnalysisPipeline:
+    # Con ANALYSIS_EXECUTOR 'thread' o 'process' parse_item deja el analisis
+    # de la pagina (hash del cuerpo, links, css, js, formularios,
+    # comentarios) para aca, y se hace fuera del hilo del reactor. Las
+    # paginas se mandan de a ANALYSIS_CHUNK_SIZE (o lo que se junte en
+    # ANALYSIS_CHUNK_DELAY segundos). Si el pool falla se analizan en el
+    # reactor.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.backend = settings.get('EXTRACTOR_BACKEND', 'lxml')
+        self.chunk_size = settings.getint('ANALYSIS_CHUNK_SIZE', 8)
+        self.chunk_delay = settings.getfloat('ANALYSIS_CHUNK_DELAY', 0.05)
+        self.executor = ANALYSIS_EXECUTORS[settings.get('ANALYSIS_EXECUTOR')].from_settings(settings)
+        self.chunk = []
+        self.flush_call = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if crawler.settings.get('ANALYSIS_EXECUTOR', 'inline') == 'inline':
+            raise NotConfigured
+        return cls(crawler)
+
+    def close_spider(self, spider):
+        self.executor.close()
+
+    def process_item(self, item, spider):
+        if not isinstance(item, PageItem) or item.analysis is None:
+            return item
+        page = item.page
+        encoding, previous_body_hash, fingerprint = item.analysis
+        item.analysis = None
+        d = Deferred()
+        self.chunk.append(((page.url, page.text, encoding, previous_body_hash, fingerprint), d))
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(self.chunk_delay, self.flush)
+        d.addCallback(self.analyzed, item, spider)
+        return d
+
+    def flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        chunk, self.chunk = self.chunk, []
+        pages = [page for page, _ in chunk]
+        d = self.executor.run(self.backend, pages)
+        d.addErrback(self.failed, pages)
+        d.addCallback(self.done, chunk, time.monotonic())
+
+    def failed(self, failure, pages):
+        logging.warning('Analisis: fallo el executor (%s), se analiza en el reactor', failure.getErrorMessage())
+        if failure.check(BrokenProcessPool):
+            # un proceso murio (p. ej. por memoria): el pool no se recupera
+            self.executor.close()
+            self.executor = InlineExecutor()
+        self.stats.inc_value('analysis/fallback', len(pages))
+        return analyze_each(self.backend, pages)
+
+    def done(self, results, chunk, start):
+        observe(self.stats, 'analysis/latency', time.monotonic() - start)
+        self.stats.inc_value('analysis/chunks')
+        self.stats.inc_value('analysis/pages', len(chunk))
+        for (_, d), result in zip(chunk, results):
+            d.callback(result)
+
+    def analyzed(self, result, item, spider):
+        body_hash, fingerprint, data = result
+        page = item.page
+        if data is None:
+            if item.certificate is not None:
+                # el registro "seen" no lleva el certificado: que lo emita la
+                # proxima pagina del host
+                spider.certificates.forget(page.url)
+            return seen_item(page.url, page.status, page.headers, page.timestamp, body_hash)
+        if fingerprint is not None:
+            page.simhash = fingerprint
+            canonical = spider.near_duplicates.check(page.url, fingerprint)
+            if canonical is not None:
+                mark_duplicate(page, body_hash, canonical)
+                return item
+        fill_page(page, body_hash, data)
+        return item
+
 class PreparePipeline:
     def process_item(self, item, spider):
-        item['id'] = str(uuid.uuid4())
+        if isinstance(item, PageItem):
+            item.id = str(uuid.uuid4())
         return item
 
 # class CertificatePipeline:
@@ -31,26 +130,168 @@ class PreparePipeline:
         
 #         return item
 
+class AssetPipeline:
+    # Calcula el md5 de los css/js externos de cada pagina descargandolos con
+    # el downloader de scrapy (mismo pool de conexiones, concurrencia y
+    # DOWNLOAD_TIMEOUT). El item sigue hacia la persistencia recien cuando
+    # todos sus recursos estan resueltos. Los hashes se guardan en el cache
+    # configurado en ASSET_CACHE_CLASS.
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.cache = load_object(crawler.settings['ASSET_CACHE_CLASS']).from_crawler(crawler)
+        self.inflight = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def close_spider(self, spider):
+        self.cache.close()
+
+    def process_item(self, item, spider):
+        if not isinstance(item, PageItem):
+            return item
+        page = item.page
+        pending = {}
+        for css in page.css:
+            if not css.md5:
+                url = parse.urljoin(page.url, css.href)
+                pending.setdefault(url, []).append(css)
+        for js in page.js:
+            if js.src and not js.md5:
+                url = parse.urljoin(page.url, js.src)
+                if parse.urlparse(url).path.split('/')[-1].endswith('.js'):
+                    pending.setdefault(url, []).append(js)
+        if not pending:
+            return item
+        dfds = []
+        for url, entries in pending.items():
+            d = self.asset_md5(url)
+            d.addCallback(self.fill_md5, entries)
+            dfds.append(d)
+        start = time.monotonic()
+        d = DeferredList(dfds, consumeErrors=True)
+        d.addCallback(self.assets_done, item, start)
+        return d
+
+    def assets_done(self, _, item, start):
+        observe(self.stats, 'stage/assets', time.monotonic() - start)
+        return item
+
+    def fill_md5(self, md5, entries):
+        for e in entries:
+            e.md5 = md5
+
+    def asset_md5(self, url):
+        cached = self.cache.get(url)
+        if cached is not None and cached.fresh:
+            self.stats.inc_value('asset_cache/hit')
+            return succeed(cached.md5)
+        d = Deferred()
+        # varias paginas pueden pedir el mismo recurso a la vez (jquery,
+        # bootstrap, ...): se descarga una sola vez
+        if url in self.inflight:
+            self.inflight[url].append(d)
+            return d
+        self.inflight[url] = [d]
+        headers = {}
+        if cached is not None:
+            # recurso de una corrida anterior: se revalida con un request condicional
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        dl = self.crawler.engine.download(Request(url, headers=headers, meta={'dont_filter_response': True}))
+        dl.addCallbacks(self.asset_downloaded, self.asset_failed,
+            callbackArgs=(url, cached), errbackArgs=(url,))
+        return d
+
+    def asset_downloaded(self, response, url, cached):
+        if response.status == 304 and cached is not None:
+            self.stats.inc_value('asset_cache/revalidated')
+            self.cache.touch(url)
+            self.resolve(url, cached.md5)
+            return
+        if isinstance(response, TextResponse):
+            body = response.text.encode('utf-8')
+        else:
+            body = response.body
+        md5 = hashlib.md5(body).hexdigest()
+        self.stats.inc_value('asset_cache/miss')
+        self.cache.set(url, md5,
+            etag=to_unicode(response.headers.get('ETag') or b'') or None,
+            last_modified=to_unicode(response.headers.get('Last-Modified') or b'') or None)
+        self.resolve(url, md5)
+
+    def asset_failed(self, failure, url):
+        logging.getLogger(__name__).debug('Error descargando %s: %s', url, failure.getErrorMessage())
+        self.stats.inc_value('asset_cache/error')
+        self.resolve(url, '')
+
+    def resolve(self, url, md5):
+        for d in self.inflight.pop(url, []):
+            d.callback(md5)
+
+
 class PersistencePipeline:
+    # Con PERSISTENCE_THREADED el PersistenceWorker guarda los items y envia
+    # los lotes vencidos; sin el hilo save() corre en el reactor y un
+    # LoopingCall revisa cada FLUSH_CHECK_INTERVAL segundos si hay un lote
+    # vencido, para no dejarlo esperando al proximo item si el crawl se frena.
+
+    FLUSH_CHECK_INTERVAL = 1
 
-    def __init__(self):
-        self.settings = get_project_settings()
-        self.persistence_items = {
-            'elasticsearch': ElasticSearchPersistence,
-            'mongodb': MongoDBPersistence,
-            'sqlite': SQLitePersistence
-        }
+    def __init__(self, settings=None, stats=None):
+        self.settings = settings or get_project_settings()
+        self.stats = stats
+        self.persistence_items = PERSISTENCE_TYPES
         self.persistence_type = self.settings['PERSISTENCE_TYPE']
         self.persistence = self.persistence_items[self.persistence_type](self.settings)
+        if self.settings.getbool('BLOBSTORE_ENABLED'):
+            self.persistence = BlobStorePersistence(self.persistence, BlobStore.from_settings(self.settings))
+        self.worker = None
+        self.flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
 
     def process_item(self, item, spider):
+        if self.worker is not None:
+            return self.worker.put(item)
+        start = time.monotonic()
         self.persistence.save(item)
+        if self.stats is not None:
+            observe(self.stats, 'persistence/write_latency', time.monotonic() - start)
+        return item
 
     def open_spider(self, spider):
         self.persistence.open()
+        if self.settings.getbool('PERSISTENCE_THREADED') and self.stats is not None:
+            self.worker = PersistenceWorker(self.persistence, self.stats,
+                self.settings.getint('PERSISTENCE_QUEUE_SIZE', 1000))
+            self.worker.start()
+        else:
+            self.flush_loop = task.LoopingCall(self.flush_if_due)
+            self.flush_loop.start(self.FLUSH_CHECK_INTERVAL, now=False)
+
+    def flush_if_due(self):
+        try:
+            self.persistence.flush_if_due()
+        except Exception as e:
+            logging.getLogger(__name__).error('Error enviando lote pendiente: %s', e)
 
     def close_spider(self, spider):
+        if self.worker is not None:
+            return self.worker.close()
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        start = time.monotonic()
         self.persistence.close()
+        if self.stats is not None:
+            self.stats.set_value('persistence/close_time', time.monotonic() - start)
 
 
 # class ElasticSearchPipeline:
@@ -0,0 +1,118 @@
+import hashlib
+import math
+import re
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from scrapy import signals
+
+from .traps import url_template
+
+FORM = re.compile(rb'<form[\s>]', re.I)
+
+
+class LinkScorer:
+    # Prioridad de cada link segun lo que promete, en lugar del BFS puro:
+    #
+    #   new_host      el hostname todavia no aparecio en ningun link
+    #   new_section   primer link a ese directorio del host (/a/b/ de /a/b/c)
+    #   parent_forms  la pagina que tiene el link tiene formularios
+    #   depth         por cada nivel de profundidad (negativo)
+    #   pattern       por cada duplicacion de urls distintas con la misma
+    #                 plantilla en el host (log2, negativo): calendarios y
+    #                 listados. Un link repetido no cuenta de nuevo
+    #
+    # Los pesos son enteros y el resultado se acota a [min_priority,
+    # max_priority] y se lleva al piso de uno de `buckets` tramos iguales:
+    # cada prioridad distinta es una cola aparte por slot (un archivo SQLite
+    # con JOBDIR), asi que tienen que ser pocas.
+    #
+    # Hosts, secciones, plantillas y urls vistas se recuerdan en LRUs de a lo
+    # sumo `memory` entradas: lo olvidado vuelve a contar como nuevo.
+
+    WEIGHTS = {
+        'new_host': 50,
+        'new_section': 10,
+        'parent_forms': 10,
+        'depth': -2,
+        'pattern': -3,
+    }
+
+    def __init__(self, weights=None, min_priority=-50, max_priority=100, buckets=8, memory=100000):
+        self.weights = dict(self.WEIGHTS, **(weights or {}))
+        self.min_priority = min_priority
+        self.max_priority = max_priority
+        self.bucket_size = max(1, math.ceil((max_priority - min_priority + 1) / max(1, buckets)))
+        self.memory = memory
+        self.stats = None
+        self.hosts = OrderedDict()
+        self.sections = OrderedDict()
+        # plantilla -> urls distintas vistas
+        self.patterns = OrderedDict()
+        self.urls = OrderedDict()
+        # process_request se llama seguido para los links de una misma
+        # respuesta: se busca el formulario una sola vez
+        self.last_response = None
+        self.last_forms = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        scorer = cls(settings.getdict('SCORING_WEIGHTS'),
+            settings.getint('SCORING_MIN_PRIORITY', -50),
+            settings.getint('SCORING_MAX_PRIORITY', 100),
+            settings.getint('SCORING_BUCKETS', 8),
+            settings.getint('SCORING_MEMORY', 100000))
+        # el spider se crea antes que crawler.stats
+        crawler.signals.connect(scorer.spider_opened, signal=signals.spider_opened)
+        return scorer
+
+    def spider_opened(self, spider):
+        self.stats = spider.crawler.stats
+
+    def has_forms(self, response):
+        if response is not self.last_response:
+            self.last_response = response
+            self.last_forms = FORM.search(response.body) is not None
+        return self.last_forms
+
+    def remember(self, entries, key, value=True):
+        # guarda key como la mas reciente y devuelve el valor anterior
+        previous = entries.pop(key, None)
+        entries[key] = value
+        if len(entries) > self.memory:
+            entries.popitem(last=False)
+        return previous
+
+    def features(self, request, response):
+        u = urlsplit(request.url)
+        host = (u.hostname or '').lower()
+        section = (host, u.path.rsplit('/', 1)[0])
+        pattern = (host, url_template(request.url))
+        new_host = self.remember(self.hosts, host) is None
+        new_section = self.remember(self.sections, section) is None
+        known = self.patterns.get(pattern, 0)
+        if self.remember(self.urls, hashlib.md5(request.url.encode('utf-8')).digest()[:8]) is None:
+            repeats = known
+            known += 1
+        else:
+            repeats = max(0, known - 1)
+        self.remember(self.patterns, pattern, known)
+        return {
+            'new_host': int(new_host),
+            'new_section': int(new_section),
+            'parent_forms': int(self.has_forms(response)),
+            'depth': response.meta.get('depth', 0) + 1,
+            'pattern': int(math.log2(repeats + 1)),
+        }
+
+    def score(self, request, response):
+        features = self.features(request, response)
+        if self.stats is not None and features['new_host']:
+            self.stats.inc_value('scoring/new_hosts')
+        priority = sum(self.weights.get(k, 0) * v for k, v in features.items())
+        return self.quantize(priority)
+
+    def quantize(self, priority):
+        priority = max(self.min_priority, min(self.max_priority, priority))
+        return priority - (priority - self.min_priority) % self.bucket_size
@@ -47,18 +47,37 @@ ROBOTSTXT_OBEY = False
 #SPIDER_MIDDLEWARES = {
 #    'unlp_crawler.middlewares.UnlpCrawlerSpiderMiddleware': 543,
 #}
+SPIDER_MIDDLEWARES = {
+    # antes que HttpErrorMiddleware (50), ver FRONTERA PERSISTENTE
+    'unlp_crawler.frontier.FrontierSpiderMiddleware': 10,
+    'unlp_crawler.distributed.DistributedMiddleware': 450,
+    'unlp_crawler.traps.TrapMiddleware': 460,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #DOWNLOADER_MIDDLEWARES = {
 #    'unlp_crawler.middlewares.UnlpCrawlerDownloaderMiddleware': 543,
 #}
+DOWNLOADER_MIDDLEWARES = {
+    'unlp_crawler.frontier.FrontierDownloaderMiddleware': 50,
+    'unlp_crawler.middlewares.AdaptiveConcurrencyMiddleware': 550,
+    'unlp_crawler.middlewares.CanonicalOriginMiddleware': 570,
+    'unlp_crawler.middlewares.IncrementalMiddleware': 580,
+    # entre RedirectMiddleware (600) y HttpCompressionMiddleware (590)
+    'unlp_crawler.middlewares.ResponseFilterMiddleware': 595,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 #}
+EXTENSIONS = {
+    'unlp_crawler.distributed.DistributedExtension': 500,
+    'unlp_crawler.instrumentation.InstrumentationExtension': 510,
+    'unlp_crawler.logshipping.LogShippingExtension': 0,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -73,12 +92,14 @@ ROBOTSTXT_OBEY = False
 #     }
 
 ITEM_PIPELINES = {
+    'unlp_crawler.pipelines.AnalysisPipeline': 50,
     'unlp_crawler.pipelines.PreparePipeline': 100,
+    'unlp_crawler.pipelines.AssetPipeline': 200,
     'unlp_crawler.pipelines.PersistencePipeline': 300,
     }
 
 # Seleccionar el tipo de persistencia a utilizar
-# types: 'elasticsearch', 'mongodb', 'sqlite', 'mysql', 'postgresql'
+# types: 'elasticsearch', 'mongodb', 'sqlite', 'mysql', 'postgresql', 'jsonl', 'parquet'
 PERSISTENCE_TYPE = 'sqlite'
 
 ELASTICSEARCH_SERVER = 'localhost'
@@ -91,6 +112,84 @@ MONGO_DATABASE = 'unlp2'
 
 SQLITE_DB = 'unlp2.db'
 
+# 'jsonl' y 'parquet' escriben archivos en EXPORT_DIR (pages, seen y
+# certificates), rotados cada EXPORT_ROWS_PER_FILE filas. 'parquet' requiere
+# pyarrow; cada lote de escritura es un row group.
+EXPORT_DIR = 'export'
+EXPORT_ROWS_PER_FILE = 100000
+EXPORT_PARQUET_COMPRESSION = 'zstd'
+
+# Escrituras por lotes: se envia el lote al llegar a PERSISTENCE_BATCH_SIZE
+# documentos, PERSISTENCE_BATCH_BYTES bytes o PERSISTENCE_BATCH_INTERVAL
+# segundos. El ultimo lote se envia al cerrar el spider. Si la base SQL esta
+# bloqueada o caida el lote se reintenta cada PERSISTENCE_BATCH_INTERVAL
+# segundos y se conservan a lo sumo PERSISTENCE_MAX_PENDING items (se
+# descartan los mas viejos, con un error en el log).
+PERSISTENCE_BATCH_SIZE = 500
+PERSISTENCE_BATCH_BYTES = 5242880
+PERSISTENCE_BATCH_INTERVAL = 5
+PERSISTENCE_MAX_PENDING = 10000
+
+# Las escrituras se hacen en un hilo aparte. Si la cola de PERSISTENCE_QUEUE_SIZE
+# items se llena, scrapy frena el procesamiento de respuestas hasta que se libere.
+PERSISTENCE_THREADED = True
+PERSISTENCE_QUEUE_SIZE = 1000
+
+# Guardar el cuerpo de las paginas fuera de la base, comprimido y una sola vez
+# por contenido (BLOBSTORE_DIR/ab/cd/<body_hash>.gz). Las paginas se guardan
+# con text vacio y se referencian por body_hash.
+# types: 'gzip', 'zstd' (requiere zstandard)
+BLOBSTORE_ENABLED = False
+BLOBSTORE_DIR = 'bodies'
+BLOBSTORE_COMPRESSION = 'gzip'
+BLOBSTORE_LEVEL = 6
+
+# Recrawl incremental: carga de la persistencia las urls ya visitadas y guarda
+# solo un registro "seen" para las paginas que no cambiaron. Con
+# BLOBSTORE_ENABLED ademas envia requests condicionales (ETag/Last-Modified).
+INCREMENTAL_ENABLED = False
+
+# Filtro temprano de respuestas (ver ResponseFilterMiddleware): las urls con
+# extension de RESPONSE_FILTER_DENY_EXTENSIONS, los Content-Type fuera de
+# RESPONSE_FILTER_CONTENT_TYPES (vacio = todos) y los cuerpos de mas de
+# RESPONSE_FILTER_MAX_SIZE bytes (0 = sin limite) se cortan al llegar los
+# headers y se guarda solo un registro "resource" (url, tipo, tamano, status).
+RESPONSE_FILTER_ENABLED = True
+RESPONSE_FILTER_DENY_EXTENSIONS = ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'odt', 'ods', 'odp',
+    'zip', 'rar', '7z', 'gz', 'tar', 'jpg', 'jpeg', 'png', 'gif', 'svg', 'mp3', 'mp4', 'avi', 'mov', 'iso', 'exe']
+RESPONSE_FILTER_CONTENT_TYPES = ['text/html', 'application/xhtml+xml']
+RESPONSE_FILTER_MAX_SIZE = 5242880
+
+# Motor de extraccion de parse_item (ver unlp_crawler/extraction.py)
+# types: 'lxml' (una sola pasada sobre el arbol), 'selector' (extraccion original)
+EXTRACTOR_BACKEND = 'lxml'
+
+# Donde se analizan las paginas: 'inline' (en parse_item, hilo del reactor).
+# Opcionales, para crawls con CPU de sobra: 'thread' (threadpool del
+# reactor, ver REACTOR_THREADPOOL_MAXSIZE) o 'process' (ANALYSIS_WORKERS
+# procesos; 0 = uno por CPU).
+ANALYSIS_EXECUTOR = 'inline'
+ANALYSIS_WORKERS = 0
+ANALYSIS_CHUNK_SIZE = 8
+ANALYSIS_CHUNK_DELAY = 0.05
+
+# Paginas casi iguales (ver unlp_crawler/nearduplicates.py): si el SimHash
+# del texto difiere en a lo sumo NEARDUP_DISTANCE bits del de una pagina ya
+# vista se guarda solo la referencia (duplicate_of). Con NEARDUP_FOLLOW_LINKS
+# en False tampoco se siguen sus links (calendarios, listados infinitos).
+# El indice recuerda a lo sumo NEARDUP_MAX_PAGES paginas (unos 700 bytes por
+# pagina); pasado ese tamanio olvida las menos recientes.
+NEARDUP_ENABLED = True
+NEARDUP_DISTANCE = 3
+NEARDUP_FOLLOW_LINKS = True
+NEARDUP_MAX_PAGES = 200000
+
+# Cache de hashes de css/js (ver unlp_crawler/cache.py). Con ASSET_CACHE_DB
+# en None el cache vive solo en memoria durante la corrida.
+ASSET_CACHE_CLASS = 'unlp_crawler.cache.AssetHashCache'
+ASSET_CACHE_SIZE = 10000
+ASSET_CACHE_DB = 'assets.db'
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -136,25 +235,21 @@ root_logger.addHandler(rotating_file_log)
 # logging.getLogger('chardet.charsetprober').setLevel(logging.INFO)
 
 
-import logstash
-
-host = 'localhost'
-
-test_logger = logging.getLogger()
-test_logger.setLevel(logging.INFO)
-h = logstash.TCPLogstashHandler(host, 5000, version=1)
-h.setLevel(logging.INFO)
-test_logger.addHandler(h)
-
-test_logger.error('python-logstash: test logstash error message.')
-test_logger.info('python-logstash: test logstash info message.')
-test_logger.warning('python-logstash: test logstash warning message.')
-
-offsite_logger = logging.getLogger('scrapy.spidermiddlewares.offsite')
-offsite_logger.setLevel(logging.DEBUG)
-offsite_h = logstash.TCPLogstashHandler(host, 5000, version=1)
-offsite_h.setLevel(logging.DEBUG)
-offsite_logger.addHandler(offsite_h)
+# Los logs se mandan tambien a Logstash (elastic-cluster/docker-compose.yml)
+# desde un hilo aparte, en lotes y con un buffer acotado: si Logstash esta
+# lento o caido se descartan los registros mas viejos (ver
+# unlp_crawler/logshipping.py). LOGSTASH_LOGGERS fija niveles por logger.
+LOGSTASH_ENABLED = True
+LOGSTASH_HOST = 'localhost'
+LOGSTASH_PORT = 5000
+LOGSTASH_LEVEL = 'INFO'
+LOGSTASH_LOGGERS = {
+    'scrapy.spidermiddlewares.offsite': 'DEBUG',
+}
+LOGSTASH_BUFFER = 10000
+LOGSTASH_BATCH = 500
+LOGSTASH_FLUSH_INTERVAL = 1
+LOGSTASH_RECONNECT_DELAY = 5
 
 
 
@@ -168,7 +263,8 @@ LOG_FILE = 'unlp.log'
 ##### BROAD CRAWLING #####
 
 # Scrapy’s default scheduler priority queue is 'scrapy.pqueues.ScrapyPriorityQueue'. It works best during single-domain crawl. It does not work well with crawling many different domains in parallel
-SCHEDULER_PRIORITY_QUEUE = 'scrapy.pqueues.DownloaderAwarePriorityQueue'
+# Igual, pero con un heap de prioridades por slot (ver unlp_crawler/frontier.py)
+SCHEDULER_PRIORITY_QUEUE = 'unlp_crawler.frontier.HeapDownloaderAwarePriorityQueue'
 
 # The default global concurrency limit in Scrapy is not suitable for crawling many different domains in parallel, so you will want to increase it. How much to increase it will depend on how much CPU and memory you crawler will have available.
 # But the best way to find out is by doing some trials and identifying at what concurrency your Scrapy process gets CPU bounded. For optimum performance, you should pick a concurrency where CPU usage is at 80-90%.
@@ -186,12 +282,52 @@ COOKIES_ENABLED = False
 # Retrying failed HTTP requests can slow down the crawls substantially, specially when sites causes are very slow (or fail) to respond, thus causing a timeout error which gets retried many times, unnecessarily, preventing crawler capacity to be reused for other domains.
 RETRY_ENABLED = False
 
+# En lugar del RetryMiddleware se usa AdaptiveConcurrencyMiddleware: ajusta la
+# concurrencia y el delay de cada host segun su latencia y sus errores, y
+# reintenta solo mientras el host tenga presupuesto de reintentos.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 16
+ADAPTIVE_TARGET_LATENCY = 2
+ADAPTIVE_BACKOFF_DELAY = 1
+ADAPTIVE_MAX_DELAY = 30
+ADAPTIVE_RETRY_TIMES = 2
+ADAPTIVE_RETRY_BUDGET = 20
+
 # Unless you are crawling from a very slow connection (which shouldn’t be the case for broad crawls) reduce the download timeout so that stuck requests are discarded quickly and free up capacity to process the next ones.
 DOWNLOAD_TIMEOUT = 15
 
+# Perfil de descarga (ver unlp_crawler/download.py): conexiones persistentes
+# por host (a lo sumo DOWNLOAD_POOL_MAX_PER_HOST ociosas, cerradas tras
+# DOWNLOAD_POOL_IDLE_TIMEOUT segundos), HTTP/2 opcional con los hosts https
+# que lo negocian (DOWNLOAD_HTTP2_ENABLED = True requiere h2: pip install
+# Twisted[http2]; el resto sigue por HTTP/1.1) y reanudacion de sesiones TLS
+# para los ultimos DOWNLOAD_TLS_SESSION_CACHE hosts. En los stats quedan los
+# tiempos de conexion, handshake y transferencia; con DOWNLOAD_PROFILE_FILE
+# se guarda el reporte por host en JSON.
+DOWNLOAD_HANDLERS = {
+    'http': 'unlp_crawler.download.AdaptiveDownloadHandler',
+    'https': 'unlp_crawler.download.AdaptiveDownloadHandler',
+}
+DOWNLOADER_CLIENTCONTEXTFACTORY = 'unlp_crawler.download.ResumingContextFactory'
+DOWNLOAD_POOL_MAX_PER_HOST = 16
+DOWNLOAD_POOL_IDLE_TIMEOUT = 30
+DOWNLOAD_HTTP2_ENABLED = False
+DOWNLOAD_TLS_SESSION_CACHE = 10000
+DOWNLOAD_PROFILE_FILE = None
+
+# HttpCompressionMiddleware pide gzip y deflate siempre, y br si esta
+# instalado brotli
+COMPRESSION_ENABLED = True
+
 # Consider disabling redirects, unless you are interested in following them. When doing broad crawls it’s common to save redirects and resolve them when revisiting the site at a later crawl. This also help to keep the number of request constant per crawl batch, otherwise redirect loops may cause the crawler to dedicate too many resources on any specific domain.
 # REDIRECT_ENABLED = False
 
+# Los dominios se piden primero por https y http solo si https falla; los
+# alias de un mismo sitio (http/https, www, redirects que mantienen la ruta) se
+# aprenden de las respuestas y los links se reescriben al origen canonico.
+CANONICAL_ENABLED = True
+
 # Some pages (up to 1%, based on empirical data from year 2013) declare themselves as ajax crawlable. This means they provide plain HTML version of content that is usually available only via AJAX. Pages can indicate it in two ways:
     # by using #! in URL - this is the default way;
     # by using a special meta tag - this way is used on “main”, “index” website pages.
@@ -199,9 +335,99 @@ AJAXCRAWL_ENABLED = True
 
 
 
-##### breadth-first-search (BFS) CRAWLING #####
-
-DEPTH_PRIORITY = 1
-SCHEDULER_DISK_QUEUE = 'scrapy.squeues.PickleFifoDiskQueue'
+##### PRIORIDAD POR PUNTAJE #####
+
+# En lugar del BFS puro (DEPTH_PRIORITY = 1) cada link recibe una prioridad
+# segun hostname nuevo, seccion nueva del sitio, formularios en la pagina
+# padre, profundidad y frecuencia de su plantilla de url (ver
+# unlp_crawler/scoring.py). La profundidad ya entra en el puntaje; con
+# SCORING_ENABLED = False volver a DEPTH_PRIORITY = 1 para tener BFS.
+# SCORING_WEIGHTS pisa los pesos de LinkScorer.WEIGHTS. El puntaje se
+# redondea a SCORING_BUCKETS tramos: cada prioridad distinta es una cola (y
+# un archivo SQLite con JOBDIR) por slot. SCORING_MEMORY acota los hosts,
+# secciones, plantillas y urls que recuerda el puntaje.
+DEPTH_PRIORITY = 0
+SCORING_ENABLED = True
+SCORING_CLASS = 'unlp_crawler.scoring.LinkScorer'
+SCORING_WEIGHTS = {}
+SCORING_MIN_PRIORITY = -50
+SCORING_MAX_PRIORITY = 100
+SCORING_BUCKETS = 8
+SCORING_MEMORY = 100000
+SCHEDULER_DISK_QUEUE = 'unlp_crawler.frontier.PickleFifoSqliteQueue'
 SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
 
+# Trampas (ver unlp_crawler/traps.py): calendarios, segmentos repetidos y
+# busquedas facetadas. Por host se admiten a lo sumo TRAP_PATTERN_BUDGET urls
+# distintas de cada plantilla (/calendario/{n}/{n}) y TRAP_MAX_PATTERNS
+# plantillas; el resto se baja TRAP_PRIORITY_PENALTY de prioridad
+# (TRAP_ACTION = 'deprioritize') o se descarta ('drop'). Las rutas de mas de
+# TRAP_MAX_SEGMENTS segmentos o con segmentos repetidos se descartan siempre.
+# Con TRAP_REPORT_FILE se guarda en JSON lo podado por host.
+TRAP_ENABLED = True
+TRAP_PATTERN_BUDGET = 500
+TRAP_MAX_PATTERNS = 1000
+TRAP_MAX_SEGMENTS = 12
+TRAP_MAX_SEGMENT_REPEAT = 3
+TRAP_ACTION = 'deprioritize'
+TRAP_PRIORITY_PENALTY = 100
+TRAP_REPORT_FILE = None
+
+
+
+##### FRONTERA PERSISTENTE #####
+
+# Para poder reanudar un crawl interrumpido (incluso con kill -9) hay que
+# correrlo con JOBDIR: scrapy crawl unlp -s JOBDIR=crawls/unlp
+# La cola de disco es SQLite y el dupefilter guarda los fingerprints en
+# JOBDIR/fingerprints.db, con un filtro de Bloom en memoria de a lo sumo
+# FRONTIER_MEMORY_LIMIT bytes. Los requests en descarga, en el spider o en
+# los pipelines al momento del corte se vuelven a encolar al reanudar; los
+# items de un lote de persistencia sin enviar se pierden salvo con
+# PERSISTENCE_BATCH_SIZE = 1.
+SCHEDULER = 'unlp_crawler.frontier.FrontierScheduler'
+DUPEFILTER_CLASS = 'unlp_crawler.frontier.FrontierDupeFilter'
+FRONTIER_BLOOM_CAPACITY = 10000000
+FRONTIER_BLOOM_ERROR_RATE = 0.001
+FRONTIER_MEMORY_LIMIT = 33554432
+
+
+
+
+##### MODO DISTRIBUIDO #####
+
+# Varios workers reparten los hosts por hash y se pasan los requests a hosts
+# ajenos a traves de un coordinador (ver unlp_crawler/distributed.py):
+# scrapy crawl unlp -s DISTRIBUTED_ENABLED=1 -s DISTRIBUTED_WORKER_INDEX=0 -s DISTRIBUTED_RUN_ID=2024-05-01 -s JOBDIR=crawls/unlp-0
+# DISTRIBUTED_RUN_ID identifica la corrida y es el mismo en todos los
+# workers: repetirlo reanuda la corrida, uno nuevo empieza de cero.
+DISTRIBUTED_ENABLED = False
+DISTRIBUTED_RUN_ID = None
+DISTRIBUTED_WORKERS = 4
+DISTRIBUTED_WORKER_INDEX = 0
+DISTRIBUTED_BACKEND = 'sqlite'
+DISTRIBUTED_PATH = 'frontier.db'
+DISTRIBUTED_REDIS_URL = 'redis://localhost:6379/0'
+DISTRIBUTED_POLL_INTERVAL = 1
+DISTRIBUTED_BATCH = 100
+
+
+
+
+##### INSTRUMENTACION #####
+
+# Tiempos por etapa (descarga, parse, links, analisis, css/js, escritura) en
+# los stats y en una linea del log cada INSTRUMENTATION_LOG_INTERVAL segundos.
+# Con INSTRUMENTATION_PROMETHEUS_FILE se escriben los stats para el textfile
+# collector de node_exporter; con INSTRUMENTATION_PROMETHEUS_PORT se sirven en
+# http://localhost:<puerto>/metrics.
+INSTRUMENTATION_ENABLED = True
+INSTRUMENTATION_LOG_INTERVAL = 60
+INSTRUMENTATION_PROMETHEUS_FILE = None
+INSTRUMENTATION_PROMETHEUS_PORT = None
+# Perfila parse_item (con ANALYSIS_EXECUTOR = 'inline' incluye la extraccion)
+# y guarda en INSTRUMENTATION_PROFILE_DIR el perfil de las
+# N paginas mas lentas ('cprofile' o 'pyinstrument'). 0 lo desactiva.
+INSTRUMENTATION_PROFILE_SLOWEST = 0
+INSTRUMENTATION_PROFILER = 'cprofile'
+INSTRUMENTATION_PROFILE_DIR = 'profiles'
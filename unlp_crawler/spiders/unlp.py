@@ -1,56 +1,26 @@
-import re
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
-from scrapy.selector import Selector
+from scrapy.utils.misc import load_object
 from scrapy import Request
-import scrapy
+from scrapy.http import TextResponse
 from w3lib.url import url_query_cleaner
 import hashlib
-import requests
 from urllib import parse
-import os
+import sys
 import time
-from bs4 import BeautifulSoup
+from ..analysis import fill_page, mark_duplicate, seen_item
+from ..canonical import OriginMap
+from ..certificates import CertificateTracker
+from ..extraction import EXTRACTORS
+from ..items import Page, PageItem, ResourceItem
+from ..metrics import timed
+from ..nearduplicates import NearDuplicateIndex, simhash
 
-# import logging
-# import sys
-# from python_elastic_logstash import ElasticHandler, ElasticFormatter
-
-
-
-# """
-# Provide logger name simple without any special character
-# Logger name will become as Elastic Search Index
-# """
-# root_logger = logging.getLogger(scrapy.core.downloader.tls)
-# root_logger.setLevel(logging.DEBUG)
-
-# elasticsearch_endpoint = 'http://localhost:9200' # No trailing slash
-
-# elastic_handler = ElasticHandler(elasticsearch_endpoint, 'dev')  # Second argument is optional
-# elastic_handler.setFormatter(ElasticFormatter())
-
-# root_logger.addHandler(elastic_handler)
-
-# # Extra is optional.
-# extra = {
-#     'elastic_fields': {
-#         'version': 'python version: ' + repr(sys.version_info)
-#     }
-# }
-
-# root_logger.debug("Python elastic logstash configured", extra=extra)
-
-
-def process_links(links):
-    for link in links:
-        link.url = url_query_cleaner(link.url)
-        yield link
 
 class UNLPCrawler(CrawlSpider):
-    js_resources = {}
-    css_resources = {}
     name = 'unlp'
+    # lo asigna InstrumentationExtension con INSTRUMENTATION_PROFILE_SLOWEST
+    profiler = None
     allowed_domains = ['unlp.edu.ar']
     # start_urls = ['https://unlp.edu.ar/']
     with open('domains', 'r') as f:
@@ -65,134 +35,130 @@ class UNLPCrawler(CrawlSpider):
                     # re.escape('https://www.imdb.com/whitelist-offsite'),
                 ],
             ),
-            process_links=process_links,
+            process_links='process_links',
+            process_request='process_request',
             callback='parse_item',
             follow=True
         ),
     )
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.extractor = EXTRACTORS[crawler.settings.get('EXTRACTOR_BACKEND', 'lxml')]()
+        # fuera de 'inline' el analisis lo hace AnalysisPipeline
+        spider.offload = crawler.settings.get('ANALYSIS_EXECUTOR', 'inline') != 'inline'
+        spider.canonical = crawler.settings.getbool('CANONICAL_ENABLED')
+        spider.origins = OriginMap()
+        spider.certificates = CertificateTracker.from_crawler(crawler)
+        spider.near_duplicates = None
+        if crawler.settings.getbool('NEARDUP_ENABLED'):
+            spider.near_duplicates = NearDuplicateIndex.from_crawler(crawler)
+        spider.follow_near_duplicates = crawler.settings.getbool('NEARDUP_FOLLOW_LINKS', True)
+        spider.scorer = None
+        if crawler.settings.getbool('SCORING_ENABLED'):
+            spider.scorer = load_object(crawler.settings['SCORING_CLASS']).from_crawler(crawler)
+        return spider
+
+    def start_requests(self):
+        if not self.canonical:
+            yield from super().start_requests()
+            return
+        # primero https; http solo si https falla. CanonicalOriginMiddleware
+        # aprende el alias con la primera respuesta
+        for d in self.domains:
+            if d:
+                yield Request('https://' + d, dont_filter=True, errback=self.start_failed,
+                    meta={'canonical_alternative': 'http://' + d})
+
+    def start_failed(self, failure):
+        url = failure.request.meta.get('canonical_alternative')
+        if url:
+            self.logger.info('Sin https, se usa %s', url)
+            yield Request(url, dont_filter=True)
+
+    def process_links(self, links):
+        for link in links:
+            link.url = self.origins.rewrite(url_query_cleaner(link.url))
+            yield link
+
+    def process_request(self, request, response):
+        # prioridad segun el puntaje del link (ver unlp_crawler/scoring.py)
+        if self.scorer is not None:
+            request.priority = self.scorer.score(request, response)
+        return request
+
+    def _requests_to_follow(self, response):
+        if response.meta.get('near_duplicate'):
+            self.crawler.stats.inc_value('neardup/links_skipped')
+            return []
+        with timed(self.crawler.stats, 'stage/links'):
+            requests = list(super()._requests_to_follow(response))
+        return requests
+
     def parse_item(self, response):
-        u = parse.urlparse(response.url)
-        f = os.path.basename(u.path)
-        h = {k.decode(): v[0].decode() for k, v in response.headers.items()}
-
-        extractor = LinkExtractor()
-        links = [l.url for l in extractor.extract_links(response)]
-        hostname_links = list(set([parse.urlparse(l.url).hostname for l in extractor.extract_links(response)]))
-
-        sel = Selector(response)
-        css = self.extract_css(response.url, sel)
-        js = self.extract_js(response.url, sel)
-        form = self.extract_form(response.url, sel)
-        comments = sel.xpath('//comment()').extract()
-        comments = list(set([c.replace('<!--', '').replace('-->', '').strip() for c in comments]))
-        ts = int(time.time())
-        if response.certificate:
-            cert_hash = response.certificate.digest().decode().replace(':','').lower()
-            certificate = {
-                'timestamp': ts,
-                'hostname': u.hostname,
-                'port': u.port,
-                'pubkey': str(response.certificate.dumpPEM()),
-                'issuer': str(response.certificate.inspect()),
-                'certificate_hash': cert_hash
-                }
-        else:
-            cert_hash = ''
-            certificate = {}
-        
-        item = { 
-                'page': {
-                    'timestamp': ts,
-                    'url': response.url,
-                    'text': response.text,
-                    'title': response.xpath('//title/text()').get(),
-                    'headers': h,
-                    'status': response.status,
-                    'body_hash': hashlib.md5(response.text.encode('utf-8')).hexdigest(),
-                    'certificate_hash': cert_hash,
-                    'ip': str(response.ip_address),
-                    'js': js,
-                    'css': css,
-                    'scheme': u.scheme,
-                    'netloc': u.netloc,
-                    'hostname': u.hostname,
-                    'port': u.port,
-                    'path': u.path,
-                    'params': u.params,
-                    'query': u.query,
-                    'fragment': u.fragment,
-                    'filename': f,
-                    'forms': form,
-                    'comments': comments,
-                    'links': links,
-                    'hostname_links': hostname_links
-                    },
-                'certificate': certificate
-            }
+        with timed(self.crawler.stats, 'stage/parse', self.profiler, response.url):
+            return self.build_item(response)
 
+    def build_item(self, response):
+        if 'response_filter' in response.meta or not isinstance(response, TextResponse):
+            return self.resource_item(response)
+        h = tuple((sys.intern(k.decode()), v[0].decode()) for k, v in response.headers.items())
+        ts = int(time.time())
+        previous_body_hash = response.meta.get('previous_body_hash')
+
+        if self.offload:
+            item = self.page_item(response, h, ts)
+            fingerprint = self.near_duplicates is not None
+            if fingerprint and not self.follow_near_duplicates:
+                # hay que saberlo antes de seguir los links, no se puede
+                # esperar al analisis
+                fingerprint = False
+                if self.near_duplicate(response, item.page, None):
+                    return item
+            item.analysis = (response.encoding, previous_body_hash, fingerprint)
+            return item
+
+        body_hash = hashlib.md5(response.text.encode('utf-8')).hexdigest()
+
+        # modo incremental: la pagina no cambio desde la corrida anterior
+        if previous_body_hash == body_hash:
+            return seen_item(response.url, response.status, h, ts, body_hash)
+
+        item = self.page_item(response, h, ts)
+        if self.near_duplicates is not None and self.near_duplicate(response, item.page, body_hash):
+            return item
+        fill_page(item.page, body_hash, self.extractor.extract(response))
         return item
-    
-    def md5(self, data):
-        return hashlib.md5(data.encode('utf-8')).hexdigest()
-
-
-    def extract_css(self, base_url, sel):
-        css = sel.xpath('//link')
-        items = []
-        for c in css:
-            href = (c.xpath('@href').extract() or [None])[0]
-            rel = (c.xpath('@rel').extract() or [None])[0]
-            if rel == 'stylesheet' and href:
-                url = parse.urljoin(base_url, href)
-                md5 = self.css_resources.get(url, '')
-                if not md5:
-                    x = requests.get(url=url).text
-                    md5 = self.md5(x)
-                    self.css_resources[url] = md5
-                # else:
-                #     print('css already in cache')
-                items.append({'rel': rel, 'href': href, 'md5': md5})
-        return items
-
-
-    def extract_js(self, base_url, sel):
-        js = sel.xpath('//script')
-        items = []
-        for j in js:
-            src = (j.xpath('@src').extract() or [''])[0]
-            jtype = (j.xpath('@type').extract() or [''])[0]
-            url = ''
-            md5 = ''
-            if src:
-                url = parse.urljoin(base_url, src)
-                md5 = self.js_resources.get(url, '')
-                if not md5:
-                    u = parse.urlparse(url)
-                    f = u.path.split('/')[-1]
-                    if f.endswith('.js'):
-                        x = requests.get(url=url).text
-                        md5 = self.md5(x)
-                        self.js_resources[url] = md5
-                # else:
-                #     print('js already in cache')
-            else:
-                md5 = self.md5(j.extract())
-            data = {'type': jtype, 'src': src, 'md5': md5}
-            items.append(data)
-        return items
-
-
-    def extract_form(self, base_url, sel):
-        form = sel.xpath('//form')
-        items = []
-        for f in form:
-            soup = BeautifulSoup(f.extract(), 'html.parser')
-            attrs = soup.form.attrs
-            attrs.pop('class', None)
-            inputs = (f.xpath('input/@name').extract() or [''])[0]
-            
-            attrs['inputs'] = inputs
-            items.append(attrs)
-        return items
 
+    def near_duplicate(self, response, page, body_hash):
+        # True si la pagina es casi igual a otra ya vista: queda solo la
+        # referencia y, con NEARDUP_FOLLOW_LINKS en False, no se siguen sus links
+        page.simhash = simhash(response.text)
+        if page.simhash is None:
+            return False
+        canonical = self.near_duplicates.check(response.url, page.simhash)
+        if canonical is None:
+            return False
+        mark_duplicate(page, body_hash or hashlib.md5(response.text.encode('utf-8')).hexdigest(), canonical)
+        if not self.follow_near_duplicates:
+            response.meta['near_duplicate'] = canonical
+        return True
+
+    def resource_item(self, response):
+        # pdf, imagen, zip o pagina demasiado grande (ver ResponseFilterMiddleware)
+        filtered = response.meta.get('response_filter')
+        if filtered is None:
+            content_type = response.headers.get(b'Content-Type')
+            filtered = (content_type.decode('latin-1').split(';')[0].strip().lower() if content_type else None,
+                len(response.body), 'type')
+        return ResourceItem(int(time.time()), response.url, response.status, *filtered)
+
+    def page_item(self, response, h, ts):
+        # body_hash, titulo, links, css, js, formularios y comentarios los
+        # completa fill_page con el resultado del analisis
+        # el certificado completo solo la primera vez que se ve en el host
+        cert_hash, certificate = self.certificates.track(response.url, response.certificate, ts)
+        page = Page(ts, response.url, response.text, h, response.status, str(response.ip_address),
+            sys.intern(parse.urlparse(response.url).hostname or ''), cert_hash)
+        return PageItem(page, certificate)
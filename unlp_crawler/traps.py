@@ -0,0 +1,214 @@
+import hashlib
+import json
+import re
+from collections import Counter
+from urllib.parse import urlsplit
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+
+
+# Deteccion de trampas: calendarios, segmentos repetidos (/a/b/a/b/...) por
+# links relativos mal armados y busquedas facetadas que generan urls sin fin.
+# Cada link se reduce a una plantilla (numeros, fechas e ids reemplazados,
+# valores de facetas y de la query descartados) y por host se cuentan las
+# urls distintas de cada plantilla. Pasado el presupuesto de una plantilla
+# sus links se bajan de prioridad o se descartan antes de llegar al
+# scheduler.
+
+DATE = re.compile(r'^\d{1,4}([-_.]\d{1,2}){1,2}$')
+HEX = re.compile(r'^[0-9a-f]{8,}$|^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+TOKEN = re.compile(r'^[\w-]{16,}$')
+DIGITS = re.compile(r'\d+')
+FACET = re.compile(r'^([^=:;]*)[=:;].*$')
+
+
+def segment_template(segment):
+    if DATE.match(segment):
+        return '{fecha}'
+    if HEX.match(segment) and not segment.isalpha():
+        return '{id}'
+    if TOKEN.match(segment) and DIGITS.search(segment) and not segment.islower():
+        # tokens de sesion, base64 y similares
+        return '{id}'
+    facet = FACET.match(segment)
+    if facet:
+        return facet.group(1) + '=*'
+    return DIGITS.sub('{n}', segment)
+
+
+def segments(url):
+    return [s for s in urlsplit(url).path.split('/') if s]
+
+
+def url_template(url):
+    # /calendario/2024/05 -> /calendario/{n}/{n}, /noticias?page=3&id=9 -> /noticias?id&page
+    u = urlsplit(url)
+    path = '/' + '/'.join(segment_template(s) for s in segments(url))
+    if u.query:
+        keys = sorted({p.split('=', 1)[0] for p in u.query.split('&') if p})
+        path += '?' + '&'.join(keys)
+    return path
+
+
+def repeated_segments(parts, max_repeat):
+    # un bloque de segmentos que se repite seguido (/a/b/a/b) o un segmento
+    # que aparece mas de max_repeat veces. Los bloques de un solo segmento
+    # numerico no cuentan (/2024/05/05)
+    counts = Counter(parts)
+    if counts and max(counts.values()) > max_repeat:
+        return True
+    n = len(parts)
+    for size in range(1, n // 2 + 1):
+        for i in range(n - 2 * size + 1):
+            block = parts[i:i + size]
+            if block == parts[i + size:i + 2 * size] and not (size == 1 and block[0].isdigit()):
+                return True
+    return False
+
+
+class _HostPatterns:
+    # plantillas de un host: digests de las urls admitidas de cada una y
+    # links podados por (motivo, plantilla)
+
+    def __init__(self):
+        self.patterns = {}
+        self.pruned = Counter()
+
+
+class TrapDetector:
+    # check(url) devuelve (plantilla, motivo) con motivo None si el link
+    # entra en el presupuesto: 'depth' (demasiados segmentos), 'repeated'
+    # (segmentos repetidos), 'patterns' (el host ya tiene max_patterns
+    # plantillas) o 'budget' (la plantilla ya tiene budget urls distintas).
+
+    def __init__(self, budget=500, max_patterns=1000, max_segments=12, max_repeat=3):
+        self.budget = budget
+        self.max_patterns = max_patterns
+        self.max_segments = max_segments
+        self.max_repeat = max_repeat
+        self.hosts = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('TRAP_PATTERN_BUDGET', 500),
+            settings.getint('TRAP_MAX_PATTERNS', 1000),
+            settings.getint('TRAP_MAX_SEGMENTS', 12),
+            settings.getint('TRAP_MAX_SEGMENT_REPEAT', 3))
+
+    def host(self, url):
+        hostname = (urlsplit(url).hostname or '').lower()
+        state = self.hosts.get(hostname)
+        if state is None:
+            state = self.hosts[hostname] = _HostPatterns()
+        return state
+
+    def check(self, url):
+        state = self.host(url)
+        template = url_template(url)
+        reason = self.reason(url, template, state)
+        if reason is not None:
+            state.pruned[(reason, template)] += 1
+        return template, reason
+
+    def reason(self, url, template, state):
+        parts = segments(url)
+        if len(parts) > self.max_segments:
+            return 'depth'
+        if repeated_segments(parts, self.max_repeat):
+            return 'repeated'
+        known = state.patterns.get(template)
+        if known is None:
+            if len(state.patterns) >= self.max_patterns:
+                return 'patterns'
+            known = state.patterns[template] = set()
+        key = hashlib.md5(url.encode('utf-8')).digest()[:8]
+        if key in known:
+            return None
+        if len(known) >= self.budget:
+            return 'budget'
+        known.add(key)
+        return None
+
+    def report(self):
+        # {host: {'patterns': n, 'pruned': {motivo: {plantilla: links}}}}
+        report = {}
+        for hostname, state in self.hosts.items():
+            if not state.pruned:
+                continue
+            pruned = {}
+            for (reason, template), count in state.pruned.most_common():
+                pruned.setdefault(reason, {})[template] = count
+            report[hostname] = {'patterns': len(state.patterns), 'pruned': pruned}
+        return report
+
+
+class TrapMiddleware:
+    # Middleware de spider: pasa cada link que sale del spider por el
+    # TrapDetector. Con TRAP_ACTION = 'deprioritize' los links fuera de
+    # presupuesto se encolan con TRAP_PRIORITY_PENALTY menos de prioridad
+    # (se bajan cuando no queda otra cosa); con 'drop' se descartan. Los
+    # segmentos repetidos y las rutas demasiado largas se descartan siempre.
+    # Al cerrar se loguea por host lo podado y, con TRAP_REPORT_FILE, se
+    # guarda el reporte completo en JSON.
+
+    ACTIONS = ('deprioritize', 'drop')
+    ALWAYS_DROP = ('depth', 'repeated')
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.detector = TrapDetector.from_settings(settings)
+        self.action = settings.get('TRAP_ACTION', 'deprioritize')
+        if self.action not in self.ACTIONS:
+            raise NotConfigured('TRAP_ACTION desconocida: {}'.format(self.action))
+        self.penalty = settings.getint('TRAP_PRIORITY_PENALTY', 100)
+        self.report_file = settings.get('TRAP_REPORT_FILE')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('TRAP_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_spider_output(self, response, result, spider):
+        for r in result:
+            r = self.filter(r)
+            if r is not None:
+                yield r
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for r in result:
+            r = self.filter(r)
+            if r is not None:
+                yield r
+
+    def filter(self, r):
+        if not isinstance(r, Request) or r.dont_filter:
+            return r
+        template, reason = self.detector.check(r.url)
+        if reason is None:
+            return r
+        self.stats.inc_value('traps/{}'.format(reason))
+        if self.action == 'drop' or reason in self.ALWAYS_DROP:
+            self.stats.inc_value('traps/dropped')
+            return None
+        self.stats.inc_value('traps/deprioritized')
+        return r.replace(priority=r.priority - self.penalty)
+
+    def spider_closed(self, spider):
+        report = self.detector.report()
+        self.stats.set_value('traps/hosts', len(report))
+        totals = {h: sum(sum(t.values()) for t in e['pruned'].values()) for h, e in report.items()}
+        for hostname in sorted(totals, key=totals.get, reverse=True)[:20]:
+            for reason, templates in report[hostname]['pruned'].items():
+                top = list(templates.items())[:5]
+                spider.logger.info('Trampas en %s (%s): %d links podados, %s', hostname, reason,
+                    sum(templates.values()), ', '.join('{} ({})'.format(t, c) for t, c in top))
+        if self.report_file:
+            with open(self.report_file, 'w') as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+            spider.logger.info('Reporte de trampas en %s', self.report_file)